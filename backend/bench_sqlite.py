@@ -0,0 +1,111 @@
+"""
+Mixed read/write benchmark for the SQLite engine modes.
+
+Seeds a fresh database per mode, then runs reader threads (channel history pages
+through RoutedSession, as the HTTP endpoints do) against writer threads (one
+message per commit through _commit_batch, as the socket writer does under light
+load) for a fixed time, and prints throughput and latency for each mode.
+
+    python bench_sqlite.py                     # legacy vs wal, 10s each
+    python bench_sqlite.py --seconds 30 --readers 16 --writers 4
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = ("legacy", "wal")
+
+
+def seed(main, rows: int, channels: int):
+    from sqlalchemy import insert
+    main.create_db_tables()
+    main.migrate_db()
+    with main.engine.begin() as conn:
+        for start in range(0, rows, 10000):
+            conn.execute(insert(main.ChatMessage), [
+                {"channel_id": i % channels + 1, "sender_id": i % 50 + 1, "sender_name": f"user{i % 50 + 1}",
+                 "content": f"seed message {i}", "reactions": "{}", "reaction_counts": "{}"}
+                for i in range(start, min(start + 10000, rows))])
+
+
+def pct(values: list, q: float):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2) if values else None
+
+
+def run(args) -> dict:
+    import main
+    seed(main, args.rows, args.channels)
+    stop = time.monotonic() + args.seconds
+    reads, writes, errors = [], [], []
+
+    def reader():
+        rnd = random.Random()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                with main.RoutedSession() as session:
+                    session.exec(main._channel_history_stmt(
+                        rnd.randint(1, args.channels), before=rnd.randint(100, args.rows), limit=50)).all()
+                reads.append(time.perf_counter() - started)
+            except Exception as exc:
+                errors.append(type(exc).__name__)
+
+    def writer():
+        rnd = random.Random()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                main._commit_batch([(main.ChatMessage(channel_id=rnd.randint(1, args.channels), sender_id=1,
+                                                      sender_name="bench", content="bench write"), None)])
+                writes.append(time.perf_counter() - started)
+            except Exception as exc:
+                errors.append(type(exc).__name__)
+
+    threads = ([threading.Thread(target=reader) for _ in range(args.readers)]
+               + [threading.Thread(target=writer) for _ in range(args.writers)])
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {"mode": main.SQLITE_MODE,
+            "reads_per_s": round(len(reads) / args.seconds), "read_p50_ms": pct(reads, 0.5),
+            "read_p99_ms": pct(reads, 0.99),
+            "writes_per_s": round(len(writes) / args.seconds), "write_p50_ms": pct(writes, 0.5),
+            "write_p99_ms": pct(writes, 0.99), "errors": len(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--mode", choices=MODES, help="run one mode in this process (used internally)")
+    args = parser.parse_args()
+    if args.mode:
+        print(json.dumps(run(args)))
+        return
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in MODES:
+            env = {**os.environ, "SQLITE_MODE": mode, "DATABASE_URL": f"sqlite:///{tmp}/bench-{mode}.db"}
+            out = subprocess.run([sys.executable, __file__, "--mode", mode] + sys.argv[1:], env=env,
+                                 capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__) or ".")
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    print(f"{args.readers} readers + {args.writers} writers, {args.seconds:g}s, {args.rows} seeded rows")
+    cols = list(results[0])
+    print("  ".join(f"{c:>13}" for c in cols))
+    for r in results:
+        print("  ".join(f"{str(r[c]):>13}" for c in cols))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Query-plan check for the chat history queries.
+
+Runs EXPLAIN on the statements behind channel_messages, dm_messages, dm_conversations,
+get_thread, pinned_messages and channel_files against DATABASE_URL, and exits non-zero
+if any of them reads the whole chatmessage or dmconversation table instead of using an index.
+
+    python check_query_plans.py
+"""
+import re
+import sys
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+import main
+
+QUERIES = {
+    "channel_messages":        main._channel_history_stmt(1),
+    "channel_messages(before)": main._channel_history_stmt(1, before=1000),
+    "channel_messages(after)":  main._channel_history_stmt(1, after=1000),
+    "dm_messages":             main._dm_history_stmt(1, 2),
+    "dm_messages(before)":     main._dm_history_stmt(1, 2, before=1000),
+    "dm_messages(after)":      main._dm_history_stmt(1, 2, after=1000),
+    "dm_conversations":        main._dm_conversations_stmt(1),
+    "get_thread":              main._thread_stmt(1),
+    "pinned_messages":         main._pinned_stmt(1),
+    "channel_files":           main._files_stmt(1),
+}
+
+
+def explain(session: Session, stmt) -> list:
+    dialect = session.get_bind().dialect
+    sql = str(stmt.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    if dialect.name == "sqlite":
+        return [row[-1] for row in session.execute(text("EXPLAIN QUERY PLAN " + sql))]
+    # Postgres prefers seq scans on small tables; rule them out to see whether an index *can* serve
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    return [row[0] for row in session.execute(text("EXPLAIN " + sql))]
+
+
+def full_scan(plan: list) -> bool:
+    full = re.compile(r"^\s*SCAN (chatmessage|dmconversation)\b|Seq Scan on (chatmessage|dmconversation)")
+    return any(full.search(line) for line in plan)
+
+
+def run() -> int:
+    main.create_db_tables()
+    main.migrate_db()
+    failed = 0
+    with Session(main.engine) as session:
+        for name, stmt in QUERIES.items():
+            plan = explain(session, stmt)
+            bad = full_scan(plan)
+            failed += bad
+            print(f"{'FAIL' if bad else 'ok  '}  {name}")
+            for line in plan:
+                print(f"        {line}")
+    print(f"{failed} of {len(QUERIES)} queries fall back to a full scan" if failed else "all queries use an index")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -16,17 +16,22 @@ Endpoints:
 """
 
 import base64
+import bisect
 import csv
+import functools
 import hashlib
 import io
 import json
 import logging
+import math
 import os
 import re
 import secrets
+import itertools
 import shutil
+import socket
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional
 
@@ -48,10 +53,24 @@ from pydantic import BaseModel, EmailStr
 from starlette.websockets import WebSocketState
 
 import bcrypt as _bcrypt
+import sqlalchemy
+from sqlalchemy import Index, event, func, literal, true, delete as sa_delete, insert as sa_insert, update as sa_update
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from jose import JWTError, jwt
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional fast JSON encoder for WebSocket frames
+    orjson = None
+
 load_dotenv()
 
 # -------------------------------------------------------------
@@ -64,6 +83,10 @@ ADMIN_KEY         = os.getenv("ADMIN_KEY", "synctact-admin-2026")
 GEMINI_API_KEY    = os.getenv("Syntact_Key") or os.getenv("GEMINI_API_KEY", "")
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./synctact.db")
+FRAME_ENCODER = os.getenv("FRAME_ENCODER", "auto")   # auto | orjson | json
+# Chat resume: how long a disconnected user's events are kept, and how many
+RESUME_WINDOW_SECONDS = float(os.getenv("RESUME_WINDOW_SECONDS", "300"))
+RESUME_BUFFER_FRAMES  = int(os.getenv("RESUME_BUFFER_FRAMES", "200"))
 UPLOADS_DIR  = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
@@ -78,9 +101,174 @@ MAX_PEERS_PER_ROOM = 30
 # -------------------------------------------------------------
 # Database � SQLModel + SQLite
 # -------------------------------------------------------------
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")   # optional replica for read-only endpoints
+REPLICA_LAG_SECONDS = float(os.getenv("REPLICA_LAG_SECONDS", "5"))   # reads pinned to the primary after a write
+
+# Connection pools (Postgres, and SQLite in legacy mode). Checkouts that wait for a
+# free connection are timed per pool and reported under "db_pools" in /metrics.
+DB_POOL_SIZE     = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW  = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE  = int(os.getenv("DB_POOL_RECYCLE", "1800"))   # seconds; -1 keeps connections forever
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+
+# SQLite modes: "wal" (default for file databases) turns on WAL journaling and the
+# pragmas below, and gives each engine one writer connection plus a pool of
+# query-only readers, so reads run alongside the single write transaction SQLite
+# allows instead of queueing behind it. "legacy" keeps SQLite's defaults.
+SQLITE_MODE       = os.getenv("SQLITE_MODE", "wal")   # wal | legacy
+SQLITE_READ_POOL  = int(os.getenv("SQLITE_READ_POOL", "8"))
+SQLITE_CACHE_MB   = int(os.getenv("SQLITE_CACHE_MB", "64"))    # page cache per connection
+SQLITE_MMAP_MB    = int(os.getenv("SQLITE_MMAP_MB", "256"))
+SQLITE_BUSY_MS    = int(os.getenv("SQLITE_BUSY_MS", "5000"))
+
+
+def _sqlite_memory(url: str) -> bool:
+    return url.startswith("sqlite") and (":memory:" in url or url.rstrip("/") in ("sqlite:", "sqlite:/"))
+
+
+_sqlite_wal = DATABASE_URL.startswith("sqlite") and not _sqlite_memory(DATABASE_URL) and SQLITE_MODE == "wal"
+
+
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")        # durable at checkpoints; no fsync per commit
+    cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_MS}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+
+def _sqlite_reader(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA query_only=1")
+    cur.close()
+
+
+_pool_stats: Dict[str, dict] = {}       # pool label → checkout counters
+_pool_waits: Dict[str, deque] = {}      # pool label → recent checkout waits (ms)
+_engines: Dict[str, object] = {}        # pool label → engine, for /metrics
+
+
+class _TimedCheckout:
+    """Pool mixin: times every checkout, so pool exhaustion shows up as wait time."""
+    label = "db"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        stats = _pool_stats[self.label]
+        try:
+            conn = super()._do_get()
+        except sa_exc.TimeoutError:
+            stats["timeouts"] += 1
+            raise
+        waited = (time.perf_counter() - started) * 1000
+        stats["checkouts"] += 1
+        if waited >= 1:
+            stats["waited"] += 1
+        _pool_waits[self.label].append(waited)
+        return conn
+
+
+def _make_engine(create, url: str, label: str, pool_size: int = None, max_overflow: int = None, **kw):
+    if _sqlite_memory(url):
+        return create(url, echo=False, **kw)
+    base = AsyncAdaptedQueuePool if create is create_async_engine else QueuePool
+    _pool_stats[label] = {"checkouts": 0, "waited": 0, "timeouts": 0}
+    _pool_waits[label] = deque(maxlen=1024)
+    _engines[label] = create(
+        url, echo=False, poolclass=type(base.__name__, (_TimedCheckout, base), {"label": label}),
+        pool_size=DB_POOL_SIZE if pool_size is None else pool_size,
+        max_overflow=DB_MAX_OVERFLOW if max_overflow is None else max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING, **kw)
+    return _engines[label]
+
+
+def _make_engines(create, url: str, read_url: str = "", prefix: str = "", **kw):
+    """(writer, reader, replica) engines. writer and reader are the same engine unless SQLite
+    runs in WAL mode; replica is the DATABASE_READ_URL engine, or the reader without one."""
+    if _sqlite_wal:
+        writer = _make_engine(create, url, prefix + "writer", 1, 0, **kw)
+        reader = _make_engine(create, url, prefix + "reader", SQLITE_READ_POOL, 0, **kw)
+        for e in (writer, reader):
+            event.listen(getattr(e, "sync_engine", e), "connect", _sqlite_pragmas)
+        event.listen(getattr(reader, "sync_engine", reader), "connect", _sqlite_reader)
+    else:
+        writer = reader = _make_engine(create, url, prefix + "primary", **kw)
+    replica = _make_engine(create, read_url, prefix + "replica", **kw) if read_url else reader
+    return writer, reader, replica
+
+
+def _pool_metrics() -> dict:
+    out = {}
+    for label, e in _engines.items():
+        pool = getattr(e, "sync_engine", e).pool
+        waits = sorted(_pool_waits[label])
+        pct = lambda q: round(waits[min(len(waits) - 1, int(q * len(waits)))], 2) if waits else None
+        out[label] = {**_pool_stats[label], "size": pool.size(), "checked_out": pool.checkedout(),
+                      "overflow": pool.overflow(), "wait_ms_p50": pct(0.5), "wait_ms_p99": pct(0.99),
+                      "wait_ms_max": round(waits[-1], 2) if waits else None}
+    return out
+
+
 # SQLite needs check_same_thread=False; Postgres does not take that arg
 _connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-engine = create_engine(DATABASE_URL, echo=False, connect_args=_connect_args)
+engine, read_engine, replica_engine = _make_engines(
+    create_engine, DATABASE_URL, DATABASE_READ_URL, connect_args=_connect_args)
+
+
+def _async_url(url: str) -> str:
+    """The same database through an asyncio driver (aiosqlite / asyncpg)."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith(("postgres://", "postgresql://", "postgresql+psycopg2://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1].replace("sslmode=", "ssl=")
+    return url
+
+
+# Async engine for code running on the event loop (WebSockets, background loops,
+# async endpoints); sync endpoints keep using `engine` from the threadpool.
+# (the replica serves sync read endpoints only, so there is no async one)
+async_engine, async_read_engine, _ = _make_engines(create_async_engine, _async_url(DATABASE_URL), prefix="async_")
+
+
+class RoutedSession(Session):
+    """Reads use the reader engine until the session writes (a flush, an INSERT/UPDATE/
+    DELETE or a SELECT ... FOR UPDATE); from then until the transaction ends everything
+    goes to the writer, so a transaction always sees its own writes."""
+    writer = engine
+    reader = read_engine
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or (clause is not None and (
+                getattr(clause, "is_dml", False) or getattr(clause, "_for_update_arg", None) is not None)):
+            self.info["writing"] = True
+        return self.writer if self.info.get("writing") else self.reader
+
+
+@event.listens_for(RoutedSession, "after_transaction_end")
+def _routed_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("writing", None)
+
+
+class ReplicaSession(RoutedSession):
+    """For read-only endpoints: reads may go to the DATABASE_READ_URL replica and so can lag
+    the primary slightly. Endpoints a client re-reads right after its own write (history,
+    threads, pins, files, gallery) use get_user_read_session, which keeps that user on the
+    primary for REPLICA_LAG_SECONDS after each write."""
+    reader = replica_engine
+
+
+class AsyncRoutedSession(RoutedSession):
+    writer = async_engine.sync_engine
+    reader = async_read_engine.sync_engine
+
+
+async_session = async_sessionmaker(class_=AsyncSession, sync_session_class=AsyncRoutedSession,
+                                   expire_on_commit=False)
 
 
 class User(SQLModel, table=True):
@@ -123,15 +311,86 @@ class ChatMessage(SQLModel, table=True):
     content:       str                = Field(default="")
     file_url:      Optional[str]      = None
     file_name:     Optional[str]      = None
-    reactions:     str                = Field(default="{}")   # JSON {"😀": [uid,...]}
+    reactions:     str                = Field(default="{}")   # JSON {"😀": [uid,...]}, first REACTION_USERS_CAP
+    reaction_counts: str              = Field(default="{}")   # JSON {"😀": n}; both summarise MessageReaction
     pinned:        bool               = Field(default=False)
     parent_id:     Optional[int]      = Field(default=None)   # thread parent id
     bot_name:      Optional[str]      = Field(default=None)   # set for bot/webhook messages
     edited:        bool               = Field(default=False)
     edited_at:     Optional[datetime] = Field(default=None)
     forwarded_from: Optional[int]     = Field(default=None)   # original message id
+    client_msg_id: Optional[str]      = Field(default=None)   # sender-generated id for idempotent sends
+    dm_lo:         Optional[int]      = Field(default=None)   # DM conversation key: (min, max) of
+    dm_hi:         Optional[int]      = Field(default=None)   # the two user ids; set on insert
     created_at:    datetime           = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    # History reads page by id within one of these keys; see _channel_history_stmt & co.
+    # (sender_id lookups use the leading column of the client_msg_id index.)
+    __table_args__ = (
+        Index("ix_chatmessage_sender_client_msg", "sender_id", "client_msg_id", unique=True),
+        Index("ix_chatmessage_channel_id", "channel_id", "id"),
+        Index("ix_chatmessage_channel_pinned", "channel_id", "pinned"),
+        Index("ix_chatmessage_parent_id", "parent_id", "id"),
+        Index("ix_chatmessage_dm_conv", "dm_lo", "dm_hi", "id"),
+    )
+
+
+class DmConversation(SQLModel, table=True):
+    """A user's side of a DM conversation: the newest message and how many are unread.
+    Kept up to date by the ChatMessage insert hooks below; read by GET /chat/dm."""
+    user_id:         int      = Field(primary_key=True)
+    partner_id:      int      = Field(primary_key=True)
+    last_message_id: int
+    last_message_at: datetime
+    unread:          int      = Field(default=0)
+
+    __table_args__ = (Index("ix_dmconversation_recent", "user_id", "last_message_at"),)
+
+
+class MessageReaction(SQLModel, table=True):
+    """One user's reaction to a message. Toggling is a single INSERT or DELETE here;
+    ChatMessage.reactions / reaction_counts are rebuilt from these rows (see _toggle_reaction)."""
+    message_id: int      = Field(primary_key=True)
+    emoji:      str      = Field(primary_key=True)
+    user_id:    int      = Field(primary_key=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+def _dm_key(a: int, b: int) -> tuple:
+    return (a, b) if a <= b else (b, a)
+
+
+@event.listens_for(ChatMessage, "before_insert")
+def _set_dm_key(mapper, connection, cm: ChatMessage):
+    if cm.channel_id is None and cm.dm_to_user_id is not None:
+        cm.dm_lo, cm.dm_hi = _dm_key(cm.sender_id, cm.dm_to_user_id)
+
+
+@event.listens_for(ChatMessage, "after_insert")
+def _bump_dm_conversation(mapper, connection, cm: ChatMessage):
+    """Every DM insert (whichever code path) moves both sides of the conversation to the
+    new message, in the same transaction; the recipient's side gains an unread.
+    One upsert per side, so two workers starting the same conversation cannot collide."""
+    if cm.channel_id is not None or cm.dm_to_user_id is None:
+        return
+    sides = {(cm.sender_id, cm.dm_to_user_id): False, (cm.dm_to_user_id, cm.sender_id): True}
+    if cm.sender_id == cm.dm_to_user_id:
+        sides = {(cm.sender_id, cm.sender_id): False}
+    upsert = pg_insert if connection.dialect.name == "postgresql" else sqlite_insert
+    for (user_id, partner_id), incoming in sides.items():
+        stmt = upsert(DmConversation).values(user_id=user_id, partner_id=partner_id, last_message_id=cm.id,
+                                             last_message_at=cm.created_at, unread=int(incoming))
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id", "partner_id"],
+            set_={"last_message_id": stmt.excluded.last_message_id,
+                  "last_message_at": stmt.excluded.last_message_at,
+                  "unread": DmConversation.unread + 1 if incoming else 0}))
+
+
+@event.listens_for(ChatMessage, "after_delete")
+def _drop_reactions(mapper, connection, cm: ChatMessage):
+    connection.execute(sa_delete(MessageReaction).where(MessageReaction.message_id == cm.id))
+
 
 class Poll(SQLModel, table=True):
     id:            Optional[int] = Field(default=None, primary_key=True)
@@ -379,12 +638,14 @@ def create_db_tables():
 
 def migrate_db():
     """Add new columns to existing tables without losing data."""
-    import sqlalchemy
     insp = sqlalchemy.inspect(engine)
     tables = insp.get_table_names()
+    # read the schema up front: on SQLite the inspector's own connection would block
+    # behind the write lock this transaction takes
+    columns = {t: {c['name'] for c in insp.get_columns(t)} for t in ('chatmessage', 'user', 'channel') if t in tables}
     with engine.begin() as conn:
         if 'chatmessage' in tables:
-            existing = {c['name'] for c in insp.get_columns('chatmessage')}
+            existing = columns['chatmessage']
             for col, ddl in [
                 ('pinned',         'ALTER TABLE chatmessage ADD COLUMN pinned BOOLEAN DEFAULT FALSE'),
                 ('parent_id',      'ALTER TABLE chatmessage ADD COLUMN parent_id INTEGER DEFAULT NULL'),
@@ -392,11 +653,26 @@ def migrate_db():
                 ('edited',         'ALTER TABLE chatmessage ADD COLUMN edited BOOLEAN DEFAULT FALSE'),
                 ('edited_at',      'ALTER TABLE chatmessage ADD COLUMN edited_at DATETIME DEFAULT NULL'),
                 ('forwarded_from', 'ALTER TABLE chatmessage ADD COLUMN forwarded_from INTEGER DEFAULT NULL'),
+                ('client_msg_id',  'ALTER TABLE chatmessage ADD COLUMN client_msg_id VARCHAR DEFAULT NULL'),
+                ('dm_lo',          'ALTER TABLE chatmessage ADD COLUMN dm_lo INTEGER DEFAULT NULL'),
+                ('dm_hi',          'ALTER TABLE chatmessage ADD COLUMN dm_hi INTEGER DEFAULT NULL'),
+                ('reaction_counts', "ALTER TABLE chatmessage ADD COLUMN reaction_counts VARCHAR DEFAULT '{}'"),
             ]:
                 if col not in existing:
                     conn.execute(sqlalchemy.text(ddl))
+            if 'dm_lo' not in existing:
+                conn.execute(sqlalchemy.text(
+                    "UPDATE chatmessage SET"
+                    " dm_lo = CASE WHEN sender_id < dm_to_user_id THEN sender_id ELSE dm_to_user_id END,"
+                    " dm_hi = CASE WHEN sender_id < dm_to_user_id THEN dm_to_user_id ELSE sender_id END"
+                    " WHERE channel_id IS NULL AND dm_to_user_id IS NOT NULL"))
+            conn.execute(sqlalchemy.text("DROP INDEX IF EXISTS ix_chatmessage_dm_pair"))
+            for ix in ChatMessage.__table__.indexes:
+                ix.create(conn, checkfirst=True)
+            _backfill_dm_conversations(conn)
+            _backfill_reactions(conn)
         if 'user' in tables:
-            existing = {c['name'] for c in insp.get_columns('user')}
+            existing = columns['user']
             for col, ddl in [
                 ('banned',       'ALTER TABLE user ADD COLUMN banned BOOLEAN DEFAULT FALSE'),
                 ('avatar_url',   'ALTER TABLE user ADD COLUMN avatar_url VARCHAR DEFAULT NULL'),
@@ -411,7 +687,7 @@ def migrate_db():
                 if col not in existing:
                     conn.execute(sqlalchemy.text(ddl))
         if 'channel' in tables:
-            existing = {c['name'] for c in insp.get_columns('channel')}
+            existing = columns['channel']
             for col, ddl in [
                 ('slowmode_seconds', 'ALTER TABLE channel ADD COLUMN slowmode_seconds INTEGER DEFAULT 0'),
                 ('category_id',      'ALTER TABLE channel ADD COLUMN category_id INTEGER DEFAULT NULL'),
@@ -426,8 +702,56 @@ def migrate_db():
         # UserWarning table likewise created by create_all
 
 
+def _backfill_dm_conversations(conn):
+    """Build DmConversation from existing DMs the first time the table is empty (unread starts at 0)."""
+    if conn.execute(select(func.count()).select_from(DmConversation)).scalar():
+        return
+    # done in SQL (INSERT ... SELECT) so the number of conversations never turns into
+    # bound parameters; one insert per side, the second skipping self-DMs
+    last = (select(ChatMessage.dm_lo, ChatMessage.dm_hi, func.max(ChatMessage.id).label("mid"))
+            .where(ChatMessage.dm_lo != None)  # noqa: E711
+            .group_by(ChatMessage.dm_lo, ChatMessage.dm_hi).subquery())
+    cols = ["user_id", "partner_id", "last_message_id", "last_message_at", "unread"]
+    for user_col, partner_col, where in ((last.c.dm_lo, last.c.dm_hi, true()),
+                                         (last.c.dm_hi, last.c.dm_lo, last.c.dm_lo != last.c.dm_hi)):
+        conn.execute(sa_insert(DmConversation).from_select(cols, select(
+            user_col, partner_col, last.c.mid, ChatMessage.created_at, literal(0))
+            .join(ChatMessage, ChatMessage.id == last.c.mid).where(where)))
+
+
+def _backfill_reactions(conn):
+    """Move the old JSON reactions into MessageReaction the first time the table is empty."""
+    if conn.execute(select(func.count()).select_from(MessageReaction)).scalar():
+        return
+    rows = conn.execute(select(ChatMessage.id, ChatMessage.reactions, ChatMessage.created_at)
+                        .where(ChatMessage.reactions != "{}", ChatMessage.reactions != "")).all()
+    for msg_id, raw, created_at in rows:
+        try:
+            reacts = json.loads(raw or "{}")
+        except ValueError:
+            continue
+        pairs = [(emoji, uid) for emoji, uids in reacts.items() for uid in dict.fromkeys(uids)]
+        if pairs:
+            conn.execute(sa_insert(MessageReaction), [
+                {"message_id": msg_id, "emoji": emoji, "user_id": uid, "created_at": created_at}
+                for emoji, uid in pairs])
+        users, counts = _reaction_summary(pairs)
+        conn.execute(sa_update(ChatMessage).where(ChatMessage.id == msg_id)
+                     .values(reactions=json.dumps(users), reaction_counts=json.dumps(counts)))
+
+
 def get_session():
-    with Session(engine) as session:
+    with RoutedSession() as session:
+        yield session
+
+
+def get_read_session():
+    with ReplicaSession() as session:
+        yield session
+
+
+async def get_async_session():
+    async with async_session() as session:
         yield session
 
 
@@ -474,6 +798,47 @@ def get_current_user(
     return user
 
 
+# ── Read-your-writes on the replica ──────────────────────────
+# A user who just sent, pinned, edited or uploaded reads from the primary until
+# REPLICA_LAG_SECONDS have passed, so their next history/pins/gallery request can't
+# reach a replica that hasn't caught up yet. The pin is shared with the other workers
+# (at most every half window per user) because the read may land on any of them.
+_read_pins: Dict[int, float] = {}      # { user_id: monotonic time the pin expires }
+_read_pin_sent: Dict[int, float] = {}  # { user_id: monotonic time we last published a pin }
+
+
+def _pin_reads_local(user_id: int):
+    now = time.monotonic()
+    if len(_read_pins) > 10_000:
+        for uid in [u for u, t in _read_pins.items() if t <= now]:
+            _read_pins.pop(uid, None); _read_pin_sent.pop(uid, None)
+    _read_pins[user_id] = now + REPLICA_LAG_SECONDS
+
+
+async def _pin_reads(user_id: int):
+    """Call after a write by user_id that they will read back."""
+    if replica_engine is read_engine or not user_id:
+        return
+    _pin_reads_local(user_id)
+    now = time.monotonic()
+    if now - _read_pin_sent.get(user_id, -REPLICA_LAG_SECONDS) >= REPLICA_LAG_SECONDS / 2:
+        _read_pin_sent[user_id] = now
+        await backplane.publish("read_pin", {"user_id": user_id})
+
+
+async def _on_read_pin(data: dict):
+    if data.get("user_id"):
+        _pin_reads_local(data["user_id"])
+
+
+def get_user_read_session(current_user: User = Depends(get_current_user)):
+    """get_read_session, except on the primary while current_user's own write may still be
+    replicating."""
+    pinned = _read_pins.get(current_user.id, 0) > time.monotonic()
+    with (RoutedSession() if pinned else ReplicaSession()) as session:
+        yield session
+
+
 # -------------------------------------------------------------
 # Pydantic request / response schemas
 # -------------------------------------------------------------
@@ -510,8 +875,50 @@ app.add_middleware(
 
 app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
 
-# Chat WebSocket connections: { user_id: WebSocket }
-chat_connections: Dict[int, WebSocket] = {}
+class ChatConn:
+    """One chat socket of a user (a browser tab or a device)."""
+    __slots__ = ("conn_id", "user_id", "device", "ws", "focus", "connected_at")
+
+    def __init__(self, conn_id: str, user_id: int, device: str, ws: WebSocket):
+        self.conn_id      = conn_id
+        self.user_id      = user_id
+        self.device       = device
+        self.ws           = ws
+        self.focus        = None     # channel_id currently on screen
+        self.connected_at = time.time()
+
+
+class ChatStream:
+    """Per-user sequence of durable chat events, with a replay buffer for resuming sockets."""
+    __slots__ = ("seq", "buffer", "expires")
+
+    def __init__(self):
+        self.seq     = 0
+        self.buffer  = deque(maxlen=RESUME_BUFFER_FRAMES)   # (seq, type, text)
+        self.expires = None      # set while the user has no socket: monotonic deadline
+
+
+# Chat WebSocket connections: { user_id: {ChatConn, ...} } — one entry per tab / device
+chat_connections: Dict[int, set] = {}
+_conn_counter = itertools.count(1)
+
+# Channel subscription index: { channel_id: {user_id, ...} }
+# Maintained from the join / leave frames each chat socket sends for its sidebar.
+_channel_subs: Dict[int, set] = defaultdict(set)
+# Channel viewers: { channel_id: {ChatConn, ...} } — sockets whose focused view is that channel
+_channel_viewers: Dict[int, set] = defaultdict(set)
+# Reverse index: { user_id: {channel_id, ...} }
+_user_subs: Dict[int, set] = {}
+# Sockets whose client never sent a join frame (legacy) — they get every channel event
+_unscoped_conns: set = set()
+# Archived channels accept no viewers (no typing indicators)
+_archived_channels: set = set()
+
+# Resumable sessions: { user_id: ChatStream }. A user's stream (and subscriptions)
+# outlive their last socket for RESUME_WINDOW_SECONDS so a reconnect can replay the gap.
+# Sequence numbers restart with the process, so resume tokens carry this epoch.
+_streams: Dict[int, ChatStream] = {}
+_stream_epoch = secrets.token_hex(4)
 
 # Slowmode tracking: { (user_id, channel_id): last_message_unix_timestamp }
 _slowmode_last: Dict[tuple, float] = {}
@@ -521,7 +928,7 @@ _bad_words_cache: set = set()
 
 def _reload_bad_words():
     global _bad_words_cache
-    with Session(engine) as s:
+    with RoutedSession() as s:
         _bad_words_cache = {bw.word.lower() for bw in s.exec(select(BadWord)).all()}
 
 def _filter_bad_words(text: str) -> str:
@@ -538,16 +945,16 @@ def _filter_bad_words(text: str) -> str:
             result.append(w)
     return ' '.join(result)
 
-def _log_audit(session: Session, action: str, actor_id: int, actor_name: str,
-               target_user_id: int = None, target_user_name: str = None,
-               channel_id: int = None, detail: str = None):
+async def _log_audit(session: AsyncSession, action: str, actor_id: int, actor_name: str,
+                     target_user_id: int = None, target_user_name: str = None,
+                     channel_id: int = None, detail: str = None):
     entry = AuditLog(
         action=action, actor_id=actor_id, actor_name=actor_name,
         target_user_id=target_user_id, target_user_name=target_user_name,
         channel_id=channel_id, detail=detail,
     )
     session.add(entry)
-    session.commit()
+    await session.commit()
 
 
 @app.on_event("startup")
@@ -565,6 +972,7 @@ def on_startup():
     ]
     with Session(engine) as session:
         existing = session.exec(select(Channel)).all()
+        _archived_channels.update(ch.id for ch in existing if ch.archived)
         if not existing:
             for _, cname, cdesc in _DEFAULT_CHANNELS:
                 session.add(Channel(name=cname, description=cdesc, created_by=0))
@@ -589,14 +997,14 @@ async def _run_scheduler():
         await _asyncio.sleep(20)
         try:
             now = datetime.now(timezone.utc)
-            with Session(engine) as sess:
+            async with async_session() as sess:
                 # -- One-time scheduled messages --
-                pending = sess.exec(
+                pending = (await sess.exec(
                     select(ScheduledMessage).where(
                         ScheduledMessage.sent == False,  # noqa: E712
                         ScheduledMessage.send_at <= now,
                     )
-                ).all()
+                )).all()
                 for sm in pending:
                     cm = ChatMessage(
                         channel_id=sm.channel_id, dm_to_user_id=sm.dm_to_user_id,
@@ -606,19 +1014,20 @@ async def _run_scheduler():
                     sess.add(cm)
                     sm.sent = True
                     sess.add(sm)
-                    sess.commit()
-                    sess.refresh(cm)
+                    await sess.commit()
+                    await sess.refresh(cm)
                     if cm.channel_id:
-                        await _chat_broadcast({"type": "channel_message", "message": _msg_dict(cm)})
+                        await _chat_broadcast({"type": "channel_message", "message": _msg_dict(cm)},
+                                              channel_id=cm.channel_id)
                     else:
-                        p = {"type": "dm", "message": _msg_dict(cm)}
+                        p = Frame({"type": "dm", "message": _msg_dict(cm)})
                         await _chat_send(cm.dm_to_user_id, p)
                         await _chat_send(cm.sender_id, p)
 
                 # -- Recurring tasks (Volt auto-posts) --
-                rt_all = sess.exec(
+                rt_all = (await sess.exec(
                     select(RecurringTask).where(RecurringTask.active == True)  # noqa: E712
-                ).all()
+                )).all()
                 for rt in rt_all:
                     if rt.last_run is None:
                         due = True
@@ -644,8 +1053,8 @@ async def _run_scheduler():
                         sess.add(cm)
                         rt.last_run = now
                         sess.add(rt)
-                        sess.commit()
-                        sess.refresh(cm)
+                        await sess.commit()
+                        await sess.refresh(cm)
                         if cm.channel_id:
                             _bcast = {"type": "channel_message", "message": _msg_dict(cm)}
                             if rt.open_url:
@@ -653,7 +1062,7 @@ async def _run_scheduler():
                                 target = rt.url_target or "self"
                                 if target == "channel":
                                     # Allow if task owner is channel owner OR system channel
-                                    ch = sess.get(Channel, rt.channel_id)
+                                    ch = await sess.get(Channel, rt.channel_id)
                                     if ch and (ch.created_by == 0 or ch.created_by == rt.owner_id):
                                         _bcast["open_url"] = rt.open_url
                                         # open_url_for_uid absent → everyone
@@ -663,7 +1072,7 @@ async def _run_scheduler():
                                 else:  # "self"
                                     _bcast["open_url"] = rt.open_url
                                     _bcast["open_url_for_uid"] = rt.owner_id
-                            await _chat_broadcast(_bcast)
+                            await _chat_broadcast(_bcast, channel_id=cm.channel_id)
         except Exception as exc:
             log.warning("Scheduler error: %s", exc)
 
@@ -731,7 +1140,7 @@ def me(current_user: User = Depends(get_current_user)):
     return {
         "id": current_user.id, "name": current_user.name, "email": current_user.email,
         "role": getattr(current_user, "role", "member"),
-        "presence": getattr(current_user, "presence", "online"),
+        "presence": _presence_pref.get(current_user.id, getattr(current_user, "presence", "online")),
         "totp_enabled": getattr(current_user, "totp_enabled", False),
         "avatar_url": current_user.avatar_url,
         "title": getattr(current_user, "title", None),
@@ -803,15 +1212,14 @@ def twofa_disable(current_user: User = Depends(get_current_user), session: Sessi
 # Presence
 # -------------------------------------------------------------
 @app.patch("/users/me/presence")
-async def update_presence(body: dict, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    allowed = {"online", "away", "dnd", "offline"}
+async def update_presence(body: dict, current_user: User = Depends(get_current_user)):
+    allowed = PRESENCE_STATUSES
     pres = body.get("presence", "online")
     if pres not in allowed:
         raise HTTPException(400, "Invalid presence value")
-    user = session.get(User, current_user.id)
-    user.presence = pres
-    session.add(user); session.commit()
-    await _chat_broadcast({"type": "user_status", "user_id": current_user.id, "presence": pres})
+    # Kept in memory and written to the DB by the presence loop's next batch
+    _presence_dirty.add(current_user.id)
+    await backplane.publish("presence_pref", {"user_id": current_user.id, "presence": pres})
     return {"ok": True, "presence": pres}
 
 
@@ -850,7 +1258,7 @@ def channel_members(channel_id: int, current_user: User = Depends(get_current_us
     role_map = {r.user_id: r.role for r in roles_rows}
     return [{"id": u.id, "name": u.name, "avatar": u.avatar,
              "role": role_map.get(u.id, getattr(u, "role", "member")),
-             "presence": getattr(u, "presence", "online")} for u in users]
+             "presence": _presence_of(u.id)} for u in users]
 
 @app.put("/channels/{channel_id}/members/{user_id}/role")
 def set_channel_role(channel_id: int, user_id: int, body: dict,
@@ -895,8 +1303,8 @@ def delete_webhook(wid: int, current_user: User = Depends(get_current_user), ses
     return {"ok": True}
 
 @app.post("/webhook/{token}")
-async def receive_webhook(token: str, body: dict, session: Session = Depends(get_session)):
-    wh = session.exec(select(WebhookConfig).where(WebhookConfig.token == token, WebhookConfig.active == True)).first()
+async def receive_webhook(token: str, body: dict, session: AsyncSession = Depends(get_async_session)):
+    wh = (await session.exec(select(WebhookConfig).where(WebhookConfig.token == token, WebhookConfig.active == True))).first()
     if not wh:
         raise HTTPException(404, "Webhook not found")
     content = str(body.get("content", "")).strip()[:2000]
@@ -905,40 +1313,23 @@ async def receive_webhook(token: str, body: dict, session: Session = Depends(get
         raise HTTPException(400, "content required")
     msg = ChatMessage(channel_id=wh.channel_id, sender_id=0, sender_name=sender,
                       content=content, bot_name=wh.name)
-    session.add(msg); session.commit(); session.refresh(msg)
+    session.add(msg); await session.commit(); await session.refresh(msg)
     await _chat_broadcast({"type": "channel_message", "channel_id": wh.channel_id,
                            "message": {"id": msg.id, "content": msg.content,
                                        "sender_name": msg.sender_name, "sender_id": 0,
                                        "bot_name": msg.bot_name,
-                                       "ts": str(msg.created_at), "reactions": {}}})
+                                       "ts": str(msg.created_at), "reactions": {}}},
+                          channel_id=wh.channel_id)
     return {"ok": True, "message_id": msg.id}
 
 
-# -------------------------------------------------------------
-# Full-text search
-# -------------------------------------------------------------
-@app.get("/chat/search")
-def search_messages(q: str = "", limit: int = 50, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    if not q.strip():
-        return []
-    rows = session.exec(
-        select(ChatMessage)
-        .where(ChatMessage.content.contains(q))
-        .order_by(ChatMessage.created_at.desc())
-        .limit(limit)
-    ).all()
-    return [{"id": m.id, "content": m.content, "channel_id": m.channel_id,
-             "sender_id": m.sender_id, "sender_name": m.sender_name,
-             "created_at": str(m.created_at)} for m in rows]
-
-
 # -------------------------------------------------------------
 # Export chat history
 # -------------------------------------------------------------
 @app.get("/chat/channels/{channel_id}/export")
 def export_channel(channel_id: int, format: str = "json",
                    current_user: User = Depends(get_current_user),
-                   session: Session = Depends(get_session)):
+                   session: Session = Depends(get_read_session)):
     rows = session.exec(
         select(ChatMessage)
         .where(ChatMessage.channel_id == channel_id)
@@ -981,7 +1372,7 @@ def get_audit_log(limit: int = 50, channel_id: Optional[int] = None,
 @app.get("/analytics/activity")
 def analytics_activity(channel_id: Optional[int] = None, days: int = 7,
                         current_user: User = Depends(get_current_user),
-                        session: Session = Depends(get_session)):
+                        session: Session = Depends(get_read_session)):
     cutoff = datetime.utcnow() - timedelta(days=days)
     q = select(ChatMessage).where(ChatMessage.created_at >= cutoff)
     if channel_id:
@@ -997,7 +1388,7 @@ def analytics_activity(channel_id: Optional[int] = None, days: int = 7,
 @app.get("/analytics/leaderboard")
 def analytics_leaderboard(channel_id: Optional[int] = None, limit: int = 10,
                            current_user: User = Depends(get_current_user),
-                           session: Session = Depends(get_session)):
+                           session: Session = Depends(get_read_session)):
     q = select(ChatMessage).where(ChatMessage.sender_id != 0)
     if channel_id:
         q = q.where(ChatMessage.channel_id == channel_id)
@@ -1249,13 +1640,17 @@ def update_channel_settings(channel_id: int, body: ChannelSettingsIn,
     ch = session.get(Channel, channel_id)
     if not ch:
         raise HTTPException(status_code=404, detail="Channel not found")
-    if body.archived is not None:  ch.archived = body.archived
+    if body.archived is not None:
+        ch.archived = body.archived
+        _publish_from_thread("chat_index", {"op": "archive", "channel_id": channel_id,
+                                            "archived": ch.archived})
     if body.readonly is not None:  ch.readonly = body.readonly
     if body.name is not None:      ch.name = body.name[:80]
     if body.description is not None: ch.description = body.description[:300]
     if body.welcome_message is not None: ch.welcome_message = body.welcome_message[:500]
     if body.slowmode_seconds is not None: ch.slowmode_seconds = max(0, body.slowmode_seconds)
     session.add(ch); session.commit()
+    _publish_from_thread("mod_cache", {"channel_id": channel_id})
     return {"ok": True, "channel_id": channel_id, "archived": ch.archived, "readonly": ch.readonly}
 
 
@@ -1264,7 +1659,7 @@ def update_channel_settings(channel_id: int, body: ChannelSettingsIn,
 # ─────────────────────────────────────────────────────────────
 
 @app.get("/discovery")
-def server_discovery(session: Session = Depends(get_session)):
+def server_discovery(session: Session = Depends(get_read_session)):
     """Return all non-archived channels with member/message counts."""
     channels = session.exec(select(Channel).where(Channel.archived == False)).all()
     out = []
@@ -1283,15 +1678,12 @@ def server_discovery(session: Session = Depends(get_session)):
 # ─────────────────────────────────────────────────────────────
 
 @app.get("/files/{channel_id}")
-def channel_files(channel_id: int, current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    rows = session.exec(
-        select(ChatMessage).where(
-            ChatMessage.channel_id == channel_id,
-            ChatMessage.file_url != None,
-        ).order_by(ChatMessage.created_at.desc())
-    ).all()
-    return [{"id": m.id, "file_url": m.file_url, "file_name": m.file_name,
-             "sender_name": m.sender_name, "ts": m.created_at.isoformat()} for m in rows]
+def channel_files(channel_id: int, before: Optional[str] = None, after: Optional[str] = None,
+                  around: Optional[int] = None, limit: int = 50,
+                  current_user: User = Depends(get_current_user), session: Session = Depends(get_user_read_session)):
+    return _keyset_page(session, functools.partial(_files_stmt, channel_id), before, after, around, limit,
+                        render=lambda m: {"id": m.id, "file_url": m.file_url, "file_name": m.file_name,
+                                          "sender_name": m.sender_name, "ts": m.created_at.isoformat()})
 
 
 # ─────────────────────────────────────────────────────────────
@@ -1326,13 +1718,13 @@ async def start_call(channel_id: int, current_user: User = Depends(get_current_u
         "room_code":    room_code,
         "started_by":   current_user.id,
         "started_name": current_user.name,
-    })
+    }, channel_id=channel_id)
     return {"room_code": room_code}
 
 
 @app.delete("/channels/{channel_id}/call")
 async def end_call(channel_id: int, current_user: User = Depends(get_current_user)):
-    await _chat_broadcast({"type": "call_ended", "channel_id": channel_id})
+    await _chat_broadcast({"type": "call_ended", "channel_id": channel_id}, channel_id=channel_id)
     return {"ok": True}
 
 
@@ -1363,14 +1755,14 @@ def update_notif_prefs(body: NotifPrefIn, current_user: User = Depends(get_curre
 # ─────────────────────────────────────────────────────────────
 
 @app.post("/email-digest")
-async def trigger_email_digest(current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
+async def trigger_email_digest(current_user: User = Depends(get_current_user), session: AsyncSession = Depends(get_async_session)):
     """Stub: in production wire SMTP_HOST/SMTP_USER/SMTP_PASS env vars."""
     smtp_host = os.getenv("SMTP_HOST")
     if not smtp_host:
         return {"ok": False, "detail": "SMTP not configured on server"}
 
     since = datetime.now(timezone.utc) - timedelta(hours=24)
-    msgs = session.exec(select(ChatMessage).where(ChatMessage.created_at >= since).order_by(ChatMessage.created_at.desc()).limit(20)).all()
+    msgs = (await session.exec(select(ChatMessage).where(ChatMessage.created_at >= since).order_by(ChatMessage.created_at.desc()).limit(20))).all()
     body_lines = [f"• [{m.sender_name}] {m.content[:120]}" for m in msgs if m.content]
     body_text = "Your SyncTact digest (last 24 h):\n\n" + "\n".join(body_lines[:20])
     try:
@@ -1431,33 +1823,571 @@ def admin_delete_user(
 # Utility endpoints
 # -------------------------------------------------------------
 
-# In-memory room registry  { room_code: { peer_id: { ws, name } } }
+# In-memory room registry of the rooms this worker owns  { room_code: { peer_id: { name, worker } } }
 rooms: Dict[str, Dict[str, dict]] = {}
+# Signaling sockets accepted by this worker  { room_code: { peer_id: WebSocket } }
+_room_sockets: Dict[str, Dict[str, WebSocket]] = {}
 
 
-async def safe_send(ws: WebSocket, payload: dict):
-    """Send JSON to a single client, swallowing errors."""
+# -------------------------------------------------------------
+# Outbound queues — each chat / signaling socket owns a bounded queue drained
+# by its own writer task, so a slow client never stalls a broadcast loop.
+# -------------------------------------------------------------
+OUTBOX_MAX_FRAMES       = int(os.getenv("OUTBOX_MAX_FRAMES", "256"))
+OUTBOX_OVERFLOW_SECONDS = float(os.getenv("OUTBOX_OVERFLOW_SECONDS", "10"))
+# Signaling frames cannot be dropped; a socket with this many unsent ones is disconnected
+OUTBOX_URGENT_MAX       = int(os.getenv("OUTBOX_URGENT_MAX", "1024"))
+# Ephemeral events are held this long per socket and shipped as one "batch" frame (0 = off)
+COALESCE_WINDOW_MS      = int(os.getenv("COALESCE_WINDOW_MS", "150"))
+
+# Frames that may be discarded (oldest first) when a client falls behind
+_DROPPABLE_TYPES = {"typing", "presence", "user_status", "volt_thinking"}
+# Call-setup frames jump ahead of queued bulk traffic (whiteboard strokes, reactions, chat)
+_PRIORITY_TYPES = {"offer", "answer", "ice", "room_state", "peer_joined", "peer_left"}
+
+_outbox_stats = {"sent": 0, "dropped": 0, "overflow_disconnects": 0, "coalesced": 0, "batches": 0}
+
+
+def _coalesce_key(payload: dict) -> Optional[str]:
+    """Dedup key for ephemeral events; a newer event with the same key replaces a pending one."""
+    ftype = payload.get("type")
+    if ftype == "typing":
+        where = payload.get("channel_id") or f"dm{payload.get('to_user_id')}"
+        return f"typing:{payload.get('user_id')}:{where}"
+    if ftype == "presence":
+        return f"presence:{payload.get('user_id')}"
+    if ftype == "user_status":
+        # status, presence and avatar updates carry different fields — keep one of each
+        fields = ",".join(sorted(k for k in payload if k not in ("type", "user_id", "name")))
+        return f"user_status:{payload.get('user_id')}:{fields}"
+    if ftype == "reaction_update":
+        return f"reaction_update:{payload.get('message_id')}"
+    if ftype == "volt_thinking":
+        return f"volt_thinking:{payload.get('channel_id')}"
+    return None
+
+
+def _make_json_encoder():
+    """Pick the WebSocket frame encoder: orjson when installed (FRAME_ENCODER=auto|orjson), else json."""
+    def encode_json(payload: dict) -> str:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+    if FRAME_ENCODER == "json" or orjson is None:
+        if FRAME_ENCODER == "orjson":
+            log.warning("FRAME_ENCODER=orjson but orjson is not installed — using json")
+        return encode_json
+
+    def encode_orjson(payload: dict) -> str:
+        try:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            return encode_json(payload)
+    return encode_orjson
+
+
+_encode_json = _make_json_encoder()
+
+
+class Frame:
+    """A payload encoded once and shared by every recipient queue of a broadcast."""
+    __slots__ = ("type", "text", "key")
+
+    def __init__(self, payload: dict):
+        self.type = payload.get("type")
+        self.text = _encode_json(payload)
+        self.key  = _coalesce_key(payload)
+
+    @classmethod
+    def wrap(cls, ftype: Optional[str], text: str, key: Optional[str] = None) -> "Frame":
+        """Rebuild a Frame from already-encoded text (e.g. received over the backplane)."""
+        frame = cls.__new__(cls)
+        frame.type = ftype
+        frame.text = text
+        frame.key  = key
+        return frame
+
+
+def _as_frame(payload) -> Frame:
+    return payload if isinstance(payload, Frame) else Frame(payload)
+
+
+class Outbox:
+    """Bounded send queue for one WebSocket.
+
+    When full, the oldest droppable frame (typing / presence) is evicted; if the
+    queue holds only durable frames it may grow to twice the bound, and a client
+    that stays over the bound for OUTBOX_OVERFLOW_SECONDS is disconnected.
+
+    Frames with a coalescing key are held for COALESCE_WINDOW_MS, deduplicated
+    by key, and queued together as one {"type": "batch", "events": [...]} frame.
+    Signaling frames (_PRIORITY_TYPES) go through a separate lane that the
+    writer always empties first, so call setup never waits behind bulk traffic;
+    that lane holds at most OUTBOX_URGENT_MAX frames before the client is disconnected.
+    """
+
+    def __init__(self, ws: WebSocket, label: str):
+        self.ws             = ws
+        self.label          = label
+        self.frames         = deque()   # (text, droppable)
+        self.urgent         = deque()   # priority lane: text
+        self.wake           = _asyncio.Event()
+        self.overflow_since = None
+        self.high_water     = 0
+        self.dropped        = 0
+        self.sending        = False
+        self.closed         = False
+        self.batch: Dict[str, tuple] = {}   # { key: (text, droppable) } awaiting the flush
+        self.batch_timer    = None
+        self.task           = _asyncio.create_task(self._run())
+
+    def put(self, frame: Frame):
+        if self.closed:
+            return
+        if frame.type in _PRIORITY_TYPES:
+            if len(self.urgent) >= OUTBOX_URGENT_MAX:
+                self._overflow_disconnect("signaling lane full", len(self.urgent))
+                return
+            self.urgent.append(frame.text)
+            self.wake.set()
+            return
+        droppable = frame.type in _DROPPABLE_TYPES
+        if frame.key and COALESCE_WINDOW_MS > 0:
+            if frame.key in self.batch:
+                _outbox_stats["coalesced"] += 1
+            self.batch[frame.key] = (frame.text, droppable)
+            if self.batch_timer is None:
+                self.batch_timer = _asyncio.get_running_loop().call_later(
+                    COALESCE_WINDOW_MS / 1000, self._flush_batch)
+            return
+        self._enqueue(frame.text, droppable)
+
+    def prime(self, texts: list):
+        """Queue a connection preamble (e.g. a resume replay) regardless of the bound."""
+        self.frames.extend((text, False) for text in texts)
+        self.high_water = max(self.high_water, len(self.frames))
+        self.wake.set()
+
+    def _flush_batch(self):
+        self.batch_timer = None
+        events, self.batch = list(self.batch.values()), {}
+        if self.closed or not events:
+            return
+        droppable = all(d for _, d in events)
+        if len(events) == 1:
+            self._enqueue(events[0][0], droppable)
+            return
+        _outbox_stats["batches"] += 1
+        self._enqueue('{"type":"batch","events":[' + ",".join(t for t, _ in events) + "]}", droppable)
+
+    def _enqueue(self, text: str, droppable: bool):
+        if len(self.frames) >= OUTBOX_MAX_FRAMES and not self._drop_oldest():
+            if droppable:
+                self._count_drop()
+                return
+            now = time.monotonic()
+            if self.overflow_since is None:
+                self.overflow_since = now
+            elif (now - self.overflow_since > OUTBOX_OVERFLOW_SECONDS
+                  or len(self.frames) >= 2 * OUTBOX_MAX_FRAMES):
+                self._overflow_disconnect(f"overflowed for {OUTBOX_OVERFLOW_SECONDS:.0f}s", len(self.frames))
+                return
+        self.frames.append((text, droppable))
+        self.high_water = max(self.high_water, len(self.frames))
+        self.wake.set()
+
+    def _drop_oldest(self) -> bool:
+        for i, (_, droppable) in enumerate(self.frames):
+            if droppable:
+                del self.frames[i]
+                self._count_drop()
+                return True
+        return False
+
+    def _count_drop(self):
+        self.dropped += 1
+        _outbox_stats["dropped"] += 1
+
+    def _overflow_disconnect(self, reason: str, queued: int):
+        log.warning("[outbox] %s %s with %d frames queued — disconnecting", self.label, reason, queued)
+        _outbox_stats["overflow_disconnects"] += 1
+        self.close()
+        _asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.ws.close(code=1013)
+        except Exception:
+            pass
+
+    async def _run(self):
+        while not self.closed:
+            await self.wake.wait()
+            self.wake.clear()
+            while (self.urgent or self.frames) and not self.closed:
+                if self.urgent:
+                    text = self.urgent.popleft()
+                else:
+                    text, _ = self.frames.popleft()
+                    if len(self.frames) < OUTBOX_MAX_FRAMES:
+                        self.overflow_since = None
+                try:
+                    if self.ws.client_state != WebSocketState.CONNECTED:
+                        self.close()
+                        return
+                    self.sending = True
+                    await self.ws.send_text(text)
+                    self.sending = False
+                    _outbox_stats["sent"] += 1
+                except Exception as exc:
+                    log.warning("[outbox] %s send failed: %s", self.label, exc)
+                    self.close()
+                    return
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.urgent.clear()
+        self.batch.clear()
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        self.wake.set()
+
+
+# Outbox per registered socket: { WebSocket: Outbox }
+_outboxes: Dict[WebSocket, Outbox] = {}
+
+
+def _open_outbox(ws: WebSocket, label: str) -> Outbox:
+    ob = Outbox(ws, label)
+    _outboxes[ws] = ob
+    return ob
+
+
+def _close_outbox(ws: WebSocket):
+    ob = _outboxes.pop(ws, None)
+    if ob:
+        ob.close()
+
+
+async def _drain_outbox(ws: WebSocket, timeout: float = 2.0):
+    """Wait (bounded) until a socket's queued frames have been written, e.g. before closing it."""
+    ob = _outboxes.get(ws)
+    deadline = time.monotonic() + timeout
+    while ob and (ob.frames or ob.urgent or ob.batch or ob.sending) and not ob.closed and time.monotonic() < deadline:
+        await _asyncio.sleep(0.01)
+
+
+def _outbox_metrics() -> dict:
+    depths = [len(ob.frames) + len(ob.urgent) for ob in _outboxes.values()]
+    return {
+        **_outbox_stats,
+        "queues":          len(depths),
+        "queued_frames":   sum(depths),
+        "max_depth":       max(depths, default=0),
+        "max_high_water":  max((ob.high_water for ob in _outboxes.values()), default=0),
+    }
+
+
+# -------------------------------------------------------------
+# Backplane — carries realtime events between uvicorn worker processes.
+# "local" delivers in this process only; "unix" elects one worker as a broker
+# that relays newline-delimited JSON events over a Unix socket to every worker.
+# -------------------------------------------------------------
+WORKER_ID        = f"{socket.gethostname()}:{os.getpid()}"
+BACKPLANE_SOCKET = os.getenv("BACKPLANE_SOCKET", "/tmp/synctact-backplane.sock")
+BACKPLANE_BUFFER = int(os.getenv("BACKPLANE_BUFFER", "10000"))
+BACKPLANE_HEARTBEAT  = float(os.getenv("BACKPLANE_HEARTBEAT", "2"))     # seconds between heartbeats
+BACKPLANE_WORKER_TTL = float(os.getenv("BACKPLANE_WORKER_TTL", "10"))   # silent workers are dropped after this
+
+
+class Backplane:
+    """In-process backplane: publish() dispatches straight to the local handlers."""
+    kind = "local"
+
+    def __init__(self):
+        self.handlers: Dict[str, object] = {}
+        self.stats = {"published": 0, "targeted": 0, "received": 0, "buffered": 0, "dropped": 0}
+
+    def on(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, kind: str, data: dict, to=None):
+        """Deliver an event in this worker and (for multi-process backplanes) in every other
+        one, or only in the workers listed in `to`."""
+        self.stats["published"] += 1
+        if to is None or WORKER_ID in to:
+            await self._dispatch(kind, data)
+
+    async def _dispatch(self, kind: str, data: dict):
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return
+        try:
+            await handler(data)
+        except Exception as exc:
+            log.warning("[backplane] %s handler error: %s", kind, exc)
+
+    def metrics(self) -> dict:
+        return {"kind": self.kind, "worker": WORKER_ID, **self.stats}
+
+
+class UnixSocketBackplane(Backplane):
+    """Multi-process backplane over a Unix socket.
+
+    Workers race for an flock on `<socket>.lock`; the holder serves the socket
+    and relays every line to all other connected workers, or, for a line
+    prefixed with "@<worker>,<worker> ", to just those workers. Each worker (the
+    broker included) is a plain client of that socket. Events published while
+    the broker is unreachable are buffered (up to BACKPLANE_BUFFER) and sent on
+    reconnect; if the broker dies another worker takes the lock over, and every
+    client drops the old broker's worker id itself (nobody is left to announce it).
+    """
+    kind = "unix"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path     = path
+        self.lock_fd  = None
+        self.server   = None
+        self.clients: Dict[object, str] = {}   # broker side: { StreamWriter: worker_id }
+        self.writer   = None
+        self.pending  = deque()
+        self.broker   = None                   # worker id of the broker we are connected to
+        self.task     = None
+        self.stopped  = False
+
+    async def start(self):
+        self.task = _asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.stopped = True
+        if self.writer:
+            # flush what was published on the way out (e.g. room handoffs)
+            try:
+                await _asyncio.wait_for(self.writer.drain(), 1)
+            except (OSError, ConnectionError, _asyncio.TimeoutError):
+                pass
+            self.writer.close()
+        if self.task:
+            self.task.cancel()
+        if self.server:
+            # as the broker, relay our own last lines before cutting the others off
+            deadline = time.monotonic() + 1
+            while WORKER_ID in self.clients.values() and time.monotonic() < deadline:
+                await _asyncio.sleep(0.02)
+            self.server.close()
+            for w in list(self.clients):
+                w.close()
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    async def publish(self, kind: str, data: dict, to=None):
+        self.stats["published"] += 1
+        if to is None or WORKER_ID in to:
+            await self._dispatch(kind, data)
+        line = self._encode(kind, data)
+        if to is not None:
+            others = [w for w in to if w != WORKER_ID]
+            if not others:
+                return
+            self.stats["targeted"] += 1
+            line = b"@" + ",".join(others).encode() + b" " + line
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(line)
+            return
+        if len(self.pending) >= BACKPLANE_BUFFER:
+            self.pending.popleft()
+            self.stats["dropped"] += 1
+        self.pending.append(line)
+        self.stats["buffered"] += 1
+
+    @staticmethod
+    def _encode(kind: str, data: dict) -> bytes:
+        frame = data.get("frame")
+        if isinstance(frame, Frame):
+            data = {**data, "frame": [frame.type, frame.text, frame.key]}
+        return _encode_json({"kind": kind, "origin": WORKER_ID, "data": data}).encode() + b"\n"
+
+    @staticmethod
+    def _decode(line: bytes):
+        env = json.loads(line)
+        data = env.get("data") or {}
+        if isinstance(data.get("frame"), list):
+            data["frame"] = Frame.wrap(*data["frame"])
+        return env.get("kind"), env.get("origin"), data
+
+    def _try_become_broker(self) -> bool:
+        import fcntl
+        if self.lock_fd is None:
+            self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        if os.path.exists(self.path):
+            os.unlink(self.path)   # stale socket left by a dead broker
+        return True
+
+    async def _run(self):
+        while not self.stopped:
+            try:
+                if self.server is None and self._try_become_broker():
+                    self.server = await _asyncio.start_unix_server(self._serve_client, path=self.path)
+                    log.info("[backplane] worker %s is the broker on %s", WORKER_ID, self.path)
+                reader, writer = await _asyncio.open_unix_connection(self.path)
+            except (OSError, ConnectionError):
+                await _asyncio.sleep(0.5)
+                continue
+            writer.write(_encode_json({"kind": "hello", "origin": WORKER_ID, "data": {}}).encode() + b"\n")
+            while self.pending:
+                writer.write(self.pending.popleft())
+            self.writer = writer
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    kind, origin, data = self._decode(line)
+                    if kind == "broker":
+                        self.broker = data["worker"]
+                        continue
+                    if origin == WORKER_ID:
+                        continue
+                    self.stats["received"] += 1
+                    await self._dispatch(kind, data)
+            except (OSError, ConnectionError, ValueError) as exc:
+                log.warning("[backplane] connection error: %s", exc)
+            finally:
+                self.writer = None
+                writer.close()
+            if not self.stopped:
+                log.warning("[backplane] lost broker connection — reconnecting")
+                gone, self.broker = self.broker, None
+                if gone and gone != WORKER_ID:
+                    # the broker may have died; if it is alive its heartbeats bring it back
+                    await self._dispatch("worker_gone", {"worker": gone})
+                await _asyncio.sleep(0.2)
+
+    async def _serve_client(self, reader, writer):
+        """Broker side: relay every line from one worker to all the others."""
+        worker = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if worker is None:
+                    worker = json.loads(line).get("origin")
+                    self.clients[writer] = worker
+                    writer.write(_encode_json({"kind": "broker", "origin": "broker",
+                                               "data": {"worker": WORKER_ID}}).encode() + b"\n")
+                    line = _encode_json({"kind": "worker_up", "origin": "broker",
+                                         "data": {"worker": worker}}).encode() + b"\n"
+                self._relay(line, writer)
+        except (OSError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+            if worker:
+                self._relay(_encode_json({"kind": "worker_gone", "origin": "broker",
+                                          "data": {"worker": worker}}).encode() + b"\n", writer)
+
+    def _relay(self, line: bytes, source):
+        targets = None
+        if line[:1] == b"@":
+            header, _, line = line.partition(b" ")
+            targets = set(header[1:].decode().split(","))
+        for w in list(self.clients):
+            if w is source or w.is_closing() or (targets is not None and self.clients.get(w) not in targets):
+                continue
+            if w.transport.get_write_buffer_size() > 64 * 1024 * 1024:
+                log.warning("[backplane] worker %s is not reading — dropping it", self.clients.get(w))
+                w.close()
+                continue
+            w.write(line)
+
+    def metrics(self) -> dict:
+        return {**super().metrics(), "broker": self.server is not None,
+                "connected": self.writer is not None, "pending": len(self.pending),
+                "workers": len(self.clients) if self.server else None}
+
+
+def _make_backplane() -> Backplane:
+    mode = os.getenv("BACKPLANE", "local")
+    if mode == "unix":
+        return UnixSocketBackplane(BACKPLANE_SOCKET)
+    if mode != "local":
+        log.warning("Unknown BACKPLANE=%s — using the in-process backplane", mode)
+    return Backplane()
+
+
+backplane = _make_backplane()
+
+
+def _publish_from_thread(kind: str, data: dict):
+    """publish() from a sync (threadpool) endpoint."""
+    from anyio import from_thread
+    from_thread.run(backplane.publish, kind, data)
+
+
+async def safe_send(ws: WebSocket, payload):
+    """Queue a payload dict or pre-encoded Frame for a single client
+    (or send directly if it has no outbox), swallowing errors."""
+    frame = _as_frame(payload)
+    ob = _outboxes.get(ws)
+    if ob:
+        ob.put(frame)
+        return
     try:
         if ws.client_state == WebSocketState.CONNECTED:
-            await ws.send_text(json.dumps(payload))
+            await ws.send_text(frame.text)
     except Exception as exc:
         log.warning("safe_send failed: %s", exc)
 
 
 async def broadcast_to_room(room_code: str, payload: dict, exclude: str | None = None):
-    """Broadcast JSON to all peers in a room except `exclude`."""
-    if room_code not in rooms:
-        return
-    for pid, info in list(rooms[room_code].items()):
-        if pid == exclude:
-            continue
-        await safe_send(info["ws"], payload)
+    """Broadcast JSON to all peers in a room except `exclude` (on the workers holding them)."""
+    await backplane.publish("room", {"room": room_code, "frame": _as_frame(payload), "exclude": exclude},
+                            to=_room_targets(room_code))
+
+
+async def send_to_room_peer(room_code: str, to_id: str, payload: dict):
+    """Send JSON to one peer of a room, on the worker holding its socket."""
+    worker = _room_members_of(room_code).get(to_id)
+    await backplane.publish("room_peer", {"room": room_code, "to_id": to_id, "frame": _as_frame(payload)},
+                            to=None if worker is None else (worker,))
+
+
+async def _deliver_room(data: dict):
+    frame, exclude = data["frame"], data.get("exclude")
+    for pid, peer_ws in list(_room_sockets.get(data["room"], {}).items()):
+        if pid != exclude:
+            await safe_send(peer_ws, frame)
+
+
+async def _deliver_room_peer(data: dict):
+    peer_ws = _room_sockets.get(data["room"], {}).get(data["to_id"])
+    if peer_ws:
+        await safe_send(peer_ws, data["frame"])
+
+
+backplane.on("room", _deliver_room)
+backplane.on("room_peer", _deliver_room_peer)
 
 
 # -------------------------------------------------------------
 @app.get("/health")
 async def health():
-    return {"status": "ok", "rooms": len(rooms)}
+    return {"status": "ok", "rooms": len(rooms), **_online_counts()}
 
 
 @app.get("/debug/volt")
@@ -1473,44 +2403,441 @@ async def debug_volt():
 
 @app.get("/rooms")
 async def room_stats():
-    return {
-        code: {"participants": len(peers)}
-        for code, peers in rooms.items()
-    }
+    """Every worker's owned rooms (workers that do not answer in ROOM_CALL_TIMEOUT are left out)."""
+    stats = _owned_room_stats()
+    others = _workers - {WORKER_ID}
+    if not others:
+        return stats
+    rid = secrets.token_hex(8)
+    call = _room_stats_calls[rid] = {"stats": stats, "waiting": set(others),
+                                     "done": _asyncio.get_running_loop().create_future()}
+    await backplane.publish("room_stats_req", {"rid": rid, "reply_to": WORKER_ID}, to=others)
+    try:
+        await _asyncio.wait_for(call["done"], ROOM_CALL_TIMEOUT)
+    except _asyncio.TimeoutError:
+        _room_stats["call_timeouts"] += 1
+    finally:
+        _room_stats_calls.pop(rid, None)
+    return stats
+
+
+_room_stats_calls: Dict[str, dict] = {}   # pending /rooms fan-outs by id
+
+
+def _owned_room_stats() -> dict:
+    stats = {}
+    for code, peers in rooms.items():
+        ring = _meeting_chat.get(code)
+        stats[code] = {"participants": len(peers),
+                       "chat_messages": len(ring.items) if ring else 0,
+                       "chat_bytes": ring.size if ring else 0,
+                       "room_cap_bytes": MEETING_CHAT_ROOM_BYTES,
+                       "total_cap_bytes": MEETING_CHAT_TOTAL_BYTES}
+    return stats
+
+
+async def _on_room_stats_req(data: dict):
+    await backplane.publish("room_stats", {"rid": data["rid"], "worker": WORKER_ID,
+                                           "stats": _owned_room_stats()}, to=(data["reply_to"],))
+
+
+async def _on_room_stats(data: dict):
+    call = _room_stats_calls.get(data["rid"])
+    if call is None:
+        return
+    call["stats"].update(data["stats"])
+    call["waiting"].discard(data["worker"])
+    if not call["waiting"] and not call["done"].done():
+        call["done"].set_result(None)
+
+
+backplane.on("room_stats_req", _on_room_stats_req)
+backplane.on("room_stats", _on_room_stats)
+backplane.on("read_pin", _on_read_pin)
+
+
+@app.get("/metrics")
+async def realtime_metrics(_: None = Depends(require_admin)):
+    return {"outbound": _outbox_metrics(), "backplane": backplane.metrics(),
+            "volt": {**_volt_stats, "queue_depth": _volt_queue.qsize() if _volt_queue else 0},
+            "resume": {"streams": len(_streams),
+                       "detached": sum(1 for st in _streams.values() if st.expires is not None),
+                       "buffered_frames": sum(len(st.buffer) for st in _streams.values())},
+            "writes": _writer_metrics(),
+            "rooms": {**_room_stats, "owned": len(rooms), "local_rooms": len(_room_sockets),
+                      "workers": sorted(_workers)},
+            "meeting_chat": {**_meeting_chat_stats, "rooms": len(_meeting_chat),
+                             "room_cap_bytes": MEETING_CHAT_ROOM_BYTES,
+                             "total_cap_bytes": MEETING_CHAT_TOTAL_BYTES},
+            "xp": {**_xp_stats, "users": len(_xp_board.xp), "dirty": len(_xp_dirty)},
+            "db_pools": _pool_metrics()}
 
 
 # -------------------------------------------------------------
+# ── Room sharding ────────────────────────────────────────────
+# Each room has one owning worker — a rendezvous hash of room_code over the live
+# workers — that holds its membership, the participant limit and the whiteboard
+# log. Sockets stay on the worker that accepted them; it asks the owner to
+# join/leave via "room_ctl" backplane events, and frames reach peers through
+# "room" / "room_peer" events addressed to the workers holding the room's sockets.
+# When the worker set changes (start, drain, crash) rooms move to their new owner.
+ROOM_CALL_TIMEOUT = float(os.getenv("ROOM_CALL_TIMEOUT", "5"))
+
+_workers: set = {WORKER_ID}
+_room_calls: Dict[str, "_asyncio.Future"] = {}   # pending owner requests by id
+# { room_code: { peer_id: worker } } for rooms this worker holds sockets in, pushed by
+# the owner whenever it changes; room frames are addressed to just these workers.
+_room_members: Dict[str, Dict[str, str]] = {}
+_room_stats = {"forwarded": 0, "handoffs_out": 0, "handoffs_in": 0, "call_timeouts": 0}
+
+
+def _room_owner(room_code: str) -> str:
+    return max(_workers, key=lambda w: hashlib.blake2b(f"{room_code}|{w}".encode(), digest_size=8).digest())
+
+
+async def _room_request(room_code: str, op: str, data: dict, wait: bool = False) -> Optional[dict]:
+    """Run a room operation on the room's owner; with `wait`, return its result (None on timeout)."""
+    owner = _room_owner(room_code)
+    if owner == WORKER_ID:
+        return await _room_op(op, {**data, "room": room_code})
+    msg = {**data, "to": owner, "op": op, "room": room_code}
+    if not wait:
+        await backplane.publish("room_ctl", msg, to=(owner,))
+        return None
+    rid = secrets.token_hex(8)
+    fut = _room_calls[rid] = _asyncio.get_running_loop().create_future()
+    await backplane.publish("room_ctl", {**msg, "rid": rid, "reply_to": WORKER_ID}, to=(owner,))
+    try:
+        return await _asyncio.wait_for(fut, ROOM_CALL_TIMEOUT)
+    except _asyncio.TimeoutError:
+        _room_stats["call_timeouts"] += 1
+        return None
+    finally:
+        _room_calls.pop(rid, None)
+
+
+def _room_members_of(room_code: str) -> Dict[str, str]:
+    if room_code in rooms:
+        return {pid: info["worker"] for pid, info in rooms[room_code].items()}
+    return _room_members.get(room_code, {})
+
+
+def _room_targets(room_code: str) -> Optional[set]:
+    """Workers holding the room's sockets; None (every worker) while this one does not know."""
+    if room_code not in rooms and room_code not in _room_members:
+        return None
+    return set(_room_members_of(room_code).values())
+
+
+async def _room_op(op: str, data: dict) -> Optional[dict]:
+    """Owner side of the room registry; tells the room's workers when its members change."""
+    room_code = data["room"]
+    before = _room_members_of(room_code) if room_code in rooms else {}
+    result = await _apply_room_op(op, data)
+    after = _room_members_of(room_code) if room_code in rooms else {}
+    if after != before:
+        await backplane.publish("room_members", {"room": room_code, "members": after},
+                                to=set(before.values()) | set(after.values()))
+    return result
+
+
+async def _on_room_members(data: dict):
+    if data["room"] in _room_sockets and data["members"]:
+        _room_members[data["room"]] = data["members"]
+    else:
+        _room_members.pop(data["room"], None)
+
+
+async def _apply_room_op(op: str, data: dict) -> Optional[dict]:
+    room_code = data["room"]
+    if op == "join":
+        peers = rooms.setdefault(room_code, {})
+        if len(peers) >= MAX_PEERS_PER_ROOM and data["peer"] not in peers:
+            if not peers:
+                del rooms[room_code]
+            return {"full": True}
+        existing = [{"id": pid, "name": info["name"]} for pid, info in peers.items() if pid != data["peer"]]
+        peers[data["peer"]] = {"name": data["name"], "worker": data["worker"]}
+        log.info("[%s] %s joined as '%s'  (total: %d)", room_code, data["peer"], data["name"], len(peers))
+        await broadcast_to_room(room_code, {
+            "type":    "peer_joined",
+            "peer_id": data["peer"],
+            "name":    data["name"],
+        }, exclude=data["peer"])
+        return {"peers": existing, "whiteboard": _whiteboards.get(room_code),
+                "chat": _mchat_history(room_code)}
+    if op == "rejoin":
+        rooms.setdefault(room_code, {})[data["peer"]] = {"name": data["name"], "worker": data["worker"]}
+    elif op == "leave":
+        peers = rooms.get(room_code, {})
+        if peers.get(data["peer"], {}).get("worker") != data["worker"]:
+            return None
+        del peers[data["peer"]]
+        log.info("[%s] %s left  (total: %d)", room_code, data["peer"], len(peers))
+        await broadcast_to_room(room_code, {"type": "peer_left", "peer_id": data["peer"]})
+        if not peers:
+            del rooms[room_code]
+            _whiteboards.pop(room_code, None)
+            _mchat_free(room_code)
+            log.info("[%s] Room deleted (empty)", room_code)
+    elif op == "wb":
+        _wb_record(room_code, data["msg"])
+    elif op == "chat":
+        _mchat_record(room_code, data["msg"])
+        await broadcast_to_room(room_code, data["msg"], exclude=data["msg"]["from_id"])
+    elif op == "handoff":
+        rooms.setdefault(room_code, {}).update(data["peers"])
+        if data.get("whiteboard") and not _whiteboards.get(room_code):
+            _whiteboards[room_code] = data["whiteboard"]
+        if data.get("chat") and room_code not in _meeting_chat:
+            for item in data["chat"]:
+                _mchat_record(room_code, item)
+        _room_stats["handoffs_in"] += 1
+    return None
+
+
+async def _on_room_ctl(data: dict):
+    if data["to"] != WORKER_ID:
+        return
+    room_code = data["room"]
+    if _room_owner(room_code) != WORKER_ID and room_code not in rooms and not data.get("hop"):
+        # sent with an outdated view of the workers — pass it on once
+        _room_stats["forwarded"] += 1
+        await backplane.publish("room_ctl", {**data, "to": _room_owner(room_code), "hop": 1},
+                                to=(_room_owner(room_code),))
+        return
+    result = await _room_op(data["op"], data)
+    if data.get("rid"):
+        await backplane.publish("room_reply", {"to": data["reply_to"], "rid": data["rid"], "result": result},
+                                to=(data["reply_to"],))
+
+
+async def _on_room_reply(data: dict):
+    fut = _room_calls.get(data["rid"]) if data["to"] == WORKER_ID else None
+    if fut and not fut.done():
+        fut.set_result(data["result"])
+
+
+async def _handoff_rooms():
+    """Move rooms this worker no longer owns (the worker set changed) to their new owner."""
+    for room_code in [r for r in rooms if _room_owner(r) != WORKER_ID]:
+        _room_stats["handoffs_out"] += 1
+        owner = _room_owner(room_code)
+        await backplane.publish("room_ctl", {"to": owner, "op": "handoff", "room": room_code,
+                                             "peers": rooms.pop(room_code),
+                                             "whiteboard": _whiteboards.pop(room_code, None),
+                                             "chat": _mchat_history(room_code), "hop": 1}, to=(owner,))
+        _mchat_free(room_code)
+
+
+async def _room_worker_seen(worker: str):
+    if worker not in _workers:
+        _workers.add(worker)
+        await _handoff_rooms()
+
+
+async def _room_worker_gone(worker: str):
+    """Forget a dead worker: drop its peers from our rooms and re-register our
+    sockets with the new owner of rooms it owned (their membership died with it)."""
+    owners = {r: _room_owner(r) for r in _room_sockets}
+    _workers.discard(worker)
+    for room_code, peers in list(rooms.items()):
+        for pid in [p for p, info in peers.items() if info["worker"] == worker]:
+            await _room_op("leave", {"room": room_code, "peer": pid, "worker": worker})
+    for room_code, sockets in _room_sockets.items():
+        if owners[room_code] == worker:
+            for pid in sockets:
+                await _room_request(room_code, "rejoin", {"peer": pid, "worker": WORKER_ID,
+                                                          "name": _room_names.get((room_code, pid), pid)})
+
+
+async def _drain_rooms():
+    """On shutdown, hand every owned room to the workers that remain."""
+    if len(_workers) > 1:
+        _workers.discard(WORKER_ID)
+        await _handoff_rooms()
+
+
+# (room_code, peer_id) → display name of this worker's peers, for re-registration
+_room_names: Dict[tuple, str] = {}
+
+backplane.on("room_ctl", _on_room_ctl)
+backplane.on("room_reply", _on_room_reply)
+backplane.on("room_members", _on_room_members)
+
+
+# ── Whiteboard op-log ────────────────────────────────────────
+# Each room keeps its whiteboard as a compacted snapshot plus a tail of recent ops,
+# both sent to late joiners in room_state. Ops are {"op": "clear"}, the legacy
+# single segment {"op": "draw", x0, y0, x1, y1, color, size, tool}, and batched
+# strokes {"op": "stroke", color, size, tool, "pts": [x, y, dx1, dy1, dx2, dy2, ...]}
+# (first point absolute, then deltas). Ops with an unknown tool, a size outside
+# (0, WB_MAX_SIZE], a color other than #rgb / #rrggbb(aa) or non-numeric points are
+# dropped, so they are neither relayed nor kept.
+WB_TAIL_MAX   = int(os.getenv("WB_TAIL_MAX", "256"))      # tail ops before compaction
+WB_MAX_POINTS = int(os.getenv("WB_MAX_POINTS", "200000")) # per room; oldest ink dropped beyond
+
+# { room_code: {"snapshot": [stroke, ...], "tail": [op, ...]} }
+_whiteboards: Dict[str, dict] = {}
+WB_MAX_SIZE   = 64                                         # brush size; the UI offers 2-30
+_WB_STYLE_KEYS = ("color", "size", "tool")
+_WB_TOOLS      = {"pen", "eraser"}
+_WB_COLOR      = re.compile(r"#(?:[0-9a-fA-F]{3}|[0-9a-fA-F]{6}|[0-9a-fA-F]{8})")
+
+
+def _wb_num(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+
+
+def _wb_clean(msg: dict) -> Optional[dict]:
+    """Keep only the fields of a whiteboard op that are replayed to late joiners;
+    None for ops that are malformed or carry an invalid style."""
+    op = msg.get("op")
+    if op == "clear":
+        return {"op": "clear"}
+    tool, size, color = msg.get("tool") or "pen", msg.get("size"), msg.get("color")
+    if (tool not in _WB_TOOLS or not _wb_num(size) or not 0 < size <= WB_MAX_SIZE
+            or not isinstance(color, str) or not _WB_COLOR.fullmatch(color)):
+        return None
+    style = {"color": color, "size": size, "tool": tool}
+    if op == "draw":
+        coords = {k: msg.get(k) for k in ("x0", "y0", "x1", "y1")}
+        if all(_wb_num(v) for v in coords.values()):
+            return {"op": "draw", **style, **coords}
+    if op == "stroke" and isinstance(msg.get("pts"), list):
+        pts = msg["pts"][:4000]
+        pts = pts[:len(pts) - len(pts) % 2]
+        if len(pts) >= 4 and all(_wb_num(v) for v in pts):
+            return {"op": "stroke", **style, "pts": pts}
+    return None
+
+
+def _wb_record(room_code: str, msg: dict):
+    op = _wb_clean(msg)
+    if op is None:
+        return
+    board = _whiteboards.setdefault(room_code, {"snapshot": [], "tail": []})
+    if op["op"] == "clear":
+        board["snapshot"], board["tail"] = [], []
+        return
+    board["tail"].append(op)
+    if len(board["tail"]) >= WB_TAIL_MAX:
+        _wb_compact(board)
+
+
+def _wb_compact(board: dict):
+    """Fold the tail into the snapshot, joining connected segments of the same style
+    into delta-encoded strokes and dropping the oldest ink beyond WB_MAX_POINTS."""
+    merged, end = [], None   # end: absolute last point of merged[-1]
+    for op in board["snapshot"] + board["tail"]:
+        if op["op"] == "draw":
+            pts = [op["x0"], op["y0"], op["x1"] - op["x0"], op["y1"] - op["y0"]]
+        else:
+            pts = op["pts"]
+        start = (pts[0], pts[1])
+        last = merged[-1] if merged else None
+        if last and end == start and all(last[k] == op.get(k) for k in _WB_STYLE_KEYS):
+            last["pts"].extend(pts[2:])
+        else:
+            last = {"op": "stroke", **{k: op.get(k) for k in _WB_STYLE_KEYS}, "pts": list(pts)}
+            merged.append(last)
+        x, y = start
+        for i in range(2, len(pts) - 1, 2):
+            x, y = x + pts[i], y + pts[i + 1]
+        end = (x, y)
+    total = sum(len(st["pts"]) // 2 for st in merged)
+    while merged and total > WB_MAX_POINTS:
+        total -= len(merged.pop(0)["pts"]) // 2
+    board["snapshot"], board["tail"] = merged, []
+
+
+# ── Meeting chat history ─────────────────────────────────────
+# The owner of a room keeps its recent in-meeting chat as encoded JSON frames in a
+# ring buffer, sent in room_state so a reconnecting peer gets the conversation
+# back. Each room is capped in bytes, and so is the total across rooms: beyond
+# the global cap the oldest messages of the largest room are evicted first.
+MEETING_CHAT_ROOM_BYTES  = int(os.getenv("MEETING_CHAT_ROOM_BYTES", str(64 * 1024)))
+MEETING_CHAT_TOTAL_BYTES = int(os.getenv("MEETING_CHAT_TOTAL_BYTES", str(16 * 1024 * 1024)))
+MEETING_CHAT_MAX_TEXT    = 2000
+
+
+class ChatRing:
+    __slots__ = ("items", "size")
+
+    def __init__(self):
+        self.items: deque = deque()   # encoded chat frames (bytes), oldest first
+        self.size = 0
+
+
+_meeting_chat: Dict[str, ChatRing] = {}
+_meeting_chat_stats = {"bytes": 0, "evicted": 0}
+
+
+def _mchat_pop(room_code: str, ring: ChatRing):
+    n = len(ring.items.popleft())
+    ring.size -= n
+    _meeting_chat_stats["bytes"] -= n
+    _meeting_chat_stats["evicted"] += 1
+    if not ring.items:
+        del _meeting_chat[room_code]
+
+
+def _mchat_record(room_code: str, payload: dict):
+    data = _encode_json(payload).encode()
+    if len(data) > MEETING_CHAT_ROOM_BYTES:
+        return
+    ring = _meeting_chat.get(room_code)
+    if ring is None:
+        ring = _meeting_chat[room_code] = ChatRing()
+    ring.items.append(data)
+    ring.size += len(data)
+    _meeting_chat_stats["bytes"] += len(data)
+    while ring.size > MEETING_CHAT_ROOM_BYTES:
+        _mchat_pop(room_code, ring)
+    while _meeting_chat_stats["bytes"] > MEETING_CHAT_TOTAL_BYTES:
+        largest = max(_meeting_chat, key=lambda r: _meeting_chat[r].size)
+        _mchat_pop(largest, _meeting_chat[largest])
+
+
+def _mchat_history(room_code: str) -> List[dict]:
+    ring = _meeting_chat.get(room_code)
+    return [json.loads(b) for b in ring.items] if ring else []
+
+
+def _mchat_free(room_code: str):
+    ring = _meeting_chat.pop(room_code, None)
+    if ring:
+        _meeting_chat_stats["bytes"] -= ring.size
+
+
 @app.websocket("/ws/{room_code}/{peer_id}/{display_name}")
 async def ws_endpoint(ws: WebSocket, room_code: str, peer_id: str, display_name: str):
     await ws.accept()
     room_code = room_code.upper()
 
-    # -- Enforce participant limit --
-    room_peers = rooms.get(room_code, {})
-    if len(room_peers) >= MAX_PEERS_PER_ROOM:
-        await safe_send(ws, {"type": "room_full"})
-        await ws.close()
+    # -- Join through the room's owner (enforces the participant limit) --
+    _open_outbox(ws, f"room {room_code}/{peer_id}")
+    _room_sockets.setdefault(room_code, {})[peer_id] = ws
+    _room_names[(room_code, peer_id)] = display_name
+    joined = await _room_request(room_code, "join", {"peer": peer_id, "name": display_name,
+                                                     "worker": WORKER_ID}, wait=True)
+    if joined is None or joined.get("full"):
+        _close_outbox(ws)
+        _discard_room_socket(room_code, peer_id)
+        if joined is None:
+            await ws.close(code=1013)   # owner unreachable — client retries
+        else:
+            await safe_send(ws, {"type": "room_full"})
+            await ws.close()
         return
 
-    # -- Register peer --
-    rooms.setdefault(room_code, {})
-    rooms[room_code][peer_id] = {"ws": ws, "name": display_name}
-    log.info("[%s] %s joined as '%s'  (total: %d)", room_code, peer_id, display_name, len(rooms[room_code]))
-
-    # -- Send existing peers to new joiner --
-    existing = [
-        {"id": pid, "name": info["name"]}
-        for pid, info in rooms[room_code].items()
-        if pid != peer_id
-    ]
-    await safe_send(ws, {"type": "room_state", "peers": existing})
-
-    # -- Notify existing peers of new joiner --
-    await broadcast_to_room(room_code, {
-        "type":    "peer_joined",
-        "peer_id": peer_id,
-        "name":    display_name,
-    }, exclude=peer_id)
+    # -- Send existing peers (and the whiteboard so far) to the new joiner --
+    state = {"type": "room_state", "peers": joined["peers"]}
+    if joined.get("whiteboard"):
+        state["whiteboard"] = joined["whiteboard"]
+    if joined.get("chat"):
+        state["chat"] = joined["chat"]
+    await safe_send(ws, state)
 
     # -- Message loop --
     try:
@@ -1522,22 +2849,36 @@ async def ws_endpoint(ws: WebSocket, room_code: str, peer_id: str, display_name:
             # -- WebRTC Signaling relay --
             if msg_type in ("offer", "answer", "ice"):
                 to_id = msg.get("to_id")
-                if to_id and to_id in rooms.get(room_code, {}):
-                    relay = {**msg, "from_id": peer_id}
-                    await safe_send(rooms[room_code][to_id]["ws"], relay)
+                if to_id:
+                    await send_to_room_peer(room_code, to_id, {**msg, "from_id": peer_id})
 
             # -- Chat relay --
+            # -- Chat: kept in the room's history by the owner, which relays it --
             elif msg_type == "chat":
-                await broadcast_to_room(room_code, {
+                await _room_request(room_code, "chat", {"msg": {
                     "type":      "chat",
+                    "id":        secrets.token_hex(6),
+                    "from_id":   peer_id,
+                    "from_name": display_name,
+                    "text":      str(msg.get("text", ""))[:MEETING_CHAT_MAX_TEXT],
+                    "ts":        msg.get("ts") or int(time.time() * 1000),
+                }})
+
+            # -- Whiteboard: recorded for late joiners; the sender already drew it --
+            elif msg_type == "whiteboard":
+                op = _wb_clean(msg)
+                if op is None:
+                    continue
+                await _room_request(room_code, "wb", {"msg": op})
+                await broadcast_to_room(room_code, {
+                    "type":      "whiteboard",
+                    **op,
                     "from_id":   peer_id,
                     "from_name": display_name,
-                    "text":      msg.get("text", ""),
-                    "ts":        msg.get("ts", 0),
                 }, exclude=peer_id)
 
-            # -- Raise hand / Reaction / Whiteboard broadcast --
-            elif msg_type in ("raise_hand", "reaction", "whiteboard"):
+            # -- Raise hand / Reaction broadcast --
+            elif msg_type in ("raise_hand", "reaction"):
                 await broadcast_to_room(room_code, {
                     **msg,
                     "from_id":   peer_id,
@@ -1552,96 +2893,1254 @@ async def ws_endpoint(ws: WebSocket, room_code: str, peer_id: str, display_name:
             log.warning("[%s] %s error: %s", room_code, peer_id, exc)
 
     finally:
-        # -- Clean up --
-        if room_code in rooms and peer_id in rooms[room_code]:
-            del rooms[room_code][peer_id]
-            log.info("[%s] %s left  (total: %d)", room_code, peer_id, len(rooms.get(room_code, {})))
+        # -- Clean up (the owner notifies the others and deletes empty rooms) --
+        _close_outbox(ws)
+        _discard_room_socket(room_code, peer_id)
+        await _room_request(room_code, "leave", {"peer": peer_id, "worker": WORKER_ID})
 
-        # Notify others
-        await broadcast_to_room(room_code, {
-            "type":    "peer_left",
-            "peer_id": peer_id,
-        })
 
-        # Remove empty rooms
-        if room_code in rooms and not rooms[room_code]:
-            del rooms[room_code]
-            log.info("[%s] Room deleted (empty)", room_code)
+def _discard_room_socket(room_code: str, peer_id: str):
+    _room_names.pop((room_code, peer_id), None)
+    sockets = _room_sockets.get(room_code)
+    if sockets is not None:
+        sockets.pop(peer_id, None)
+        if not sockets:
+            del _room_sockets[room_code]
+            _room_members.pop(room_code, None)
+
+
+# -------------------------------------------------------------
+# Chat helpers
+# -------------------------------------------------------------
+def _poll_dict(p: Poll, votes: List[PollVote]) -> dict:
+    opts    = json.loads(p.options_json)
+    counts  = [0] * len(opts)
+    voters  = [[] for _ in range(len(opts))]
+    for v in votes:
+        if 0 <= v.option_index < len(opts):
+            counts[v.option_index] += 1
+            voters[v.option_index].append(v.user_id)
+    return {
+        "id":            p.id,
+        "creator_id":    p.creator_id,
+        "creator_name":  p.creator_name,
+        "question":      p.question,
+        "options":       opts,
+        "counts":        counts,
+        "voters":        voters,
+        "channel_id":    p.channel_id,
+        "dm_to_user_id": p.dm_to_user_id,
+        "ts":            p.created_at.isoformat(),
+    }
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_reactions_cached(raw: str) -> dict:
+    return json.loads(raw)
+
+
+def _parse_reactions(raw: Optional[str]) -> dict:
+    """Reactions JSON → dict, memoised on the raw string (treat the result as read-only)."""
+    if not raw or raw == "{}":
+        return {}
+    return _parse_reactions_cached(raw)
+
+
+def _msg_dict(m: ChatMessage) -> dict:
+    return {
+        "id":             m.id,
+        "channel_id":     m.channel_id,
+        "dm_to_user_id":  m.dm_to_user_id,
+        "sender_id":      m.sender_id,
+        "sender_name":    m.sender_name,
+        "content":        m.content,
+        "file_url":       m.file_url,
+        "file_name":      m.file_name,
+        "reactions":      _parse_reactions(m.reactions),
+        "reaction_counts": _parse_reactions(m.reaction_counts),
+        "pinned":         bool(m.pinned),
+        "parent_id":      m.parent_id,
+        "bot_name":       m.bot_name,
+        "edited":         bool(m.edited),
+        "edited_at":      m.edited_at.isoformat() if m.edited_at else None,
+        "forwarded_from": m.forwarded_from,
+        "client_msg_id":  m.client_msg_id,
+        "ts":             m.created_at.isoformat(),
+    }
+
+
+# ── Message history queries ──────────────────────────────────
+# Every history-style list is a keyset page over ChatMessage.id: newest-first
+# below `before`, or oldest-first above `after`, each an index range scan. The
+# statement builders are shared with check_query_plans.py, which fails if any of
+# them stops using the ChatMessage indexes.
+PAGE_LIMIT_MAX = 200
+
+
+def _id_page(stmt, before: Optional[int] = None, after: Optional[int] = None, limit: int = 50):
+    if after is not None:
+        return stmt.where(ChatMessage.id > after).order_by(ChatMessage.id).limit(limit)
+    if before is not None:
+        stmt = stmt.where(ChatMessage.id < before)
+    return stmt.order_by(ChatMessage.id.desc()).limit(limit)
+
+
+def _channel_history_stmt(channel_id: int, before: Optional[int] = None, limit: int = 50,
+                          after: Optional[int] = None):
+    return _id_page(select(ChatMessage).where(ChatMessage.channel_id == channel_id), before, after, limit)
+
+
+def _dm_history_stmt(user_a: int, user_b: int, before: Optional[int] = None, limit: int = 50,
+                     after: Optional[int] = None):
+    """DMs between two users: one range of ix_chatmessage_dm_conv, both directions."""
+    lo, hi = _dm_key(user_a, user_b)
+    return _id_page(select(ChatMessage).where(ChatMessage.dm_lo == lo, ChatMessage.dm_hi == hi),
+                    before, after, limit)
+
+
+def _dm_conversations_stmt(user_id: int, limit: int = 50):
+    return (select(DmConversation, User, ChatMessage)
+            .join(User, User.id == DmConversation.partner_id)
+            .outerjoin(ChatMessage, ChatMessage.id == DmConversation.last_message_id)
+            .where(DmConversation.user_id == user_id)
+            .order_by(DmConversation.last_message_at.desc())
+            .limit(limit))
+
+
+def _thread_stmt(parent_id: int, before: Optional[int] = None, limit: int = 50, after: Optional[int] = None):
+    return _id_page(select(ChatMessage).where(ChatMessage.parent_id == parent_id), before, after, limit)
+
+
+def _pinned_stmt(channel_id: int):
+    return (select(ChatMessage)
+            .where(ChatMessage.channel_id == channel_id, ChatMessage.pinned == True)  # noqa: E712
+            .order_by(ChatMessage.id))
+
+
+def _files_stmt(channel_id: int, before: Optional[int] = None, limit: int = 50, after: Optional[int] = None,
+                extensions: tuple = ()):
+    from sqlalchemy import or_
+    stmt = select(ChatMessage).where(ChatMessage.channel_id == channel_id,
+                                     ChatMessage.file_url != None)  # noqa: E711
+    if extensions:
+        stmt = stmt.where(or_(*(ChatMessage.file_name.ilike(f"%{ext}") for ext in extensions)))
+    return _id_page(stmt, before, after, limit)
+
+
+def _encode_cursor(msg_id: int) -> str:
+    return base64.urlsafe_b64encode(f"m{msg_id}".encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    """Opaque cursor → message id (a bare message id is accepted too)."""
+    if cursor is None or cursor == "":
+        return None
+    if cursor.isdigit():
+        return int(cursor)
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        if raw[:1] == "m" and raw[1:].isdigit():
+            return int(raw[1:])
+    except (ValueError, UnicodeDecodeError):
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _keyset_page(session: Session, build, before: Optional[str] = None, after: Optional[str] = None,
+                 around: Optional[int] = None, limit: int = 50, render=None) -> dict:
+    """One page from `build(before=, after=, limit=)`, oldest first:
+    {"items", "has_more_before", "has_more_after", "before", "after"} — the cursors
+    fetch the neighbouring pages. `around` centres the page on a message id. The flag
+    for the side the page was not fetched towards comes from a one-row probe."""
+    limit = max(1, min(limit, PAGE_LIMIT_MAX))
+    before_id, after_id = _decode_cursor(before), _decode_cursor(after)
+    exists = lambda **kw: session.exec(build(limit=1, **kw)).first() is not None
+    if around is not None:
+        half = limit // 2
+        older = session.exec(build(before=around, limit=half + 1)).all()
+        newer = session.exec(build(after=around - 1, limit=limit - half + 1)).all()
+        more_before, more_after = len(older) > half, len(newer) > limit - half
+        rows = list(reversed(older[:half])) + list(newer[:limit - half])
+        first, last = around, around - 1
+    elif after_id is not None:
+        rows = list(session.exec(build(after=after_id, limit=limit + 1)).all())
+        more_after, rows = len(rows) > limit, rows[:limit]
+        first, last = after_id + 1, after_id
+        more_before = exists(before=rows[0].id if rows else first)
+    else:
+        rows = session.exec(build(before=before_id, limit=limit + 1)).all()
+        more_before, rows = len(rows) > limit, list(reversed(rows[:limit]))
+        first = last = None
+        if before_id is not None:
+            first, last = before_id, before_id - 1
+            more_after = exists(after=rows[-1].id if rows else last)
+        else:
+            more_after = False
+    # an empty page still gets cursors back to where it was requested from
+    return {
+        "items":           [(render or _msg_dict)(m) for m in rows],
+        "has_more_before": more_before,
+        "has_more_after":  more_after,
+        "before":          _encode_cursor(rows[0].id if rows else first) if more_before else None,
+        "after":           _encode_cursor(rows[-1].id if rows else last) if more_after else None,
+    }
+
+
+def _with_my_reactions(session: Session, page: dict, user_id: int) -> dict:
+    """Add "my_reactions" (the viewer's emojis) to items whose reactor lists are capped,
+    where the list alone can't tell whether the viewer reacted."""
+    capped = [m["id"] for m in page["items"]
+              if any(n > REACTION_USERS_CAP for n in (m.get("reaction_counts") or {}).values())]
+    if capped:
+        mine = defaultdict(list)
+        for msg_id, emoji in session.exec(
+                select(MessageReaction.message_id, MessageReaction.emoji)
+                .where(MessageReaction.message_id.in_(capped), MessageReaction.user_id == user_id)):
+            mine[msg_id].append(emoji)
+        for m in page["items"]:
+            if m["id"] in capped:
+                m["my_reactions"] = mine[m["id"]]
+    return page
+
+
+def _task_dict(t: RecurringTask) -> dict:
+    return {
+        "id":               t.id,
+        "channel_id":       t.channel_id,
+        "message":          t.message,
+        "interval_minutes": t.interval_minutes,
+        "last_run":         t.last_run.isoformat() if t.last_run else None,
+        "active":           t.active,
+        "open_url":         t.open_url,
+        "shell_cmd":        t.shell_cmd,
+        "url_target":       t.url_target or "self",
+        "created_at":       t.created_at.isoformat(),
+    }
+
+
+def _register_conn(conn: ChatConn) -> bool:
+    """Add a socket to the registry; True when it is the user's first (presence goes online)."""
+    conns = chat_connections.setdefault(conn.user_id, set())
+    conns.add(conn)
+    _unscoped_conns.add(conn)
+    _streams.setdefault(conn.user_id, ChatStream()).expires = None
+    return len(conns) == 1
+
+
+def _unregister_conn(conn: ChatConn) -> bool:
+    """Remove a socket; True when it was the user's last one (presence goes offline)."""
+    _set_focus(conn, None)
+    _unscoped_conns.discard(conn)
+    conns = chat_connections.get(conn.user_id)
+    if conns is None:
+        return False
+    conns.discard(conn)
+    if conns:
+        return False
+    del chat_connections[conn.user_id]
+    stream = _streams.get(conn.user_id)
+    if stream and RESUME_WINDOW_SECONDS > 0:
+        # keep buffering the user's events (subscriptions included) for a resume
+        stream.expires = time.monotonic() + RESUME_WINDOW_SECONDS
+    else:
+        _streams.pop(conn.user_id, None)
+        _drop_subscriptions(conn.user_id)
+    return True
+
+
+def _online_counts() -> dict:
+    return {"chat_users": len(chat_connections),
+            "chat_connections": sum(len(c) for c in chat_connections.values())}
+
+
+def _subscribe(conn: ChatConn, channel_ids: list):
+    """Add channels to the user's subscriptions (a join makes the socket channel-scoped)."""
+    _unscoped_conns.discard(conn)
+    subs = _user_subs.setdefault(conn.user_id, set())
+    for cid in channel_ids:
+        subs.add(cid)
+        _channel_subs[cid].add(conn.user_id)
+
+
+def _unsubscribe(user_id: int, channel_ids: list):
+    subs = _user_subs.get(user_id, set())
+    for cid in channel_ids:
+        subs.discard(cid)
+        _discard_index(_channel_subs, cid, user_id)
+        for conn in list(chat_connections.get(user_id, ())):
+            if conn.focus == cid:
+                _set_focus(conn, None)
+
+
+def _set_focus(conn: ChatConn, channel_id: Optional[int]):
+    if conn.focus is not None:
+        _discard_index(_channel_viewers, conn.focus, conn)
+        conn.focus = None
+    if channel_id is not None and channel_id not in _archived_channels:
+        conn.focus = channel_id
+        _channel_viewers[channel_id].add(conn)
+
+
+def _drop_subscriptions(user_id: int):
+    """Forget every subscription of a user whose last socket disconnected."""
+    for cid in _user_subs.pop(user_id, set()):
+        _discard_index(_channel_subs, cid, user_id)
+
+
+def _drop_channel(channel_id: int):
+    """Forget a deleted channel in the subscription index."""
+    for uid in _channel_subs.pop(channel_id, set()):
+        _user_subs.get(uid, set()).discard(channel_id)
+    for conn in _channel_viewers.pop(channel_id, set()):
+        conn.focus = None
+
+
+def _discard_index(index: Dict[int, set], channel_id: int, member):
+    members = index.get(channel_id)
+    if members is not None:
+        members.discard(member)
+        if not members:
+            del index[channel_id]
+
+
+def _chat_audience(channel_id: Optional[int], viewers_only: bool = False) -> set:
+    """Sockets that should receive an event scoped to `channel_id` (None = everyone)."""
+    if channel_id is None:
+        return {c for conns in chat_connections.values() for c in conns}
+    if viewers_only:
+        targets = set(_channel_viewers.get(channel_id, ()))
+    else:
+        targets = {c for uid in _channel_subs.get(channel_id, ()) for c in chat_connections.get(uid, ())}
+    targets.update(_unscoped_conns)
+    return targets
+
+
+# ── Sequenced delivery / resume ──────────────────────────────
+def _is_durable(frame: Frame) -> bool:
+    """Durable events are sequenced and replayed; ephemeral ones (typing, presence…) are not."""
+    return frame.key is None and frame.type not in _DROPPABLE_TYPES
+
+
+def _stream_append(user_id: int, frame: Frame) -> Frame:
+    """Stamp the next per-user seq onto a shared frame (by splicing its text) and buffer it."""
+    stream = _streams.get(user_id)
+    if stream is None:
+        return frame
+    stream.seq += 1
+    text = f'{{"seq":{stream.seq},{frame.text[1:]}'
+    stream.buffer.append((stream.seq, frame.type, text))
+    return Frame.wrap(frame.type, text)
+
+
+async def _send_sequenced(frame: Frame, conns):
+    """Send to sockets; durable frames get one seq per user, shared by all of that user's sockets."""
+    if not _is_durable(frame):
+        for conn in conns:
+            await safe_send(conn.ws, frame)
+        return
+    by_user: Dict[int, list] = {}
+    for conn in conns:
+        by_user.setdefault(conn.user_id, []).append(conn)
+    for uid, user_conns in by_user.items():
+        stamped = _stream_append(uid, frame)
+        for conn in user_conns:
+            await safe_send(conn.ws, stamped)
+
+
+def _detached_users(channel_id: Optional[int]):
+    """Users inside their resume window (no socket) who are in a channel event's audience."""
+    uids = _streams if channel_id is None else _channel_subs.get(channel_id, ())
+    return [uid for uid in uids if uid not in chat_connections and uid in _streams]
+
+
+def _resume(user_id: int, token: str) -> list:
+    """Encoded frames replaying what a reconnecting socket missed after `token` ("<epoch>:<seq>"),
+    followed by a "resumed" or "resume_failed" frame."""
+    stream = _streams.get(user_id)
+    epoch, _, seq = token.partition(":")
+    if not seq.isdigit() or epoch != _stream_epoch or stream is None or int(seq) > stream.seq:
+        return [_encode_json({"type": "resume_failed", "reason": "unknown session"})]
+    seq = int(seq)
+    missed = [text for s, _, text in stream.buffer if s > seq]
+    if len(missed) != stream.seq - seq:
+        return [_encode_json({"type": "resume_failed", "reason": "replay window exceeded"})]
+    return missed + [_encode_json({"type": "resumed", "replayed": len(missed), "last_seq": stream.seq})]
+
+
+async def _run_stream_sweeper():
+    """Forget streams (and subscriptions) of users whose resume window has passed."""
+    while True:
+        await _asyncio.sleep(15)
+        now = time.monotonic()
+        for uid in [u for u, st in _streams.items() if st.expires is not None and st.expires <= now]:
+            del _streams[uid]
+            if uid not in chat_connections:
+                _drop_subscriptions(uid)
+
+
+@app.on_event("startup")
+async def start_stream_sweeper():
+    _asyncio.create_task(_run_stream_sweeper())
+
+
+# ── Idempotent sends ─────────────────────────────────────────
+# channel_message / dm / thread_reply frames may carry a client_msg_id. A repeat of
+# a recent id is answered from memory; older repeats hit the unique
+# (sender_id, client_msg_id) index. Either way the sender gets an ack, never a duplicate.
+CLIENT_MSG_TTL_SECONDS = float(os.getenv("CLIENT_MSG_TTL_SECONDS", "600"))
+
+# { (sender_id, client_msg_id): (expires_at, message_id, seq) }
+_recent_client_msgs: Dict[tuple, tuple] = {}
+
+
+def _client_msg_id(msg: dict) -> Optional[str]:
+    cid = msg.get("client_msg_id")
+    return cid[:64] if isinstance(cid, str) and cid else None
+
+
+def _recent_client_msg(sender_id: int, client_msg_id: str) -> Optional[tuple]:
+    hit = _recent_client_msgs.get((sender_id, client_msg_id))
+    if hit is None or hit[0] < time.monotonic():
+        return None
+    return hit[1], hit[2]
+
+
+def _remember_client_msg(sender_id: int, client_msg_id: str, message_id: int, seq: Optional[int]):
+    now = time.monotonic()
+    if len(_recent_client_msgs) > 10000:
+        for key in [k for k, v in _recent_client_msgs.items() if v[0] < now]:
+            del _recent_client_msgs[key]
+    _recent_client_msgs[(sender_id, client_msg_id)] = (now + CLIENT_MSG_TTL_SECONDS, message_id, seq)
+
+
+def _insert_chat_message(session: Session, cm: ChatMessage):
+    """Insert a message. Returns (row, duplicate) — the stored row when its client_msg_id repeats.
+    The session must be opened with expire_on_commit=False (the row is not re-read)."""
+    session.add(cm)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        existing = session.exec(select(ChatMessage).where(
+            ChatMessage.sender_id == cm.sender_id, ChatMessage.client_msg_id == cm.client_msg_id)).first()
+        if cm.client_msg_id is None or existing is None:
+            raise
+        return existing, True
+    return cm, False
+
+
+REACTION_USERS_CAP = int(os.getenv("REACTION_USERS_CAP", "50"))   # user ids kept per emoji on the message
+
+
+def _reaction_summary(pairs) -> tuple:
+    """(emoji, user_id) pairs, oldest first → ({emoji: [first REACTION_USERS_CAP ids]}, {emoji: count})."""
+    users: Dict[str, list] = {}
+    counts: Dict[str, int] = {}
+    for emoji, uid in pairs:
+        counts[emoji] = counts.get(emoji, 0) + 1
+        if counts[emoji] <= REACTION_USERS_CAP:
+            users.setdefault(emoji, []).append(uid)
+    return users, counts
+
+
+# Postgres adjusts the summary inside the UPDATE itself, against whichever row version
+# it ends up writing, so toggles on a hot message only queue for that one statement.
+# (The JSON columns are text; jsonb parses either escaping of the emoji key.)
+_PG_COUNTS   = "COALESCE(NULLIF(reaction_counts, ''), '{}')::jsonb"
+_PG_USERS    = "COALESCE(NULLIF(reactions, ''), '{}')::jsonb"
+_PG_LISTED   = f"COALESCE({_PG_USERS} -> CAST(:emoji AS text), '[]'::jsonb)"
+_PG_COUNT_TO = f"COALESCE(({_PG_COUNTS} ->> CAST(:emoji AS text))::int, 0) + CAST(:delta AS integer)"
+_PG_REACTION_COUNTS = (
+    f"CASE WHEN {_PG_COUNT_TO} <= 0 THEN ({_PG_COUNTS} - CAST(:emoji AS text))::text "
+    f"ELSE jsonb_set({_PG_COUNTS}, ARRAY[CAST(:emoji AS text)], to_jsonb({_PG_COUNT_TO}))::text END")
+_PG_REACTIONS_ADD = (
+    f"CASE WHEN jsonb_array_length({_PG_LISTED}) >= CAST(:cap AS integer) THEN {_PG_USERS}::text "
+    f"ELSE jsonb_set({_PG_USERS}, ARRAY[CAST(:emoji AS text)], "
+    f"{_PG_LISTED} || to_jsonb(CAST(:uid AS integer)))::text END")
+_PG_REACTIONS_REMOVE = (
+    f"CASE WHEN {_PG_COUNT_TO} <= 0 THEN ({_PG_USERS} - CAST(:emoji AS text))::text "
+    f"ELSE jsonb_set({_PG_USERS}, ARRAY[CAST(:emoji AS text)], COALESCE((SELECT jsonb_agg(e.x ORDER BY e.i) "
+    f"FROM jsonb_array_elements({_PG_LISTED}) WITH ORDINALITY AS e(x, i) "
+    f"WHERE e.x <> to_jsonb(CAST(:uid AS integer))), '[]'::jsonb))::text END")
+
+
+def _pg_sql(sql: str, **params):
+    return sqlalchemy.text(sql).bindparams(**{k: v for k, v in params.items() if f":{k}" in sql})
+
+
+async def _toggle_reaction(session: AsyncSession, msg_id: int, emoji: str, user_id: int) -> tuple:
+    """Add or remove one reaction and update the message's summary, in one transaction.
+    The toggle itself is a single DELETE or INSERT, so concurrent reactions never lose each
+    other, and nothing locks the message first. The summary is then adjusted by one UPDATE
+    (Postgres: a jsonb expression on the current row; SQLite: rewritten from a read taken
+    under the write lock the DELETE/INSERT already holds). Only when the user list has to
+    be refilled from MessageReaction is the row locked for the extra read.
+    Returns (message, added), or (None, False) if the message does not exist."""
+    removed = (await session.execute(sa_delete(MessageReaction).where(
+        MessageReaction.message_id == msg_id, MessageReaction.emoji == emoji,
+        MessageReaction.user_id == user_id))).rowcount
+    if not removed:
+        await session.execute(sa_insert(MessageReaction).values(
+            message_id=msg_id, emoji=emoji, user_id=user_id, created_at=datetime.now(timezone.utc)))
+    delta = -1 if removed else 1
+    if async_engine.dialect.name == "postgresql":
+        params = {"emoji": emoji, "uid": user_id, "delta": delta, "cap": REACTION_USERS_CAP}
+        cm = (await session.execute(
+            sa_update(ChatMessage).where(ChatMessage.id == msg_id)
+            .values(reaction_counts=_pg_sql(_PG_REACTION_COUNTS, **params),
+                    reactions=_pg_sql(_PG_REACTIONS_REMOVE if removed else _PG_REACTIONS_ADD, **params))
+            .returning(ChatMessage), execution_options={"populate_existing": True})).scalars().first()
+    else:
+        cm = await session.get(ChatMessage, msg_id, populate_existing=True)
+        if cm is not None:
+            users, counts = json.loads(cm.reactions or "{}"), json.loads(cm.reaction_counts or "{}")
+            listed = users.setdefault(emoji, [])
+            counts[emoji] = counts.get(emoji, 0) + delta
+            if counts[emoji] <= 0:
+                users.pop(emoji, None)
+                counts.pop(emoji, None)
+            elif not removed:
+                if len(listed) < REACTION_USERS_CAP:
+                    listed.append(user_id)
+            elif user_id in listed:
+                listed.remove(user_id)
+            cm.reactions, cm.reaction_counts = json.dumps(users), json.dumps(counts)
+            await session.flush()
+    if cm is None:
+        await session.rollback()
+        return None, False
+    users, counts = json.loads(cm.reactions or "{}"), json.loads(cm.reaction_counts or "{}")
+    if len(users.get(emoji, [])) < min(counts.get(emoji, 0), REACTION_USERS_CAP):
+        # a listed reactor left while others are not shown: refill the list under the row lock
+        cm = (await session.exec(select(ChatMessage).where(ChatMessage.id == msg_id).with_for_update()
+                                 .execution_options(populate_existing=True))).first()
+        users = json.loads(cm.reactions or "{}")
+        users[emoji] = list((await session.exec(
+            select(MessageReaction.user_id)
+            .where(MessageReaction.message_id == msg_id, MessageReaction.emoji == emoji)
+            .order_by(MessageReaction.created_at).limit(REACTION_USERS_CAP)
+        )).all())
+        cm.reactions = json.dumps(users)
+    await session.commit()
+    return cm, not removed
+
+
+async def _ack(conn: ChatConn, client_msg_id: Optional[str], message_id: Optional[int],
+               seq: Optional[int] = None, duplicate: bool = False):
+    """Confirm a stored message to the socket that sent it (remembering it for dedupe).
+    message_id is None for frames handled without storing a message (slash commands)."""
+    if client_msg_id is None:
+        return
+    if not duplicate:
+        _remember_client_msg(conn.user_id, client_msg_id, message_id, seq)
+    await safe_send(conn.ws, {"type": "ack", "client_msg_id": client_msg_id, "id": message_id,
+                              "seq": seq, "duplicate": duplicate})
+
+
+async def _nack(conn: ChatConn, client_msg_id: Optional[str], reason: str):
+    """Tell the sender a frame was refused (mute, slowmode, read-only, empty), so it
+    stops re-sending it; the human-readable reason goes out as an "error" frame."""
+    if client_msg_id is None:
+        return
+    await safe_send(conn.ws, {"type": "nack", "client_msg_id": client_msg_id, "reason": reason})
+
+
+def _stream_seq(user_id: int) -> Optional[int]:
+    stream = _streams.get(user_id)
+    return stream.seq if stream else None
+
+
+# ── Moderation cache ─────────────────────────────────────────
+# The channel_message path checks kicks, mutes, the user's role and the channel's
+# slowmode/readonly flags against this cache instead of the DB. Entries are loaded
+# on first use and dropped on every worker (the "mod_cache" event) by the /mod/*
+# endpoints and channel settings changes; MOD_CACHE_TTL bounds staleness from
+# anything that edits the tables directly.
+MOD_CACHE_TTL = float(os.getenv("MOD_CACHE_TTL", "300"))
+
+# { user_id: (expires, {"role", "kicked": {channel_id}, "mutes": {channel_id|None: until|None}}) }
+_mod_users: Dict[int, tuple] = {}
+# { channel_id: (expires, {"slowmode", "readonly"}) }
+_mod_channels: Dict[int, tuple] = {}
+
+
+async def _mod_user(session: AsyncSession, user_id: int) -> dict:
+    hit = _mod_users.get(user_id)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    user = await session.get(User, user_id)
+    mutes = {}
+    for m in (await session.exec(select(MutedUser).where(MutedUser.user_id == user_id))).all():
+        until = m.muted_until.replace(tzinfo=timezone.utc) if m.muted_until else None
+        mutes[m.channel_id] = until
+    entry = {
+        "role":   user.role if user else None,
+        "kicked": set((await session.exec(select(KickedUser.channel_id).where(KickedUser.user_id == user_id))).all()),
+        "mutes":  mutes,
+    }
+    _mod_users[user_id] = (time.monotonic() + MOD_CACHE_TTL, entry)
+    return entry
+
+
+async def _mod_channel(session: AsyncSession, channel_id) -> Optional[dict]:
+    hit = _mod_channels.get(channel_id)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    ch = await session.get(Channel, channel_id) if isinstance(channel_id, int) else None
+    if ch is None:
+        return None
+    entry = {"slowmode": ch.slowmode_seconds, "readonly": ch.readonly}
+    _mod_channels[channel_id] = (time.monotonic() + MOD_CACHE_TTL, entry)
+    return entry
+
+
+def _mod_block(mod: dict, channel_id: int) -> Optional[str]:
+    """Why `mod`'s user may not post in the channel, if they may not."""
+    if channel_id in mod["kicked"]:
+        return "You have been removed from this channel."
+    now = datetime.now(timezone.utc)
+    for scope in (channel_id, None):
+        if scope in mod["mutes"]:
+            until = mod["mutes"][scope]
+            if until is None or until > now:
+                return "You are muted in this channel."
+    return None
+
+
+async def _mod_invalidate(user_id: Optional[int] = None, channel_id: Optional[int] = None):
+    await backplane.publish("mod_cache", {"user_id": user_id, "channel_id": channel_id})
+
+
+async def _on_mod_cache(data: dict):
+    if data.get("user_id") is not None:
+        _mod_users.pop(data["user_id"], None)
+    if data.get("channel_id") is not None:
+        _mod_channels.pop(data["channel_id"], None)
+
+
+# ── Message write-behind ─────────────────────────────────────
+# Socket messages are persisted by a single writer that groups everything queued
+# within WRITE_BATCH_MS into one multi-row insert and one commit (one fsync on
+# SQLite). Senders await their row, so nothing is broadcast or acked before it is
+# durable. A larger WRITE_BATCH_MS trades per-message latency for throughput;
+# 0 still batches whatever piles up while the previous commit runs.
+WRITE_BATCH_MS  = float(os.getenv("WRITE_BATCH_MS", "5"))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "256"))
+
+_write_queue: "_asyncio.Queue" = None   # (ChatMessage, Future), created at startup
+_write_stats = {"messages": 0, "batches": 0, "max_batch": 0, "fallbacks": 0, "failed": 0}
+_write_latency: deque = deque(maxlen=1024)   # recent commit times (ms)
+
+
+async def _persist_message(cm: ChatMessage):
+    """Queue a message for the writer; returns (row, duplicate) like _insert_chat_message."""
+    await _pin_reads(cm.sender_id)
+    if _write_queue is None:
+        result = (await _asyncio.to_thread(_commit_batch, [(cm, None)]))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+    fut = _asyncio.get_running_loop().create_future()
+    await _write_queue.put((cm, fut))
+    return await fut
+
+
+def _commit_batch(batch: list) -> list:
+    """Insert a batch in one transaction. If any row fails (a repeated client_msg_id),
+    fall back to one transaction per message so only that one is affected; a message
+    that still fails gets its exception in place of the (row, duplicate) result."""
+    with Session(engine, expire_on_commit=False) as session:
+        session.add_all([cm for cm, _ in batch])
+        try:
+            session.commit()
+            return [(cm, False) for cm, _ in batch]
+        except IntegrityError:
+            session.rollback()
+    _write_stats["fallbacks"] += 1
+    results = []
+    for cm, _ in batch:
+        with Session(engine, expire_on_commit=False) as session:
+            try:
+                results.append(_insert_chat_message(session, ChatMessage(**cm.model_dump(exclude={"id"}))))
+            except Exception as exc:
+                log.warning("[writer] message from user %s failed: %s", cm.sender_id, exc)
+                _write_stats["failed"] += 1
+                results.append(exc)
+    return results
+
+
+async def _run_writer():
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_MS / 1000
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_write_queue.get_nowait())
+                continue
+            except _asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await _asyncio.wait_for(_write_queue.get(), remaining))
+            except _asyncio.TimeoutError:
+                break
+        started = time.perf_counter()
+        try:
+            results = await _asyncio.to_thread(_commit_batch, batch)
+        except Exception as exc:
+            log.warning("[writer] batch of %d failed: %s", len(batch), exc)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            continue
+        _write_latency.append((time.perf_counter() - started) * 1000)
+        _write_stats["messages"] += len(batch)
+        _write_stats["batches"] += 1
+        _write_stats["max_batch"] = max(_write_stats["max_batch"], len(batch))
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+
+def _writer_metrics() -> dict:
+    lat = sorted(_write_latency)
+    pct = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 2) if lat else None
+    return {**_write_stats,
+            "avg_batch": round(_write_stats["messages"] / _write_stats["batches"], 2) if _write_stats["batches"] else 0,
+            "queue_depth": _write_queue.qsize() if _write_queue else 0,
+            "commit_ms_p50": pct(0.5), "commit_ms_p99": pct(0.99),
+            "batch_ms": WRITE_BATCH_MS, "batch_max": WRITE_BATCH_MAX}
+
+
+@app.on_event("startup")
+async def _start_writer():
+    global _write_queue
+    _write_queue = _asyncio.Queue()
+    _asyncio.create_task(_run_writer())
+
+
+async def _chat_broadcast(payload, exclude_uid: Optional[int] = None,
+                          channel_id: Optional[int] = None, viewers_only: bool = False):
+    """Send to every socket subscribed to `channel_id` (or focused on it when `viewers_only`);
+    with no channel_id the event goes to all connected sockets. Encoded once for all recipients
+    and published on the backplane so sockets held by other workers receive it too."""
+    await backplane.publish("chat", {"frame": _as_frame(payload), "exclude_uid": exclude_uid,
+                                     "channel_id": channel_id, "viewers_only": viewers_only})
+
+
+async def _deliver_chat(data: dict):
+    frame, exclude_uid = data["frame"], data.get("exclude_uid")
+    channel_id, viewers_only = data.get("channel_id"), data.get("viewers_only", False)
+    await _send_sequenced(frame, [c for c in _chat_audience(channel_id, viewers_only)
+                                  if c.user_id != exclude_uid])
+    if not viewers_only and _is_durable(frame):
+        for uid in _detached_users(channel_id):
+            if uid != exclude_uid:
+                _stream_append(uid, frame)
+
+
+async def _chat_broadcast_for(m: ChatMessage, payload, exclude_uid: Optional[int] = None):
+    """Deliver a message-scoped event: channel subscribers, or both participants of a DM."""
+    frame = _as_frame(payload)
+    if m.channel_id:
+        await _chat_broadcast(frame, exclude_uid=exclude_uid, channel_id=m.channel_id)
+    else:
+        for uid in {m.sender_id, m.dm_to_user_id}:
+            if uid and uid != exclude_uid:
+                await _chat_send(uid, frame)
+
+
+async def _chat_send(user_id: int, payload, conn_id: Optional[str] = None):
+    """Send to every socket of a user, or only to the socket `conn_id` when given."""
+    await backplane.publish("chat_send", {"user_id": user_id, "frame": _as_frame(payload), "conn_id": conn_id})
+
+
+async def _deliver_chat_send(data: dict):
+    frame, conn_id, uid = data["frame"], data.get("conn_id"), data["user_id"]
+    if conn_id is not None:   # a reply to one socket is not part of the user's stream
+        for conn in list(chat_connections.get(uid, ())):
+            if conn.conn_id == conn_id:
+                await safe_send(conn.ws, frame)
+        return
+    conns = list(chat_connections.get(uid, ()))
+    if conns:
+        await _send_sequenced(frame, conns)
+    elif uid in _streams and _is_durable(frame):
+        _stream_append(uid, frame)
+
+
+# ── Cross-worker chat state ──────────────────────────────────
+# Sockets are registered in the worker that accepted them; other workers only
+# know how many each one holds per user, which is enough to decide presence.
+_remote_conns: Dict[str, Dict[int, int]] = {}   # { worker_id: { user_id: socket count } }
+_worker_seen: Dict[str, float] = {}              # { worker_id: monotonic time last heard from }
+
+
+def _online_elsewhere(user_id: int) -> bool:
+    return any(user_id in counts for counts in _remote_conns.values())
+
+
+async def _publish_conn_count(user_id: int):
+    await backplane.publish("conns", {"worker": WORKER_ID,
+                                      "counts": {user_id: len(chat_connections.get(user_id, ()))}})
+
+
+async def _on_conns(data: dict):
+    if data["worker"] == WORKER_ID:
+        return
+    await _worker_heard(data["worker"])
+    counts = _remote_conns.setdefault(data["worker"], {})
+    for uid, n in data["counts"].items():
+        if n:
+            counts[int(uid)] = n
+        else:
+            counts.pop(int(uid), None)
+
+
+async def _on_worker_up(data: dict):
+    """A worker (re)joined: tell it which users this worker holds sockets for, and
+    the XP totals it may now own."""
+    await _worker_heard(data["worker"])
+    await backplane.publish("conns", {"worker": WORKER_ID,
+                                      "counts": {uid: len(c) for uid, c in chat_connections.items()}})
+    await _xp_handover()
+
+
+async def _on_worker_gone(data: dict):
+    """A worker died: its users go offline unless they are connected somewhere else.
+    Every surviving worker sees this event, so each one notifies only its own sockets."""
+    if data["worker"] == WORKER_ID:
+        return
+    _worker_seen.pop(data["worker"], None)
+    await _room_worker_gone(data["worker"])
+    for uid in _remote_conns.pop(data["worker"], {}):
+        if uid not in chat_connections and not _online_elsewhere(uid):
+            _presence_state.pop(uid, None)
+            await _deliver_chat({"frame": _as_frame({"type": "presence", "user_id": uid,
+                                                     "presence": "offline", "online": False})})
+
+
+async def _worker_heard(worker: str):
+    _worker_seen[worker] = time.monotonic()
+    await _room_worker_seen(worker)
+
+
+async def _on_heartbeat(data: dict):
+    worker = data["worker"]
+    if worker == WORKER_ID:
+        return
+    returning = worker not in _workers
+    await _worker_heard(worker)
+    if returning:
+        # we dropped it as silent (or missed its worker_up): have it resend its socket counts
+        await backplane.publish("worker_up", {"worker": WORKER_ID})
+
+
+async def _run_worker_heartbeat():
+    """Announce this worker every BACKPLANE_HEARTBEAT seconds and drop workers that have
+    been silent for BACKPLANE_WORKER_TTL (hung, or killed while it was the broker)."""
+    while True:
+        await _asyncio.sleep(BACKPLANE_HEARTBEAT)
+        try:
+            await backplane.publish("heartbeat", {"worker": WORKER_ID})
+            now = time.monotonic()
+            for worker in (_workers | set(_remote_conns)) - {WORKER_ID}:
+                if now - _worker_seen.setdefault(worker, now) > BACKPLANE_WORKER_TTL:
+                    log.warning("[backplane] no heartbeat from %s — dropping it", worker)
+                    await _on_worker_gone({"worker": worker})
+        except Exception as exc:
+            log.warning("Worker heartbeat error: %s", exc)
+
+
+async def _on_chat_index(data: dict):
+    """Replicate subscription-index changes made by an endpoint on any worker."""
+    op = data["op"]
+    if op == "unsubscribe":
+        _unsubscribe(data["user_id"], data["channel_ids"])
+    elif op == "drop_channel":
+        _drop_channel(data["channel_id"])
+    elif op == "archive":
+        if data["archived"]:
+            _archived_channels.add(data["channel_id"])
+            for conn in list(_channel_viewers.get(data["channel_id"], ())):
+                _set_focus(conn, None)
+        else:
+            _archived_channels.discard(data["channel_id"])
+    elif op == "disconnect":
+        for conn in list(chat_connections.get(data["user_id"], ())):
+            await _drain_outbox(conn.ws)
+            try: await conn.ws.close()
+            except: pass
+
+
+async def _on_slowmode(data: dict):
+    _slowmode_last[(data["user_id"], data["channel_id"])] = data["ts"]
+
+
+async def _on_bad_words(data: dict):
+    await _asyncio.to_thread(_reload_bad_words)
+
+
+backplane.on("chat", _deliver_chat)
+backplane.on("chat_send", _deliver_chat_send)
+backplane.on("chat_index", _on_chat_index)
+backplane.on("mod_cache", _on_mod_cache)
+backplane.on("conns", _on_conns)
+backplane.on("worker_up", _on_worker_up)
+backplane.on("worker_gone", _on_worker_gone)
+backplane.on("heartbeat", _on_heartbeat)
+backplane.on("slowmode", _on_slowmode)
+backplane.on("bad_words", _on_bad_words)
+
+
+@app.on_event("startup")
+async def _start_backplane():
+    await backplane.start()
+    if backplane.kind != "local":
+        _asyncio.create_task(_run_worker_heartbeat())
+
+
+@app.on_event("shutdown")
+async def _stop_backplane():
+    await _drain_rooms()
+    await backplane.stop()
+
+
+# ── Typing indicators ────────────────────────────────────────
+# Clients report typing at most every few seconds; the server keeps who is typing
+# where, and only emits start ({"typing": true}) and stop ({"typing": false})
+# transitions — to the channel's viewers, or to the DM partner.
+TYPING_TTL_SECONDS   = float(os.getenv("TYPING_TTL_SECONDS", "6"))
+TYPING_MIN_INTERVAL  = float(os.getenv("TYPING_MIN_INTERVAL", "1"))
+
+# { (user_id, "ch"|"dm", channel_id|to_user_id): [expires_at, last_refresh, user_name] }
+_typing: Dict[tuple, list] = {}
+
+
+async def _typing_emit(key: tuple, name: str, active: bool):
+    user_id, scope, target = key
+    payload = {"type": "typing", "user_id": user_id, "user_name": name, "typing": active}
+    if scope == "ch":
+        payload["channel_id"] = target
+        await _chat_broadcast(payload, exclude_uid=user_id, channel_id=target, viewers_only=True)
+    else:
+        payload["to_user_id"] = target
+        await _chat_send(target, payload)
+
+
+async def _typing_start(user_id: int, name: str, scope: str, target: int):
+    key, now = (user_id, scope, target), time.monotonic()
+    state = _typing.get(key)
+    if state is not None:
+        if now - state[1] >= TYPING_MIN_INTERVAL:   # rate-limit refreshes per sender
+            state[0], state[1] = now + TYPING_TTL_SECONDS, now
+        return
+    _typing[key] = [now + TYPING_TTL_SECONDS, now, name]
+    await _typing_emit(key, name, True)
+
+
+async def _typing_stop(user_id: int, scope: str, target: int):
+    state = _typing.pop((user_id, scope, target), None)
+    if state is not None:
+        await _typing_emit((user_id, scope, target), state[2], False)
+
+
+async def _typing_stop_all(user_id: int):
+    for key in [k for k in _typing if k[0] == user_id]:
+        await _typing_stop(*key)
+
+
+async def _run_typing_sweeper():
+    """Expire typing states whose sender went quiet without sending a message."""
+    while True:
+        await _asyncio.sleep(1)
+        now = time.monotonic()
+        for key in [k for k, st in _typing.items() if st[0] <= now]:
+            try:
+                await _typing_stop(*key)
+            except Exception as exc:
+                log.warning("Typing sweeper error: %s", exc)
+
+
+@app.on_event("startup")
+async def start_typing_sweeper():
+    _asyncio.create_task(_run_typing_sweeper())
+
+
+# ── Presence ─────────────────────────────────────────────────
+# Presence lives in memory: the status a user picked (User.presence, flushed to
+# the DB in batches), activity from client heartbeats (idle → away), and the
+# effective presence of every online user across workers. A user with sockets on
+# several workers has their activity shared between them (at most every
+# PRESENCE_SHARE_SECONDS), so an idle worker does not flip them to away. Changes are sent only
+# to users sharing a subscribed channel with the subject, and to DM partners.
+PRESENCE_IDLE_SECONDS  = float(os.getenv("PRESENCE_IDLE_SECONDS", "300"))
+PRESENCE_FLUSH_SECONDS = float(os.getenv("PRESENCE_FLUSH_SECONDS", "30"))
+PRESENCE_SHARE_SECONDS = float(os.getenv("PRESENCE_SHARE_SECONDS", str(PRESENCE_IDLE_SECONDS / 10)))
+PRESENCE_STATUSES      = {"online", "away", "dnd", "offline"}
+_PRESENCE_ACTIVITY     = {"channel_message", "dm", "typing", "thread_reply", "react"}
+
+_presence_pref: Dict[int, str]     = {}   # chosen status of connected users / pending flush
+_presence_active: Dict[int, float] = {}   # last activity (monotonic) of local users
+_presence_shared: Dict[int, float] = {}   # when a local user's activity was last sent to other workers
+_presence_dirty: set               = set()
+_presence_state: Dict[int, str]    = {}   # effective presence of online users (all workers)
+_dm_partners: Dict[int, set]       = {}   # local user → DM counterparts
+
+
+def _presence_of(user_id: int) -> str:
+    return _presence_state.get(user_id, "offline")
+
+
+def _effective_presence(user_id: int) -> str:
+    pref = _presence_pref.get(user_id, "online")
+    if user_id not in chat_connections or pref == "offline":
+        return "offline"
+    if pref == "online" and time.monotonic() - _presence_active.get(user_id, 0) > PRESENCE_IDLE_SECONDS:
+        return "away"
+    return pref
+
+
+async def _presence_publish(user_id: int, presence: str, channels: list):
+    await backplane.publish("presence", {"user_id": user_id, "presence": presence, "channels": channels,
+                                         "partners": list(_dm_partners.get(user_id, ()))})
+
+
+async def _presence_refresh(user_id: int, channels: Optional[list] = None):
+    """Recompute a user's presence and publish it if it changed."""
+    if user_id not in chat_connections and _online_elsewhere(user_id):
+        return   # still connected through another worker, which owns the state
+    presence = _effective_presence(user_id)
+    if _presence_of(user_id) != presence:
+        await _presence_publish(user_id, presence,
+                                list(_user_subs.get(user_id, ())) if channels is None else channels)
+
+
+def _presence_touch(user_id: int):
+    _presence_active[user_id] = time.monotonic()
+
+
+async def _presence_share(user_id: int, force: bool = False):
+    """Pass a local user's activity on to the other workers holding their sockets."""
+    if not _online_elsewhere(user_id):
+        return
+    now = time.monotonic()
+    if force or now - _presence_shared.get(user_id, 0) >= PRESENCE_SHARE_SECONDS:
+        _presence_shared[user_id] = now
+        await backplane.publish("presence_active", {"user_id": user_id, "worker": WORKER_ID})
+
+
+async def _on_presence_active(data: dict):
+    if data["worker"] != WORKER_ID and data["user_id"] in chat_connections:
+        _presence_touch(data["user_id"])
+
+
+async def _load_dm_partners(user_id: int):
+    async with async_session() as session:
+        rows = (await session.exec(
+            select(DmConversation.partner_id).where(DmConversation.user_id == user_id)
+        )).all()
+    _dm_partners[user_id] = {uid for uid in rows if uid != user_id}
+
 
+async def _deliver_presence(data: dict):
+    """Record a presence change and notify the local sockets allowed to see it."""
+    uid, presence = data["user_id"], data["presence"]
+    if presence == "offline":
+        _presence_state.pop(uid, None)
+    else:
+        _presence_state[uid] = presence
+    users = {u for cid in data["channels"] for u in _channel_subs.get(cid, ())}
+    users.update(data["partners"])
+    users.discard(uid)
+    targets = {c for u in users for c in chat_connections.get(u, ())}
+    targets.update(c for c in _unscoped_conns if c.user_id != uid)
+    frame = _as_frame({"type": "presence", "user_id": uid, "presence": presence,
+                       "online": presence != "offline"})
+    for conn in targets:
+        await safe_send(conn.ws, frame)
+
+
+async def _on_presence_pref(data: dict):
+    uid = data["user_id"]
+    if uid in chat_connections or uid in _presence_dirty:
+        _presence_pref[uid] = data["presence"]
+    if uid in chat_connections:
+        _presence_touch(uid)
+        await _presence_refresh(uid)
+
+
+def _flush_presence(prefs: Dict[int, str]):
+    with Session(engine) as session:
+        for user in session.exec(select(User).where(User.id.in_(list(prefs)))).all():
+            user.presence = prefs[user.id]
+            session.add(user)
+        session.commit()
 
-# -------------------------------------------------------------
-# Chat helpers
-# -------------------------------------------------------------
-def _poll_dict(p: Poll, session: Session) -> dict:
-    opts    = json.loads(p.options_json)
-    votes   = session.exec(select(PollVote).where(PollVote.poll_id == p.id)).all()
-    counts  = [0] * len(opts)
-    voters  = [[] for _ in range(len(opts))]
-    for v in votes:
-        if 0 <= v.option_index < len(opts):
-            counts[v.option_index] += 1
-            voters[v.option_index].append(v.user_id)
-    return {
-        "id":            p.id,
-        "creator_id":    p.creator_id,
-        "creator_name":  p.creator_name,
-        "question":      p.question,
-        "options":       opts,
-        "counts":        counts,
-        "voters":        voters,
-        "channel_id":    p.channel_id,
-        "dm_to_user_id": p.dm_to_user_id,
-        "ts":            p.created_at.isoformat(),
-    }
 
+async def _flush_presence_dirty():
+    if not _presence_dirty:
+        return
+    batch = {uid: _presence_pref.get(uid, "online") for uid in _presence_dirty}
+    _presence_dirty.clear()
+    try:
+        await _asyncio.to_thread(_flush_presence, batch)
+    except Exception as exc:
+        log.warning("Presence flush error: %s", exc)
+        _presence_dirty.update(batch)
+    for uid in batch:
+        if uid not in chat_connections and uid not in _presence_dirty:
+            _presence_pref.pop(uid, None)
 
-def _msg_dict(m: ChatMessage) -> dict:
-    return {
-        "id":             m.id,
-        "channel_id":     m.channel_id,
-        "dm_to_user_id":  m.dm_to_user_id,
-        "sender_id":      m.sender_id,
-        "sender_name":    m.sender_name,
-        "content":        m.content,
-        "file_url":       m.file_url,
-        "file_name":      m.file_name,
-        "reactions":      json.loads(m.reactions or "{}"),
-        "pinned":         bool(m.pinned),
-        "parent_id":      m.parent_id,
-        "bot_name":       m.bot_name,
-        "edited":         bool(m.edited),
-        "edited_at":      m.edited_at.isoformat() if m.edited_at else None,
-        "forwarded_from": m.forwarded_from,
-        "ts":             m.created_at.isoformat(),
-    }
 
+async def _run_presence_loop():
+    """Move idle users to away and persist chosen statuses in batches."""
+    last_flush = time.monotonic()
+    while True:
+        await _asyncio.sleep(5)
+        for uid in list(chat_connections):
+            try:
+                await _presence_refresh(uid)
+            except Exception as exc:
+                log.warning("Presence refresh error: %s", exc)
+        if time.monotonic() - last_flush >= PRESENCE_FLUSH_SECONDS:
+            last_flush = time.monotonic()
+            await _flush_presence_dirty()
 
-def _task_dict(t: RecurringTask) -> dict:
-    return {
-        "id":               t.id,
-        "channel_id":       t.channel_id,
-        "message":          t.message,
-        "interval_minutes": t.interval_minutes,
-        "last_run":         t.last_run.isoformat() if t.last_run else None,
-        "active":           t.active,
-        "open_url":         t.open_url,
-        "shell_cmd":        t.shell_cmd,
-        "url_target":       t.url_target or "self",
-        "created_at":       t.created_at.isoformat(),
-    }
+
+@app.on_event("startup")
+async def start_presence_loop():
+    _asyncio.create_task(_run_presence_loop())
+
+
+@app.on_event("shutdown")
+async def flush_presence_on_shutdown():
+    await _flush_presence_dirty()
+
+
+backplane.on("presence", _deliver_presence)
+backplane.on("presence_pref", _on_presence_pref)
+backplane.on("presence_active", _on_presence_active)
+
+
+# ── @Volt AI replies ─────────────────────────────────────────
+# Mentions are queued and answered by a small pool of workers, so a slow model
+# never blocks the sender's socket. A channel has at most one job waiting: later
+# mentions join it (up to VOLT_PENDING_MAX, repeats dropped) and are answered
+# together in one Gemini call that addresses each asker.
+VOLT_WORKERS     = int(os.getenv("VOLT_WORKERS", "4"))
+VOLT_QUEUE_MAX   = int(os.getenv("VOLT_QUEUE_MAX", "100"))
+VOLT_PENDING_MAX = int(os.getenv("VOLT_PENDING_MAX", "5"))
+
+_volt_queue: "_asyncio.Queue[int]" = None   # channel ids, created at startup
+_volt_pending: Dict[int, List[dict]] = {}   # { channel_id: [mention, ...] not yet picked up }
+_volt_stats = {"queued": 0, "merged": 0, "rejected": 0, "answered": 0, "running": 0}
+
+
+def _enqueue_volt(channel_id: int, user_name: str, content: str) -> bool:
+    """Queue an @Volt mention; False when the queue is full."""
+    mention = {"user_name": user_name, "content": content}
+    job = _volt_pending.get(channel_id)
+    if job is not None:
+        if mention in job:
+            _volt_stats["merged"] += 1
+            return True
+        if len(job) >= VOLT_PENDING_MAX:
+            _volt_stats["rejected"] += 1
+            return False
+        job.append(mention)
+        _volt_stats["merged"] += 1
+        return True
+    if _volt_queue is None or _volt_queue.full():
+        _volt_stats["rejected"] += 1
+        return False
+    _volt_pending[channel_id] = [mention]
+    _volt_queue.put_nowait(channel_id)
+    _volt_stats["queued"] += 1
+    _asyncio.create_task(_volt_thinking(channel_id, True))
+    return True
+
+
+async def _volt_thinking(channel_id: int, thinking: bool):
+    await _chat_broadcast({"type": "volt_thinking", "channel_id": channel_id, "thinking": thinking},
+                          channel_id=channel_id, viewers_only=True)
+
+
+async def _volt_generate(prompt: str) -> str:
+    if not GEMINI_API_KEY:
+        return "⚡ Volt: AI is not configured — the `Syntact_Key` environment variable is missing on the server."
+    try:
+        async with httpx.AsyncClient(timeout=15) as hc:
+            r = await hc.post(
+                f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}",
+                json={"contents": [{"parts": [{"text": prompt}]}]},
+            )
+        if r.status_code == 200:
+            return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+        log.warning("@Volt Gemini error %d: %s", r.status_code, r.text[:200])
+        return f"⚡ Volt: Gemini API error {r.status_code} — {r.json().get('error',{}).get('message','unknown error')}"
+    except Exception as exc:
+        log.warning("@Volt AI error: %s", exc)
+        return f"⚡ Volt: network error reaching Gemini — {exc}"
+
+
+async def _answer_volt(channel_id: int, job: List[dict]):
+    async with async_session() as hs:
+        hist_msgs = (await hs.exec(
+            select(ChatMessage)
+            .where(ChatMessage.channel_id == channel_id, ChatMessage.bot_name == None)
+            .order_by(ChatMessage.created_at.desc()).limit(10)
+        )).all()
+        context_txt = '\n'.join(f"{m.sender_name}: {m.content}" for m in reversed(hist_msgs) if m.content)
+    asks = '\n'.join(f"User ({m['user_name']}) says: {m['content']}" for m in job)
+    ai_prompt = (
+        f"You are Volt, a helpful smart assistant in a team chat app.\n"
+        f"Recent chat context:\n{context_txt}\n\n"
+        f"{asks}\n\n"
+        + ("Reply helpfully and concisely (2-3 sentences max)." if len(job) == 1 else
+           "Answer each user above by name, helpfully and concisely (2-3 sentences each).")
+    )
+    reply = await _volt_generate(ai_prompt)
+    async with async_session() as vs:
+        volt_cm = ChatMessage(
+            channel_id=channel_id, sender_id=0, sender_name="Volt",
+            content=reply, bot_name="Volt",
+        )
+        vs.add(volt_cm); await vs.commit(); await vs.refresh(volt_cm)
+        volt_out = {"type": "channel_message", "message": _msg_dict(volt_cm)}
+    await _chat_broadcast(volt_out, channel_id=channel_id)
 
 
-async def _chat_broadcast(payload: dict, exclude_uid: Optional[int] = None):
-    for uid, ws in list(chat_connections.items()):
-        if uid == exclude_uid:
+async def _run_volt_worker():
+    while True:
+        channel_id = await _volt_queue.get()
+        job = _volt_pending.pop(channel_id, None)
+        if job is None:
             continue
-        await safe_send(ws, payload)
+        _volt_stats["running"] += 1
+        try:
+            await _answer_volt(channel_id, job)
+            _volt_stats["answered"] += 1
+        except Exception as exc:
+            log.warning("@Volt job error in channel %s: %s", channel_id, exc)
+        finally:
+            _volt_stats["running"] -= 1
+            if channel_id not in _volt_pending:
+                await _volt_thinking(channel_id, False)
 
 
-async def _chat_send(user_id: int, payload: dict):
-    ws = chat_connections.get(user_id)
-    if ws:
-        await safe_send(ws, payload)
+@app.on_event("startup")
+async def start_volt_workers():
+    global _volt_queue
+    _volt_queue = _asyncio.Queue(maxsize=VOLT_QUEUE_MAX)
+    for _ in range(max(1, VOLT_WORKERS)):
+        _asyncio.create_task(_run_volt_worker())
 
 
 # -------------------------------------------------------------
@@ -1698,18 +4197,16 @@ def create_channel(
 @app.get("/chat/channels/{channel_id}/messages")
 def channel_messages(
     channel_id: int,
-    before: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[int] = None,
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_user_read_session),
 ):
-    stmt = select(ChatMessage).where(ChatMessage.channel_id == channel_id)
-    if before:
-        stmt = stmt.where(ChatMessage.id < before)
-    stmt = stmt.order_by(ChatMessage.created_at.desc()).limit(limit)
-    msgs = list(session.exec(stmt).all())
-    msgs.reverse()
-    return [_msg_dict(m) for m in msgs]
+    return _with_my_reactions(session, _keyset_page(
+        session, functools.partial(_channel_history_stmt, channel_id), before, after, around, limit),
+        current_user.id)
 
 
 @app.get("/chat/users")
@@ -1718,31 +4215,43 @@ def list_chat_users(
     session: Session = Depends(get_session),
 ):
     users = session.exec(select(User).where(User.id != current_user.id)).all()
-    return [{"id": u.id, "name": u.name, "avatar_url": u.avatar_url, "status": u.status, "title": u.title} for u in users]
+    return [{"id": u.id, "name": u.name, "avatar_url": u.avatar_url, "status": u.status, "title": u.title,
+             "presence": _presence_of(u.id)} for u in users]
+
+
+@app.get("/chat/dm")
+async def dm_conversations(
+    limit: int = 50,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """The user's DM conversations, most recent first, in one indexed query."""
+    rows = (await session.exec(_dm_conversations_stmt(current_user.id, max(1, min(limit, PAGE_LIMIT_MAX))))).all()
+    return [{
+        "user_id":         conv.partner_id,
+        "name":            u.name,
+        "avatar_url":      u.avatar_url,
+        "presence":        _presence_of(u.id),
+        "unread":          conv.unread,
+        "last_message_at": conv.last_message_at.isoformat(),
+        "last_message":    {"id": cm.id, "sender_id": cm.sender_id, "content": cm.content,
+                            "file_name": cm.file_name} if cm else None,
+    } for conv, u, cm in rows]
 
 
 @app.get("/chat/dm/{other_user_id}/messages")
 def dm_messages(
     other_user_id: int,
-    before: Optional[int] = None,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[int] = None,
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_user_read_session),
 ):
-    from sqlalchemy import or_, and_
-    stmt = select(ChatMessage).where(
-        ChatMessage.channel_id == None,  # noqa: E711
-        or_(
-            and_(ChatMessage.sender_id == current_user.id, ChatMessage.dm_to_user_id == other_user_id),
-            and_(ChatMessage.sender_id == other_user_id,   ChatMessage.dm_to_user_id == current_user.id),
-        ),
-    )
-    if before:
-        stmt = stmt.where(ChatMessage.id < before)
-    stmt = stmt.order_by(ChatMessage.created_at.desc()).limit(limit)
-    msgs = list(session.exec(stmt).all())
-    msgs.reverse()
-    return [_msg_dict(m) for m in msgs]
+    return _with_my_reactions(session, _keyset_page(
+        session, functools.partial(_dm_history_stmt, current_user.id, other_user_id), before, after, around, limit),
+        current_user.id)
 
 
 @app.post("/chat/upload")
@@ -1759,6 +4268,7 @@ async def upload_file(
     dest     = os.path.join(UPLOADS_DIR, fname)
     with open(dest, "wb") as fh:
         shutil.copyfileobj(file.file, fh)
+    await _pin_reads(current_user.id)
     return {"url": f"/uploads/{fname}", "name": original}
 
 
@@ -1766,20 +4276,22 @@ async def upload_file(
 async def delete_channel(
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    ch = session.get(Channel, channel_id)
+    ch = await session.get(Channel, channel_id)
     if not ch:
         raise HTTPException(status_code=404, detail="Channel not found")
     if ch.created_by != current_user.id:
         raise HTTPException(status_code=403, detail="Only the channel owner can delete this channel")
     # Delete all messages in channel first
-    msgs = session.exec(select(ChatMessage).where(ChatMessage.channel_id == channel_id)).all()
+    msgs = (await session.exec(select(ChatMessage).where(ChatMessage.channel_id == channel_id))).all()
     for m in msgs:
-        session.delete(m)
-    session.delete(ch)
-    session.commit()
-    await _chat_broadcast({"type": "channel_deleted", "channel_id": channel_id})
+        await session.delete(m)
+    await session.delete(ch)
+    await session.commit()
+    await _chat_broadcast({"type": "channel_deleted", "channel_id": channel_id}, channel_id=channel_id)
+    await backplane.publish("chat_index", {"op": "drop_channel", "channel_id": channel_id})
+    await _mod_invalidate(channel_id=channel_id)
     return {"ok": True}
 
 
@@ -1788,38 +4300,40 @@ async def delete_channel(
 async def delete_message(
     msg_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    cm = session.get(ChatMessage, msg_id)
+    cm = await session.get(ChatMessage, msg_id)
     if not cm:
         raise HTTPException(status_code=404, detail="Message not found")
     # Bot messages (sender_id=0) can be deleted by anyone; regular messages by sender only
     if cm.sender_id != 0 and cm.sender_id != current_user.id:
         raise HTTPException(status_code=403, detail="You can only delete your own messages")
-    _log_audit(session, "delete_message", current_user.id, current_user.name,
+    await _log_audit(session, "delete_message", current_user.id, current_user.name,
                channel_id=cm.channel_id, detail=cm.content[:200] if cm.content else None)
-    session.delete(cm)
-    session.commit()
-    await _chat_broadcast({"type": "message_deleted", "message_id": msg_id})
+    await session.delete(cm)
+    await session.commit()
+    await _pin_reads(current_user.id)
+    await _chat_broadcast_for(cm, {"type": "message_deleted", "message_id": msg_id})
     return {"ok": True}
 @app.post("/chat/messages/{msg_id}/pin")
 async def toggle_pin(
     msg_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    cm = session.get(ChatMessage, msg_id)
+    cm = await session.get(ChatMessage, msg_id)
     if not cm:
         raise HTTPException(status_code=404, detail="Message not found")
     # Only the channel owner can pin (DM messages: either participant can pin)
     if cm.channel_id:
-        ch = session.get(Channel, cm.channel_id)
+        ch = await session.get(Channel, cm.channel_id)
         if ch and ch.created_by != 0 and ch.created_by != current_user.id:
             raise HTTPException(status_code=403, detail="Only the channel owner can pin messages")
     cm.pinned = not bool(cm.pinned)
     session.add(cm)
-    session.commit()
-    await _chat_broadcast({"type": "pin_update", "message_id": msg_id, "pinned": cm.pinned})
+    await session.commit()
+    await _pin_reads(current_user.id)
+    await _chat_broadcast_for(cm, {"type": "pin_update", "message_id": msg_id, "pinned": cm.pinned})
     return {"pinned": cm.pinned}
 
 
@@ -1828,14 +4342,9 @@ async def toggle_pin(
 def pinned_messages(
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_user_read_session),
 ):
-    msgs = session.exec(
-        select(ChatMessage).where(
-            ChatMessage.channel_id == channel_id,
-            ChatMessage.pinned == True,  # noqa: E712
-        ).order_by(ChatMessage.created_at)
-    ).all()
+    msgs = session.exec(_pinned_stmt(channel_id)).all()
     return [_msg_dict(m) for m in msgs]
 
 
@@ -1845,12 +4354,14 @@ def search_messages(
     q: str = Query(..., min_length=1),
     from_user: Optional[str] = Query(None),
     channel_id: Optional[int] = Query(None),
-    after: Optional[str] = Query(None),   # ISO date string YYYY-MM-DD
-    before: Optional[str] = Query(None),  # ISO date string YYYY-MM-DD
+    from_date: Optional[str] = Query(None),  # ISO date string YYYY-MM-DD
+    to_date: Optional[str] = Query(None),    # ISO date string YYYY-MM-DD
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = 60,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_read_session),
 ):
-    from sqlalchemy import or_
     stmt = select(ChatMessage).where(
         ChatMessage.content.contains(q),
         ChatMessage.parent_id == None,  # noqa: E711  top-level only
@@ -1859,35 +4370,32 @@ def search_messages(
         stmt = stmt.where(ChatMessage.sender_name.ilike(f"%{from_user}%"))
     if channel_id:
         stmt = stmt.where(ChatMessage.channel_id == channel_id)
-    if after:
+    if from_date:
         try:
-            after_dt = datetime.fromisoformat(after)
-            stmt = stmt.where(ChatMessage.created_at >= after_dt)
+            stmt = stmt.where(ChatMessage.created_at >= datetime.fromisoformat(from_date))
         except ValueError:
             pass
-    if before:
+    if to_date:
         try:
-            before_dt = datetime.fromisoformat(before) + timedelta(days=1)
-            stmt = stmt.where(ChatMessage.created_at <= before_dt)
+            stmt = stmt.where(ChatMessage.created_at <= datetime.fromisoformat(to_date) + timedelta(days=1))
         except ValueError:
             pass
-    stmt = stmt.order_by(ChatMessage.created_at.desc()).limit(60)
-    msgs = session.exec(stmt).all()
-    return [_msg_dict(m) for m in msgs]
+    return _keyset_page(session, functools.partial(_id_page, stmt), before, after, None, limit)
 
 
 # -- Get thread replies for a message --
 @app.get("/chat/messages/{msg_id}/thread")
 def get_thread(
     msg_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[int] = None,
+    limit: int = 50,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_user_read_session),
 ):
-    msgs = session.exec(
-        select(ChatMessage).where(ChatMessage.parent_id == msg_id)
-        .order_by(ChatMessage.created_at)
-    ).all()
-    return [_msg_dict(m) for m in msgs]
+    return _with_my_reactions(session, _keyset_page(
+        session, functools.partial(_thread_stmt, msg_id), before, after, around, limit), current_user.id)
 
 
 # -- Scheduled messages --
@@ -1956,7 +4464,7 @@ class CreatePollRequest(BaseModel):
 async def create_poll(
     body: CreatePollRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     if len(body.options) < 2:
         raise HTTPException(400, "Need at least 2 options")
@@ -1965,10 +4473,10 @@ async def create_poll(
         question=body.question, options_json=json.dumps(body.options),
         channel_id=body.channel_id, dm_to_user_id=body.dm_to_user_id,
     )
-    session.add(poll); session.commit(); session.refresh(poll)
-    pd = _poll_dict(poll, session)
+    session.add(poll); await session.commit(); await session.refresh(poll)
+    pd = _poll_dict(poll, (await session.exec(select(PollVote).where(PollVote.poll_id == poll.id))).all())
     if body.channel_id:
-        await _chat_broadcast({"type": "poll_created", "poll": pd})
+        await _chat_broadcast({"type": "poll_created", "poll": pd}, channel_id=body.channel_id)
     elif body.dm_to_user_id:
         await _chat_send(body.dm_to_user_id, {"type": "poll_created", "poll": pd})
         await _chat_send(current_user.id,     {"type": "poll_created", "poll": pd})
@@ -1980,22 +4488,22 @@ async def vote_poll(
     poll_id: int,
     body: dict,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    poll = session.get(Poll, poll_id)
+    poll = await session.get(Poll, poll_id)
     if not poll:
         raise HTTPException(404, "Poll not found")
-    existing = session.exec(
+    existing = (await session.exec(
         select(PollVote).where(PollVote.poll_id == poll_id, PollVote.user_id == current_user.id)
-    ).first()
+    )).first()
     if existing:
-        session.delete(existing); session.commit()
+        await session.delete(existing); await session.commit()
     opt_idx = int(body.get("option_index", 0))
     session.add(PollVote(poll_id=poll_id, user_id=current_user.id, option_index=opt_idx))
-    session.commit()
-    pd = _poll_dict(poll, session)
+    await session.commit()
+    pd = _poll_dict(poll, (await session.exec(select(PollVote).where(PollVote.poll_id == poll.id))).all())
     if poll.channel_id:
-        await _chat_broadcast({"type": "poll_update", "poll": pd})
+        await _chat_broadcast({"type": "poll_update", "poll": pd}, channel_id=poll.channel_id)
     elif poll.dm_to_user_id:
         await _chat_send(poll.dm_to_user_id, {"type": "poll_update", "poll": pd})
         await _chat_send(current_user.id,    {"type": "poll_update", "poll": pd})
@@ -2011,7 +4519,7 @@ def get_poll(
     poll = session.get(Poll, poll_id)
     if not poll:
         raise HTTPException(404)
-    return _poll_dict(poll, session)
+    return _poll_dict(poll, session.exec(select(PollVote).where(PollVote.poll_id == poll.id)).all())
 
 
 @app.get("/chat/channels/{channel_id}/polls")
@@ -2024,7 +4532,7 @@ def get_channel_polls(
         select(Poll).where(Poll.channel_id == channel_id)
         .order_by(Poll.created_at.desc()).limit(20)
     ).all()
-    return [_poll_dict(p, session) for p in polls]
+    return [_poll_dict(p, session.exec(select(PollVote).where(PollVote.poll_id == p.id)).all()) for p in polls]
 
 
 # -------------------------------------------------------------
@@ -2047,29 +4555,30 @@ class SlowmodeRequest(BaseModel):
 async def mute_user(
     body: MuteRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    target = session.get(User, body.user_id)
+    target = await session.get(User, body.user_id)
     if not target:
         raise HTTPException(404, "User not found")
     # Check permission: channel owner if channel_id given, else admin key required
     if body.channel_id:
-        ch = session.get(Channel, body.channel_id)
+        ch = await session.get(Channel, body.channel_id)
         if not ch or (ch.created_by != 0 and ch.created_by != current_user.id):
             raise HTTPException(403, "Only the channel owner can mute in this channel")
     muted_until = None
     if body.minutes:
         muted_until = datetime.now(timezone.utc) + timedelta(minutes=body.minutes)
     # Remove existing mute for same scope first
-    existing = session.exec(
+    existing = (await session.exec(
         select(MutedUser).where(MutedUser.user_id == body.user_id, MutedUser.channel_id == body.channel_id)
-    ).first()
+    )).first()
     if existing:
-        session.delete(existing)
+        await session.delete(existing)
     mu = MutedUser(user_id=body.user_id, channel_id=body.channel_id,
                    muted_until=muted_until, muted_by=current_user.id)
-    session.add(mu); session.commit()
-    _log_audit(session, "mute_user", current_user.id, current_user.name,
+    session.add(mu); await session.commit()
+    await _mod_invalidate(user_id=body.user_id)
+    await _log_audit(session, "mute_user", current_user.id, current_user.name,
                target.id, target.name, body.channel_id,
                f"duration={'permanent' if not body.minutes else str(body.minutes)+'m'}")
     await _chat_send(body.user_id, {"type": "moderation", "action": "muted",
@@ -2093,6 +4602,7 @@ def unmute_user(
     for m in existing:
         session.delete(m)
     session.commit()
+    _publish_from_thread("mod_cache", {"user_id": user_id})
     return {"ok": True}
 
 
@@ -2101,22 +4611,25 @@ async def kick_user(
     user_id: int,
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    target = session.get(User, user_id)
+    target = await session.get(User, user_id)
     if not target:
         raise HTTPException(404, "User not found")
-    ch = session.get(Channel, channel_id)
+    ch = await session.get(Channel, channel_id)
     if not ch or (ch.created_by != 0 and ch.created_by != current_user.id):
         raise HTTPException(403, "Only the channel owner can kick users")
-    existing = session.exec(
+    existing = (await session.exec(
         select(KickedUser).where(KickedUser.user_id == user_id, KickedUser.channel_id == channel_id)
-    ).first()
+    )).first()
     if not existing:
         ku = KickedUser(user_id=user_id, channel_id=channel_id, kicked_by=current_user.id)
-        session.add(ku); session.commit()
-    _log_audit(session, "kick_user", current_user.id, current_user.name,
+        session.add(ku); await session.commit()
+        await _mod_invalidate(user_id=user_id)
+    await _log_audit(session, "kick_user", current_user.id, current_user.name,
                target.id, target.name, channel_id)
+    await backplane.publish("chat_index", {"op": "unsubscribe", "user_id": user_id,
+                                           "channel_ids": [channel_id]})
     await _chat_send(user_id, {"type": "moderation", "action": "kicked",
                                 "channel_id": channel_id, "by": current_user.name})
     return {"ok": True}
@@ -2134,6 +4647,7 @@ def unkick_user(
     ).first()
     if existing:
         session.delete(existing); session.commit()
+        _publish_from_thread("mod_cache", {"user_id": user_id})
     return {"ok": True}
 
 
@@ -2142,21 +4656,18 @@ async def ban_user(
     user_id: int,
     x_admin_key: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     from fastapi import Header
-    target = session.get(User, user_id)
+    target = await session.get(User, user_id)
     if not target:
         raise HTTPException(404, "User not found")
     target.banned = True
-    session.add(target); session.commit()
-    _log_audit(session, "ban_user", current_user.id, current_user.name, target.id, target.name)
+    session.add(target); await session.commit()
+    await _log_audit(session, "ban_user", current_user.id, current_user.name, target.id, target.name)
     # Force disconnect banned user
     await _chat_send(user_id, {"type": "moderation", "action": "banned", "by": current_user.name})
-    ws = chat_connections.get(user_id)
-    if ws:
-        try: await ws.close()
-        except: pass
+    await backplane.publish("chat_index", {"op": "disconnect", "user_id": user_id})
     return {"ok": True}
 
 
@@ -2179,17 +4690,18 @@ async def set_slowmode(
     channel_id: int,
     body: SlowmodeRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    ch = session.get(Channel, channel_id)
+    ch = await session.get(Channel, channel_id)
     if not ch:
         raise HTTPException(404, "Channel not found")
     if ch.created_by != 0 and ch.created_by != current_user.id:
         raise HTTPException(403, "Only the channel owner can set slowmode")
     ch.slowmode_seconds = max(0, min(body.seconds, 3600))
-    session.add(ch); session.commit()
+    session.add(ch); await session.commit()
+    await _mod_invalidate(channel_id=channel_id)
     await _chat_broadcast({"type": "slowmode_update", "channel_id": channel_id,
-                           "seconds": ch.slowmode_seconds})
+                           "seconds": ch.slowmode_seconds}, channel_id=channel_id)
     return {"ok": True, "seconds": ch.slowmode_seconds}
 
 
@@ -2215,7 +4727,7 @@ def add_bad_word(
         return {"id": existing.id, "word": existing.word}
     bw = BadWord(word=w, added_by=current_user.id)
     session.add(bw); session.commit(); session.refresh(bw)
-    _reload_bad_words()
+    _publish_from_thread("bad_words", {})
     return {"id": bw.id, "word": bw.word}
 
 
@@ -2229,7 +4741,7 @@ def remove_bad_word(
     if not bw:
         raise HTTPException(404, "Not found")
     session.delete(bw); session.commit()
-    _reload_bad_words()
+    _publish_from_thread("bad_words", {})
     return {"ok": True}
 
 
@@ -2296,9 +4808,9 @@ async def edit_message(
     msg_id: int,
     body: EditMessageRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    cm = session.get(ChatMessage, msg_id)
+    cm = await session.get(ChatMessage, msg_id)
     if not cm:
         raise HTTPException(404, "Message not found")
     if cm.sender_id != current_user.id:
@@ -2306,9 +4818,10 @@ async def edit_message(
     cm.content   = _filter_bad_words(body.content.strip())
     cm.edited    = True
     cm.edited_at = datetime.now(timezone.utc)
-    session.add(cm); session.commit(); session.refresh(cm)
+    session.add(cm); await session.commit(); await session.refresh(cm)
+    await _pin_reads(current_user.id)
     d = _msg_dict(cm)
-    await _chat_broadcast({"type": "message_edit", "message": d})
+    await _chat_broadcast_for(cm, {"type": "message_edit", "message": d})
     return d
 
 
@@ -2317,9 +4830,9 @@ async def forward_message(
     msg_id: int,
     body: dict,  # {channel_id?, dm_to_user_id?}
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    orig = session.get(ChatMessage, msg_id)
+    orig = await session.get(ChatMessage, msg_id)
     if not orig:
         raise HTTPException(404, "Message not found")
     channel_id    = body.get("channel_id")
@@ -2334,10 +4847,11 @@ async def forward_message(
         file_name=orig.file_name,
         forwarded_from=msg_id,
     )
-    session.add(cm); session.commit(); session.refresh(cm)
+    session.add(cm); await session.commit(); await session.refresh(cm)
+    await _pin_reads(current_user.id)
     d = _msg_dict(cm)
     if channel_id:
-        await _chat_broadcast({"type": "channel_message", "message": d})
+        await _chat_broadcast({"type": "channel_message", "message": d}, channel_id=channel_id)
     elif dm_to_user_id:
         await _chat_send(dm_to_user_id, {"type": "dm", "message": d})
         await _chat_send(current_user.id, {"type": "dm", "message": d})
@@ -2350,13 +4864,13 @@ async def forward_message(
 @app.get("/bookmarks")
 async def list_bookmarks(
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    bms = session.exec(select(Bookmark).where(Bookmark.user_id == current_user.id)
-                       .order_by(Bookmark.created_at.desc())).all()
+    bms = (await session.exec(select(Bookmark).where(Bookmark.user_id == current_user.id)
+                              .order_by(Bookmark.created_at.desc()))).all()
     result = []
     for b in bms:
-        cm = session.get(ChatMessage, b.message_id)
+        cm = await session.get(ChatMessage, b.message_id)
         if cm:
             d = _msg_dict(cm); d["bookmark_id"] = b.id
             result.append(d)
@@ -2367,14 +4881,14 @@ async def list_bookmarks(
 async def add_bookmark(
     msg_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    existing = session.exec(select(Bookmark).where(
-        Bookmark.user_id == current_user.id, Bookmark.message_id == msg_id)).first()
+    existing = (await session.exec(select(Bookmark).where(
+        Bookmark.user_id == current_user.id, Bookmark.message_id == msg_id))).first()
     if existing:
         return {"detail": "Already bookmarked", "id": existing.id}
     bm = Bookmark(user_id=current_user.id, message_id=msg_id)
-    session.add(bm); session.commit(); session.refresh(bm)
+    session.add(bm); await session.commit(); await session.refresh(bm)
     return {"detail": "Bookmarked", "id": bm.id}
 
 
@@ -2382,12 +4896,12 @@ async def add_bookmark(
 async def remove_bookmark(
     msg_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    bm = session.exec(select(Bookmark).where(
-        Bookmark.user_id == current_user.id, Bookmark.message_id == msg_id)).first()
+    bm = (await session.exec(select(Bookmark).where(
+        Bookmark.user_id == current_user.id, Bookmark.message_id == msg_id))).first()
     if bm:
-        session.delete(bm); session.commit()
+        await session.delete(bm); await session.commit()
     return {"detail": "Removed"}
 
 
@@ -2424,14 +4938,14 @@ class ProfileUpdateRequest(BaseModel):
 async def update_my_profile(
     body: ProfileUpdateRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    u = session.get(User, current_user.id)
+    u = await session.get(User, current_user.id)
     if body.name   is not None: u.name   = body.name.strip()[:64]
     if body.status is not None: u.status = body.status.strip()[:120]
     if body.bio    is not None: u.bio    = body.bio.strip()[:300]
     if body.title  is not None: u.title  = body.title.strip()[:60] if body.title.strip() else None
-    session.add(u); session.commit(); session.refresh(u)
+    session.add(u); await session.commit(); await session.refresh(u)
     # Broadcast status change to all online users
     await _chat_broadcast({"type": "user_status", "user_id": u.id, "status": u.status, "name": u.name})
     return _user_profile_dict(u)
@@ -2444,7 +4958,7 @@ os.makedirs(AVATAR_DIR, exist_ok=True)
 async def upload_avatar(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     ext   = os.path.splitext(file.filename or "")[1].lower() or ".png"
     fname = f"av_{current_user.id}{ext}"
@@ -2454,9 +4968,9 @@ async def upload_avatar(
         raise HTTPException(400, "Avatar must be under 4 MB")
     with open(dest, "wb") as f:
         f.write(content)
-    u = session.get(User, current_user.id)
+    u = await session.get(User, current_user.id)
     u.avatar_url = f"/uploads/avatars/{fname}"
-    session.add(u); session.commit()
+    session.add(u); await session.commit()
     await _chat_broadcast({"type": "user_status", "user_id": u.id, "avatar_url": u.avatar_url})
     return {"avatar_url": u.avatar_url}
 
@@ -2465,9 +4979,9 @@ async def upload_avatar(
 async def get_user_profile(
     user_id: int,
     _: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    u = session.get(User, user_id)
+    u = await session.get(User, user_id)
     if not u:
         raise HTTPException(404, "User not found")
     return _user_profile_dict(u)
@@ -2484,9 +4998,9 @@ class CategoryCreate(BaseModel):
 @app.get("/channels/categories")
 async def list_categories(
     _: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    cats = session.exec(select(ChannelCategory).order_by(ChannelCategory.position)).all()
+    cats = (await session.exec(select(ChannelCategory).order_by(ChannelCategory.position))).all()
     return [{"id": c.id, "name": c.name, "position": c.position} for c in cats]
 
 
@@ -2494,10 +5008,10 @@ async def list_categories(
 async def create_category(
     body: CategoryCreate,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     cat = ChannelCategory(name=body.name.strip(), created_by=current_user.id, position=body.position)
-    session.add(cat); session.commit(); session.refresh(cat)
+    session.add(cat); await session.commit(); await session.refresh(cat)
     return {"id": cat.id, "name": cat.name, "position": cat.position}
 
 
@@ -2505,14 +5019,14 @@ async def create_category(
 async def delete_category(
     cat_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    cat = session.get(ChannelCategory, cat_id)
+    cat = await session.get(ChannelCategory, cat_id)
     if not cat:
         raise HTTPException(404, "Category not found")
     if cat.created_by != current_user.id:
         raise HTTPException(403, "Not your category")
-    session.delete(cat); session.commit()
+    await session.delete(cat); await session.commit()
     return {"detail": "Deleted"}
 
 
@@ -2521,15 +5035,15 @@ async def set_channel_category(
     channel_id: int,
     body: dict,   # {category_id: int | null}
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    ch = session.get(Channel, channel_id)
+    ch = await session.get(Channel, channel_id)
     if not ch:
         raise HTTPException(404, "Channel not found")
     if ch.created_by != current_user.id and ch.created_by != 0:
         raise HTTPException(403, "Not your channel")
     ch.category_id = body.get("category_id")
-    session.add(ch); session.commit()
+    session.add(ch); await session.commit()
     return {"detail": "Updated"}
 
 
@@ -2540,7 +5054,7 @@ async def set_channel_category(
 async def create_invite(
     body: dict,   # {channel_id?, max_uses?, expires_hours?}
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     code       = secrets.token_urlsafe(8)
     channel_id = body.get("channel_id")
@@ -2551,7 +5065,7 @@ async def create_invite(
         expires_at = datetime.now(timezone.utc) + timedelta(hours=int(exp_hours))
     inv = InviteLink(code=code, channel_id=channel_id, created_by=current_user.id,
                      max_uses=max_uses, expires_at=expires_at)
-    session.add(inv); session.commit(); session.refresh(inv)
+    session.add(inv); await session.commit(); await session.refresh(inv)
     return {"code": code, "url": f"/invite/{code}", "channel_id": channel_id,
             "expires_at": expires_at.isoformat() if expires_at else None}
 
@@ -2560,9 +5074,9 @@ async def create_invite(
 async def use_invite(
     code: str,
     _: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    inv = session.exec(select(InviteLink).where(InviteLink.code == code)).first()
+    inv = (await session.exec(select(InviteLink).where(InviteLink.code == code))).first()
     if not inv:
         raise HTTPException(404, "Invite not found or expired")
     now_utc = datetime.now(timezone.utc)
@@ -2571,8 +5085,8 @@ async def use_invite(
     if inv.max_uses and inv.uses >= inv.max_uses:
         raise HTTPException(410, "Invite has reached maximum uses")
     inv.uses += 1
-    session.add(inv); session.commit()
-    ch = session.get(Channel, inv.channel_id) if inv.channel_id else None
+    session.add(inv); await session.commit()
+    ch = await session.get(Channel, inv.channel_id) if inv.channel_id else None
     return {
         "code":       code,
         "channel_id": inv.channel_id,
@@ -2664,28 +5178,23 @@ IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".bmp", ".avif",
 @app.get("/chat/channels/{channel_id}/gallery")
 def channel_gallery(
     channel_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    around: Optional[int] = None,
+    limit: int = 100,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_user_read_session),
 ):
-    msgs = session.exec(
-        select(ChatMessage)
-        .where(ChatMessage.channel_id == channel_id)
-        .where(ChatMessage.file_url != None)  # noqa: E711
-        .order_by(ChatMessage.created_at.desc())
-        .limit(200)
-    ).all()
-    items = []
-    for m in msgs:
-        ext = os.path.splitext((m.file_name or "").lower())[1]
-        if ext in IMAGE_EXTS:
-            items.append({
-                "msg_id":    m.id,
-                "file_url":  m.file_url,
-                "file_name": m.file_name,
-                "sender":    m.sender_name,
-                "ts":        m.created_at.isoformat() if m.created_at else None,
-            })
-    return items
+    return _keyset_page(
+        session, functools.partial(_files_stmt, channel_id, extensions=tuple(sorted(IMAGE_EXTS))),
+        before, after, around, limit,
+        render=lambda m: {
+            "msg_id":    m.id,
+            "file_url":  m.file_url,
+            "file_name": m.file_name,
+            "sender":    m.sender_name,
+            "ts":        m.created_at.isoformat() if m.created_at else None,
+        })
 
 
 # -------------------------------------------------------------
@@ -2703,14 +5212,14 @@ class SyncBotRequest(BaseModel):
 async def syncbot_message(
     body: SyncBotRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     # Determine actual delivery mode
     target = body.volt_target if body.volt_target in ("self", "channel") else "self"
 
     # Channel owner (or any user for system channels) may broadcast Volt
     if target == "channel" and body.channel_id:
-        ch = session.get(Channel, body.channel_id)
+        ch = await session.get(Channel, body.channel_id)
         if not ch or (ch.created_by != 0 and ch.created_by != current_user.id):
             target = "self"  # silently downgrade
 
@@ -2725,11 +5234,11 @@ async def syncbot_message(
             bot_name=body.bot_name,
         )
         session.add(cm)
-        session.commit()
-        session.refresh(cm)
+        await session.commit()
+        await session.refresh(cm)
         d = _msg_dict(cm)
         if cm.channel_id:
-            await _chat_broadcast({"type": "channel_message", "message": d})
+            await _chat_broadcast({"type": "channel_message", "message": d}, channel_id=cm.channel_id)
         elif cm.dm_to_user_id:
             await _chat_send(cm.dm_to_user_id, {"type": "dm", "message": d})
             await _chat_send(current_user.id, {"type": "dm", "message": d})
@@ -2837,9 +5346,9 @@ def delete_bot(
 async def bot_webhook(
     token: str,
     body: WebhookPayload,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    bot = session.exec(select(Bot).where(Bot.webhook_token == token)).first()
+    bot = (await session.exec(select(Bot).where(Bot.webhook_token == token))).first()
     if not bot:
         raise HTTPException(404, "Bot not found")
     if not body.content.strip():
@@ -2859,15 +5368,15 @@ async def bot_webhook(
         bot_name=f"{bot.avatar} {bot.name}",
     )
     session.add(cm)
-    session.commit()
-    session.refresh(cm)
+    await session.commit()
+    await session.refresh(cm)
     d = _msg_dict(cm)
     if cm.channel_id:
         bcast = {"type": "channel_message", "message": d}
         if body.open_url:
             if body.url_target == "channel":
                 # Allow if bot owner is channel owner OR it's a system channel
-                ch = session.get(Channel, cm.channel_id)
+                ch = await session.get(Channel, cm.channel_id)
                 if ch and (ch.created_by == 0 or ch.created_by == bot.owner_id):
                     bcast["open_url"] = body.open_url
                     # open_url_for_uid absent → everyone
@@ -2877,7 +5386,7 @@ async def bot_webhook(
             else:  # "self"
                 bcast["open_url"] = body.open_url
                 bcast["open_url_for_uid"] = bot.owner_id
-        await _chat_broadcast(bcast)
+        await _chat_broadcast(bcast, channel_id=cm.channel_id)
     return d
 
 
@@ -2963,7 +5472,8 @@ def toggle_task(
 # Chat WebSocket
 # -------------------------------------------------------------
 @app.websocket("/ws/chat/{user_id}")
-async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
+async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...),
+                  device: Optional[str] = Query(None), resume_from: Optional[str] = Query(None)):
     # Authenticate via token query param
     try:
         payload = decode_token(token)
@@ -2975,25 +5485,48 @@ async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
         return
 
     await ws.accept()
-    chat_connections[user_id] = ws
-    log.info("[chat] user %d connected  (total online: %d)", user_id, len(chat_connections))
 
-    with Session(engine) as session:
-        db_user = session.get(User, user_id)
+    async with async_session() as session:
+        db_user = await session.get(User, user_id)
         uname   = db_user.name if db_user else f"User{user_id}"
         # Reject banned users
         if db_user and db_user.banned:
-            await ws.send_text(json.dumps({"type": "moderation", "action": "banned", "by": "system"}))
+            await safe_send(ws, {"type": "moderation", "action": "banned", "by": "system"})
             await ws.close(code=4003)
             return
 
-    await _chat_broadcast({"type": "presence", "user_id": user_id, "online": True}, exclude_uid=user_id)
+    conn = ChatConn(f"{user_id}.{next(_conn_counter)}", user_id, (device or "web")[:40], ws)
+    ob = _open_outbox(ws, f"chat {conn.conn_id}")
+    # Replay and registration happen without yielding, so no live event can slip between them
+    replay = _resume(user_id, resume_from) if resume_from else []
+    first_device = _register_conn(conn)
+    ob.prime([_encode_json({"type": "connected", "conn_id": conn.conn_id, "device": conn.device,
+                            "epoch": _stream_epoch, "last_seq": _streams[user_id].seq}), *replay])
+    if first_device:
+        if user_id not in _presence_dirty:
+            _presence_pref[user_id] = (db_user.presence if db_user else None) or "online"
+        await _load_dm_partners(user_id)
+    await _publish_conn_count(user_id)
+    log.info("[chat] user %d connected on %s  (online: %d users / %d sockets)",
+             user_id, conn.conn_id, *_online_counts().values())
+    _presence_touch(user_id)
+    await _presence_share(user_id, force=True)
+    await _presence_refresh(user_id)
 
     try:
         while True:
             raw   = await ws.receive_text()
             msg   = json.loads(raw)
             mtype = msg.get("type")
+            if mtype in _PRESENCE_ACTIVITY or (mtype == "heartbeat" and msg.get("active")):
+                _presence_touch(user_id)
+                await _presence_share(user_id)
+                if _presence_of(user_id) == "away":
+                    await _presence_refresh(user_id)
+            client_msg_id = _client_msg_id(msg) if mtype in ("channel_message", "dm", "thread_reply") else None
+            if client_msg_id and (seen := _recent_client_msg(user_id, client_msg_id)):
+                await _ack(conn, client_msg_id, seen[0], seen[1], duplicate=True)
+                continue
 
             # -- Channel message --
             if mtype == "channel_message":
@@ -3002,50 +5535,33 @@ async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
                 file_url   = msg.get("file_url")
                 file_name  = msg.get("file_name")
                 if not content and not file_url:
+                    await _nack(conn, client_msg_id, "empty")
                     continue
-                with Session(engine) as session:
-                    # Kick check
-                    kicked = session.exec(
-                        select(KickedUser).where(KickedUser.user_id == user_id,
-                                                  KickedUser.channel_id == channel_id)
-                    ).first()
-                    if kicked:
-                        await ws.send_text(json.dumps({"type": "error", "message": "You have been removed from this channel."}))
+                async with async_session() as session:
+                    # Kick / mute / slowmode / readonly checks (cached; no queries when warm)
+                    mod = await _mod_user(session, user_id)
+                    blocked = _mod_block(mod, channel_id)
+                    if blocked:
+                        await safe_send(ws, {"type": "error", "message": blocked})
+                        await _nack(conn, client_msg_id, "blocked")
                         continue
-                    # Mute check
-                    now_utc = datetime.now(timezone.utc)
-                    mute = session.exec(
-                        select(MutedUser).where(
-                            MutedUser.user_id == user_id,
-                            (MutedUser.channel_id == channel_id) | (MutedUser.channel_id == None)  # noqa: E711
-                        )
-                    ).first()
-                    if mute:
-                        if mute.muted_until is None or mute.muted_until.replace(tzinfo=timezone.utc) > now_utc:
-                            await ws.send_text(json.dumps({"type": "error", "message": "You are muted in this channel."}))
-                            continue
-                        else:
-                            # Mute expired — clean up
-                            session.delete(mute); session.commit()
-                    # Slowmode check
-                    ch = session.get(Channel, channel_id)
-                    if ch and ch.slowmode_seconds > 0:
+                    ch = await _mod_channel(session, channel_id)
+                    if ch and ch["slowmode"] > 0:
                         key = (user_id, channel_id)
                         last = _slowmode_last.get(key, 0)
                         elapsed = _time_mod.time() - last
-                        if elapsed < ch.slowmode_seconds:
-                            wait = int(ch.slowmode_seconds - elapsed) + 1
-                            await ws.send_text(json.dumps({"type": "error",
-                                "message": f"Slowmode: please wait {wait}s before sending again."}))
-                            continue
-                        _slowmode_last[key] = _time_mod.time()
-                    # Readonly check
-                    if ch and ch.readonly:
-                        with Session(engine) as s2:
-                            u2 = s2.get(User, user_id)
-                        if not u2 or u2.role not in ('admin', 'moderator'):
-                            await ws.send_text(json.dumps({"type": "error", "message": "This channel is read-only."}))
+                        if elapsed < ch["slowmode"]:
+                            wait = int(ch["slowmode"] - elapsed) + 1
+                            await safe_send(ws, {"type": "error",
+                                "message": f"Slowmode: please wait {wait}s before sending again."})
+                            await _nack(conn, client_msg_id, "slowmode")
                             continue
+                        await backplane.publish("slowmode", {"user_id": user_id, "channel_id": channel_id,
+                                                             "ts": _time_mod.time()})
+                    if ch and ch["readonly"] and mod["role"] not in ('admin', 'moderator'):
+                        await safe_send(ws, {"type": "error", "message": "This channel is read-only."})
+                        await _nack(conn, client_msg_id, "readonly")
+                        continue
                     # /remind slash command
                     if content and content.lower().startswith("/remind "):
                         # /remind me in 30m to do something  OR  /remind me at 2026-03-05T10:00 to ...
@@ -3059,79 +5575,35 @@ async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
                             at = datetime.fromisoformat(m_abs.group(1))
                         else:
                             at = datetime.now(timezone.utc) + timedelta(minutes=30)
-                        with Session(engine) as rs:
+                        async with async_session() as rs:
                             rs.add(Reminder(user_id=user_id, channel_id=channel_id, content=note, remind_at=at))
-                            rs.commit()
-                        await ws.send_text(json.dumps({"type": "system_msg",
-                            "message": f"⏰ Reminder set for {at.strftime('%Y-%m-%d %H:%M')} UTC: {note}"}))
+                            await rs.commit()
+                        await safe_send(ws, {"type": "system_msg",
+                            "message": f"⏰ Reminder set for {at.strftime('%Y-%m-%d %H:%M')} UTC: {note}"})
+                        await _ack(conn, client_msg_id, None)
                         continue
-                    # Bad words filter
-                    if content:
-                        content = _filter_bad_words(content)
-                    cm = ChatMessage(
-                        channel_id=channel_id, sender_id=user_id, sender_name=uname,
-                        content=content, file_url=file_url, file_name=file_name,
-                    )
-                    session.add(cm); session.commit(); session.refresh(cm)
-                    # XP reward: 5 XP per message, level up every 100 XP
-                    xp_rec = session.exec(select(UserXP).where(UserXP.user_id == user_id)).first()
-                    if not xp_rec:
-                        xp_rec = UserXP(user_id=user_id, xp=0, level=1)
-                        session.add(xp_rec)
-                    xp_rec.xp += 5
-                    new_level = max(1, xp_rec.xp // 100 + 1)
-                    leveled_up = new_level > xp_rec.level
-                    xp_rec.level = new_level
-                    xp_rec.updated_at = datetime.now(timezone.utc)
-                    session.add(xp_rec); session.commit()
-                await _chat_broadcast({"type": "channel_message", "message": _msg_dict(cm)})
-                if leveled_up:
-                    await _chat_broadcast({"type": "level_up", "user_id": user_id,
-                                           "user_name": uname, "level": new_level,
-                                           "channel_id": channel_id})
-                # @Volt mention: reply with Gemini AI
+                # Bad words filter
+                if content:
+                    content = _filter_bad_words(content)
+                # Message (committed by the batched writer), then the 5 XP reward
+                cm, duplicate = await _persist_message(ChatMessage(
+                    channel_id=channel_id, sender_id=user_id, sender_name=uname,
+                    content=content, file_url=file_url, file_name=file_name,
+                    client_msg_id=client_msg_id,
+                ))
+                if duplicate:
+                    await _ack(conn, client_msg_id, cm.id, duplicate=True)
+                    continue
+                out = {"type": "channel_message", "message": _msg_dict(cm)}
+                await _typing_stop(user_id, "ch", channel_id)
+                await _chat_broadcast(out, channel_id=channel_id)
+                await _ack(conn, client_msg_id, out["message"]["id"], _stream_seq(user_id))
+                await _xp_award(user_id, 5, uname, channel_id)
+                # @Volt mention: answered by a background worker
                 if content and '@volt' in content.lower():
-                    prompt_text = content  # the user's message
-                    hist_msgs = []
-                    with Session(engine) as hs:
-                        hist_msgs = hs.exec(
-                            select(ChatMessage)
-                            .where(ChatMessage.channel_id == channel_id, ChatMessage.bot_name == None)
-                            .order_by(ChatMessage.created_at.desc()).limit(10)
-                        ).all()
-                    context_txt = '\n'.join(f"{m.sender_name}: {m.content}" for m in reversed(hist_msgs) if m.content)
-                    ai_prompt = (
-                        f"You are Volt, a helpful smart assistant in a team chat app.\n"
-                        f"Recent chat context:\n{context_txt}\n\n"
-                        f"User ({uname}) says: {prompt_text}\n\n"
-                        f"Reply helpfully and concisely (2-3 sentences max)."
-                    )
-                    _volt_reply = None
-                    if not GEMINI_API_KEY:
-                        _volt_reply = "⚡ Volt: AI is not configured — the `Syntact_Key` environment variable is missing on the server."
-                    else:
-                        try:
-                            async with httpx.AsyncClient(timeout=15) as hc:
-                                r = await hc.post(
-                                    f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}",
-                                    json={"contents": [{"parts": [{"text": ai_prompt}]}]},
-                                )
-                            if r.status_code == 200:
-                                _volt_reply = r.json()["candidates"][0]["content"]["parts"][0]["text"]
-                            else:
-                                log.warning("@Volt Gemini error %d: %s", r.status_code, r.text[:200])
-                                _volt_reply = f"⚡ Volt: Gemini API error {r.status_code} — {r.json().get('error',{}).get('message','unknown error')}"
-                        except Exception as _ve:
-                            log.warning("@Volt AI error: %s", _ve)
-                            _volt_reply = f"⚡ Volt: network error reaching Gemini — {_ve}"
-                    if _volt_reply:
-                        with Session(engine) as vs:
-                            volt_cm = ChatMessage(
-                                channel_id=channel_id, sender_id=0, sender_name="Volt",
-                                content=_volt_reply, bot_name="Volt",
-                            )
-                            vs.add(volt_cm); vs.commit(); vs.refresh(volt_cm)
-                        await _chat_broadcast({"type": "channel_message", "message": _msg_dict(volt_cm)})
+                    if not _enqueue_volt(channel_id, uname, content):
+                        await safe_send(ws, {"type": "error",
+                            "message": "⚡ Volt is busy right now — please try again in a moment."})
 
             # -- Direct message --
             elif mtype == "dm":
@@ -3140,58 +5612,67 @@ async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
                 file_url  = msg.get("file_url")
                 file_name = msg.get("file_name")
                 if not content and not file_url:
+                    await _nack(conn, client_msg_id, "empty")
                     continue
-                with Session(engine) as session:
-                    cm = ChatMessage(
-                        channel_id=None, dm_to_user_id=to_uid,
-                        sender_id=user_id, sender_name=uname,
-                        content=content, file_url=file_url, file_name=file_name,
-                    )
-                    session.add(cm); session.commit(); session.refresh(cm)
-                dm_payload = {"type": "dm", "message": _msg_dict(cm)}
+                cm, duplicate = await _persist_message(ChatMessage(
+                    channel_id=None, dm_to_user_id=to_uid,
+                    sender_id=user_id, sender_name=uname,
+                    content=content, file_url=file_url, file_name=file_name,
+                    client_msg_id=client_msg_id,
+                ))
+                if duplicate:
+                    await _ack(conn, client_msg_id, cm.id, duplicate=True)
+                    continue
+                dm_payload = Frame({"type": "dm", "message": _msg_dict(cm)})
+                for a, b in ((user_id, to_uid), (to_uid, user_id)):
+                    if a in _dm_partners:
+                        _dm_partners[a].add(b)
+                await _typing_stop(user_id, "dm", to_uid)
                 await _chat_send(to_uid, dm_payload)
                 await _chat_send(user_id, dm_payload)
+                await _ack(conn, client_msg_id, cm.id, _stream_seq(user_id))
 
             # -- Typing indicator --
             elif mtype == "typing":
                 channel_id = msg.get("channel_id")
                 to_uid     = msg.get("to_user_id")
-                tpl        = {"type": "typing", "user_id": user_id, "user_name": uname}
-                if channel_id:
-                    tpl["channel_id"] = channel_id
-                    await _chat_broadcast(tpl, exclude_uid=user_id)
+                if channel_id and (channel_id in _user_subs.get(user_id, ()) or conn in _unscoped_conns):
+                    scope, target = "ch", channel_id
                 elif to_uid:
-                    tpl["to_user_id"] = to_uid
-                    await _chat_send(to_uid, tpl)
+                    scope, target = "dm", to_uid
+                else:
+                    continue
+                if msg.get("typing", True):
+                    await _typing_start(user_id, uname, scope, target)
+                else:
+                    await _typing_stop(user_id, scope, target)
 
             # -- Emoji reaction --
             elif mtype == "react":
                 msg_id = msg.get("message_id")
                 emoji  = msg.get("emoji", "")
-                if not emoji or not msg_id:
+                if not emoji or not msg_id or len(emoji) > 32:
                     continue
-                with Session(engine) as session:
-                    cm = session.get(ChatMessage, msg_id)
-                    if not cm:
-                        continue
-                    reacts = json.loads(cm.reactions or "{}")
-                    lst    = reacts.get(emoji, [])
-                    if user_id in lst:
-                        lst.remove(user_id)
-                    else:
-                        lst.append(user_id)
-                    if lst:
-                        reacts[emoji] = lst
-                    elif emoji in reacts:
-                        del reacts[emoji]
-                    cm.reactions = json.dumps(reacts)
-                    session.add(cm); session.commit()
-                await _chat_broadcast({"type": "reaction_update", "message_id": msg_id, "reactions": reacts})
+                async with async_session() as session:
+                    cm, added = await _toggle_reaction(session, msg_id, emoji, user_id)
+                if cm:
+                    await _pin_reads(user_id)
+                    await _chat_broadcast_for(cm, {"type": "reaction_update", "message_id": msg_id,
+                                                   "reactions": _parse_reactions(cm.reactions),
+                                                   "reaction_counts": _parse_reactions(cm.reaction_counts),
+                                                   "user_id": user_id, "emoji": emoji, "added": added})
 
             # -- Read receipt (DM seen) --
             elif mtype == "mark_dm_read":
                 to_uid = msg.get("to_user_id")
                 if to_uid:
+                    async with async_session() as session:
+                        await session.execute(
+                            sa_update(DmConversation)
+                            .where(DmConversation.user_id == user_id, DmConversation.partner_id == to_uid,
+                                   DmConversation.unread > 0)
+                            .values(unread=0))
+                        await session.commit()
                     await _chat_send(to_uid, {
                         "type":       "dm_read",
                         "by_user_id": user_id,
@@ -3205,23 +5686,60 @@ async def chat_ws(ws: WebSocket, user_id: int, token: str = Query(...)):
                 channel_id = msg.get("channel_id")
                 dm_uid     = msg.get("dm_to_user_id")
                 if not content or not parent_id:
+                    await _nack(conn, client_msg_id, "empty")
                     continue
-                with Session(engine) as session:
-                    cm = ChatMessage(
-                        channel_id=channel_id, dm_to_user_id=dm_uid,
-                        sender_id=user_id, sender_name=uname,
-                        content=content, parent_id=parent_id,
-                    )
-                    session.add(cm); session.commit(); session.refresh(cm)
-                await _chat_broadcast({"type": "thread_reply", "message": _msg_dict(cm)})
+                cm, duplicate = await _persist_message(ChatMessage(
+                    channel_id=channel_id, dm_to_user_id=dm_uid,
+                    sender_id=user_id, sender_name=uname,
+                    content=content, parent_id=parent_id, client_msg_id=client_msg_id,
+                ))
+                if duplicate:
+                    await _ack(conn, client_msg_id, cm.id, duplicate=True)
+                    continue
+                await _chat_broadcast_for(cm, {"type": "thread_reply", "message": _msg_dict(cm)})
+                await _ack(conn, client_msg_id, cm.id, _stream_seq(user_id))
+
+            # -- Channel subscriptions (sidebar join / leave, focused view) --
+            elif mtype in ("join", "leave"):
+                ids = msg.get("channel_ids")
+                if ids is None:
+                    ids = [msg.get("channel_id")]
+                ids = [int(c) for c in ids if isinstance(c, int) or (isinstance(c, str) and c.isdigit())]
+                if mtype == "leave":
+                    _unsubscribe(user_id, ids)
+                    continue
+                async with async_session() as session:
+                    kicked = set((await session.exec(
+                        select(KickedUser.channel_id).where(KickedUser.user_id == user_id)
+                    )).all())
+                ids = [c for c in ids if c not in kicked]
+                _subscribe(conn, ids)
+                # Members of the newly joined channels learn this user's presence
+                if _presence_of(user_id) != "offline":
+                    await _presence_publish(user_id, _presence_of(user_id), ids)
+
+            elif mtype == "focus":
+                channel_id = msg.get("channel_id")
+                if channel_id is not None and channel_id not in _user_subs.get(user_id, ()):
+                    channel_id = None
+                _set_focus(conn, channel_id)
 
     except (WebSocketDisconnect, Exception) as exc:
         if not isinstance(exc, WebSocketDisconnect):
             log.warning("[chat] user %d error: %s", user_id, exc)
     finally:
-        chat_connections.pop(user_id, None)
-        log.info("[chat] user %d disconnected", user_id)
-        await _chat_broadcast({"type": "presence", "user_id": user_id, "online": False})
+        _close_outbox(ws)
+        channels = list(_user_subs.get(user_id, ()))
+        if _unregister_conn(conn):
+            await _presence_refresh(user_id, channels)
+            _dm_partners.pop(user_id, None)
+            _presence_active.pop(user_id, None)
+            _presence_shared.pop(user_id, None)
+            if user_id not in _presence_dirty:
+                _presence_pref.pop(user_id, None)
+            await _typing_stop_all(user_id)
+        await _publish_conn_count(user_id)
+        log.info("[chat] user %d disconnected from %s", user_id, conn.conn_id)
 
 
 # =============================================================
@@ -3232,25 +5750,25 @@ async def purge_messages(
     channel_id: int,
     count: int = 10,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     if current_user.role not in ('admin', 'moderator'):
         raise HTTPException(403, "Moderators only")
     count = max(1, min(count, 100))
-    msgs = session.exec(
+    msgs = (await session.exec(
         select(ChatMessage)
         .where(ChatMessage.channel_id == channel_id, ChatMessage.bot_name == None)
         .order_by(ChatMessage.created_at.desc())
         .limit(count)
-    ).all()
+    )).all()
     ids = [m.id for m in msgs]
     for m in msgs:
-        session.delete(m)
-    session.commit()
-    _log_audit(session, "purge", current_user.id, current_user.name,
+        await session.delete(m)
+    await session.commit()
+    await _log_audit(session, "purge", current_user.id, current_user.name,
                channel_id=channel_id, detail=f"Purged {len(ids)} messages")
     for mid in ids:
-        await _chat_broadcast({"type": "message_deleted", "message_id": mid})
+        await _chat_broadcast({"type": "message_deleted", "message_id": mid}, channel_id=channel_id)
     return {"ok": True, "deleted": len(ids)}
 
 
@@ -3266,11 +5784,11 @@ class WarnRequest(BaseModel):
 async def warn_user(
     body: WarnRequest,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     if current_user.role not in ('admin', 'moderator'):
         raise HTTPException(403, "Moderators only")
-    target = session.get(User, body.user_id)
+    target = await session.get(User, body.user_id)
     if not target:
         raise HTTPException(404, "User not found")
     w = UserWarning(
@@ -3278,8 +5796,8 @@ async def warn_user(
         reason=body.reason, warned_by=current_user.id,
         warned_by_name=current_user.name, channel_id=body.channel_id,
     )
-    session.add(w); session.commit(); session.refresh(w)
-    _log_audit(session, "warn_user", current_user.id, current_user.name,
+    session.add(w); await session.commit(); await session.refresh(w)
+    await _log_audit(session, "warn_user", current_user.id, current_user.name,
                target.id, target.name, body.channel_id, body.reason)
     await _chat_send(target.id, {
         "type": "system_msg",
@@ -3303,29 +5821,212 @@ def get_warnings(
 # =============================================================
 # ── XP / Leaderboard ──────────────────────────────────────────
 # =============================================================
+# XP lives in memory: every worker holds the full leaderboard (XPBoard), loaded
+# from UserXP at startup. Awards for a user are applied by that user's owning
+# worker (the same rendezvous hash as rooms, keyed "xp:<id>"), so level-ups are
+# detected exactly once, in order; the owner publishes the new total to every
+# worker's board and writes the totals it changed to UserXP every XP_FLUSH_SECONDS.
+# XP only grows, so boards keep the highest total they have seen and flushes never
+# lower a stored one (a late flush from a previous owner is harmless). A crashed
+# owner's unflushed XP survives in the other workers' boards and is written with
+# the user's next award. Awards sent to a worker are held until its board is
+# loaded, and when a worker joins, the others re-send the totals they changed in
+# the last XP_SYNC_SECONDS (and flush them), so a new owner never starts from a
+# stale UserXP row.
+XP_FLUSH_SECONDS = float(os.getenv("XP_FLUSH_SECONDS", "2"))
+XP_SYNC_SECONDS  = float(os.getenv("XP_SYNC_SECONDS", str(max(10.0, 5 * XP_FLUSH_SECONDS))))
+XP_PER_LEVEL     = 100
+
+
+def _xp_level(xp: int) -> int:
+    return xp // XP_PER_LEVEL + 1
+
+
+class XPBoard:
+    """User XP kept in leaderboard order (a sorted list of (-xp, user_id)), so top-N
+    and a user's rank are a slice and a bisect."""
+    __slots__ = ("xp", "order", "names")
+
+    def __init__(self):
+        self.xp: Dict[int, int] = {}
+        self.order: list = []
+        self.names: Dict[int, str] = {}
+
+    def get(self, user_id: int) -> int:
+        return self.xp.get(user_id, 0)
+
+    def set(self, user_id: int, xp: int, name: Optional[str] = None):
+        old = self.xp.get(user_id)
+        if old is not None:
+            del self.order[bisect.bisect_left(self.order, (-old, user_id))]
+        self.xp[user_id] = xp
+        bisect.insort(self.order, (-xp, user_id))
+        if name:
+            self.names[user_id] = name
+
+    def rank(self, user_id: int) -> Optional[int]:
+        if user_id not in self.xp:
+            return None
+        return bisect.bisect_left(self.order, (-self.xp[user_id], user_id)) + 1
+
+    def top(self, n: int) -> list:
+        return [(uid, -neg) for neg, uid in self.order[:n]]
+
+
+_xp_board = XPBoard()
+_xp_dirty: set = set()   # users this worker awarded XP since the last flush
+_xp_recent: Dict[int, float] = {}   # user → when this worker last awarded them (monotonic)
+_xp_ready = False                   # board loaded from UserXP
+_xp_deferred: list = []             # xp_ctl received before that
+_xp_stats = {"awards": 0, "forwarded": 0, "level_ups": 0, "flushes": 0, "flushed_rows": 0}
+
+
+def _xp_owner(user_id: int) -> str:
+    return _room_owner(f"xp:{user_id}")
+
+
+async def _xp_award(user_id: int, amount: int, user_name: str, channel_id: Optional[int] = None):
+    """Add XP (announcing a level-up in `channel_id`), on the user's owning worker."""
+    owner = _xp_owner(user_id)
+    if owner != WORKER_ID:
+        _xp_stats["forwarded"] += 1
+        await backplane.publish("xp_ctl", {"to": owner, "user_id": user_id, "amount": amount,
+                                           "name": user_name, "channel_id": channel_id}, to=(owner,))
+        return
+    await _xp_apply(user_id, amount, user_name, channel_id)
+
+
+async def _xp_apply(user_id: int, amount: int, user_name: str, channel_id: Optional[int]):
+    old = _xp_board.get(user_id)
+    new = old + amount
+    _xp_board.set(user_id, new, user_name)   # before any await: awards for a user never interleave
+    _xp_dirty.add(user_id)
+    _xp_recent[user_id] = time.monotonic()
+    _xp_stats["awards"] += 1
+    await backplane.publish("xp", {"user_id": user_id, "xp": new, "name": user_name})
+    if _xp_level(new) != _xp_level(old):
+        _xp_stats["level_ups"] += 1
+        await _chat_broadcast({"type": "level_up", "user_id": user_id, "user_name": user_name,
+                               "level": _xp_level(new), "channel_id": channel_id}, channel_id=channel_id)
+
+
+async def _on_xp_ctl(data: dict):
+    if data["to"] != WORKER_ID:
+        return
+    if not _xp_ready:
+        _xp_deferred.append(data)
+        return
+    owner = _xp_owner(data["user_id"])
+    if owner != WORKER_ID and not data.get("hop"):
+        # sent with an outdated view of the workers — pass it on once
+        _xp_stats["forwarded"] += 1
+        await backplane.publish("xp_ctl", {**data, "to": owner, "hop": 1}, to=(owner,))
+        return
+    await _xp_apply(data["user_id"], data["amount"], data["name"], data.get("channel_id"))
+
+
+def _xp_merge(user_id: int, xp: int, name: Optional[str] = None):
+    if xp > _xp_board.get(user_id) or user_id not in _xp_board.xp:
+        _xp_board.set(user_id, xp, name)
+    elif name:
+        _xp_board.names[user_id] = name
+
+
+async def _on_xp(data: dict):
+    _xp_merge(data["user_id"], data["xp"], data.get("name"))
+
+
+async def _on_xp_sync(data: dict):
+    for user_id, xp in data["totals"]:
+        _xp_merge(int(user_id), xp)
+
+
+async def _xp_handover():
+    """A worker joined (and may now own some of our users): re-send the totals this
+    worker changed recently, which a board loaded from UserXP may not have yet."""
+    cutoff = time.monotonic() - XP_SYNC_SECONDS
+    for uid in [u for u, t in _xp_recent.items() if t < cutoff]:
+        del _xp_recent[uid]
+    if _xp_recent:
+        await backplane.publish("xp_sync", {"totals": [[uid, _xp_board.get(uid)] for uid in _xp_recent]})
+    await _flush_xp_dirty()
+
+
+def _read_xp_rows() -> list:
+    with RoutedSession() as session:
+        return session.exec(select(UserXP.user_id, UserXP.xp, User.name)
+                            .join(User, User.id == UserXP.user_id, isouter=True)).all()
+
+
+def _flush_xp(totals: Dict[int, int]):
+    """Write absolute totals, never lowering a stored one."""
+    from sqlalchemy import bindparam
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        known = set(session.exec(select(UserXP.user_id).where(UserXP.user_id.in_(list(totals)))).all())
+        if known:
+            session.connection().execute(
+                sa_update(UserXP.__table__).where(UserXP.__table__.c.user_id == bindparam("uid"),
+                                                  UserXP.__table__.c.xp < bindparam("new_xp"))
+                .values(xp=bindparam("new_xp"), level=bindparam("new_level"), updated_at=now),
+                [{"uid": uid, "new_xp": totals[uid], "new_level": _xp_level(totals[uid])} for uid in known])
+        session.add_all([UserXP(user_id=uid, xp=xp, level=_xp_level(xp), updated_at=now)
+                         for uid, xp in totals.items() if uid not in known])
+        session.commit()
+
+
+async def _flush_xp_dirty():
+    batch = {uid: _xp_board.get(uid) for uid in _xp_dirty}
+    _xp_dirty.clear()
+    if not batch:
+        return
+    try:
+        await _asyncio.to_thread(_flush_xp, batch)
+        _xp_stats["flushes"] += 1
+        _xp_stats["flushed_rows"] += len(batch)
+    except Exception as exc:
+        log.warning("XP flush error: %s", exc)
+        _xp_dirty.update(batch)
+
+
+async def _run_xp_flush():
+    while True:
+        await _asyncio.sleep(XP_FLUSH_SECONDS)
+        await _flush_xp_dirty()
+
+
+@app.on_event("startup")
+async def start_xp_board():
+    global _xp_ready
+    for user_id, xp, name in await _asyncio.to_thread(_read_xp_rows):
+        # totals published by other workers while we were reading may be newer
+        _xp_merge(user_id, xp, name)
+    _xp_ready = True
+    while _xp_deferred:
+        await _on_xp_ctl(_xp_deferred.pop(0))
+    _asyncio.create_task(_run_xp_flush())
+
+
+@app.on_event("shutdown")
+async def flush_xp_on_shutdown():
+    await _flush_xp_dirty()
+
+
+backplane.on("xp_ctl", _on_xp_ctl)
+backplane.on("xp", _on_xp)
+backplane.on("xp_sync", _on_xp_sync)
+
+
 @app.get("/users/xp")
-def get_xp_leaderboard(
-    current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
-):
-    rows = session.exec(select(UserXP).order_by(UserXP.xp.desc()).limit(20)).all()
-    result = []
-    for r in rows:
-        u = session.get(User, r.user_id)
-        result.append({"user_id": r.user_id, "name": u.name if u else f"User{r.user_id}",
-                       "xp": r.xp, "level": r.level})
-    return result
+async def get_xp_leaderboard(current_user: User = Depends(get_current_user)):
+    return [{"user_id": uid, "name": _xp_board.names.get(uid, f"User{uid}"), "xp": xp, "level": _xp_level(xp)}
+            for uid, xp in _xp_board.top(20)]
 
 @app.get("/users/me/xp")
-def get_my_xp(
-    current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
-):
-    xp_rec = session.exec(select(UserXP).where(UserXP.user_id == current_user.id)).first()
-    if not xp_rec:
-        return {"xp": 0, "level": 1, "next_level_xp": 100}
-    next_xp = xp_rec.level * 100
-    return {"xp": xp_rec.xp, "level": xp_rec.level, "next_level_xp": next_xp}
+async def get_my_xp(current_user: User = Depends(get_current_user)):
+    xp = _xp_board.get(current_user.id)
+    return {"xp": xp, "level": _xp_level(xp), "next_level_xp": _xp_level(xp) * XP_PER_LEVEL,
+            "rank": _xp_board.rank(current_user.id)}
 
 
 # =============================================================
@@ -3335,16 +6036,16 @@ def get_my_xp(
 async def summarize_channel(
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     if not GEMINI_API_KEY:
         raise HTTPException(400, "GEMINI_API_KEY not configured")
-    msgs = session.exec(
+    msgs = (await session.exec(
         select(ChatMessage)
         .where(ChatMessage.channel_id == channel_id, ChatMessage.bot_name == None)
         .order_by(ChatMessage.created_at.desc())
         .limit(50)
-    ).all()
+    )).all()
     if not msgs:
         return {"summary": "No messages to summarize yet."}
     msgs = list(reversed(msgs))
@@ -3373,7 +6074,7 @@ async def summarize_channel(
 def channel_analytics(
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_read_session),
 ):
     import collections
     msgs = session.exec(
@@ -3451,7 +6152,7 @@ def list_board_tasks(
 async def create_board_task(
     body: TaskCreate,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     t = Task(
         channel_id=body.channel_id, creator_id=current_user.id,
@@ -3459,9 +6160,9 @@ async def create_board_task(
         description=body.description, assignee_id=body.assignee_id,
         assignee_name=body.assignee_name,
     )
-    session.add(t); session.commit(); session.refresh(t)
+    session.add(t); await session.commit(); await session.refresh(t)
     td = _board_task_dict(t)
-    await _chat_broadcast({"type": "task_created", "task": td})
+    await _chat_broadcast({"type": "task_created", "task": td}, channel_id=t.channel_id)
     return td
 
 @app.patch("/board-tasks/{task_id}")
@@ -3469,9 +6170,9 @@ async def update_board_task(
     task_id: int,
     body: TaskUpdate,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    t = session.get(Task, task_id)
+    t = await session.get(Task, task_id)
     if not t:
         raise HTTPException(404, "Task not found")
     if body.title         is not None: t.title         = body.title.strip()
@@ -3479,22 +6180,23 @@ async def update_board_task(
     if body.assignee_id   is not None: t.assignee_id   = body.assignee_id
     if body.assignee_name is not None: t.assignee_name = body.assignee_name
     if body.status        is not None: t.status        = body.status
-    session.add(t); session.commit(); session.refresh(t)
+    session.add(t); await session.commit(); await session.refresh(t)
     td = _board_task_dict(t)
-    await _chat_broadcast({"type": "task_updated", "task": td})
+    await _chat_broadcast({"type": "task_updated", "task": td}, channel_id=t.channel_id)
     return td
 
 @app.delete("/board-tasks/{task_id}")
 async def delete_board_task(
     task_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    t = session.get(Task, task_id)
+    t = await session.get(Task, task_id)
     if not t:
         raise HTTPException(404)
-    session.delete(t); session.commit()
-    await _chat_broadcast({"type": "task_deleted", "task_id": task_id})
+    channel_id = t.channel_id
+    await session.delete(t); await session.commit()
+    await _chat_broadcast({"type": "task_deleted", "task_id": task_id}, channel_id=channel_id)
     return {"ok": True}
 
 
@@ -3505,19 +6207,19 @@ async def delete_board_task(
 async def meeting_summary(
     channel_id: int,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     """Summarize messages from the last 2 hours as meeting notes."""
     if not GEMINI_API_KEY:
         raise HTTPException(400, "GEMINI_API_KEY not configured")
     since = datetime.now(timezone.utc) - timedelta(hours=2)
-    msgs = session.exec(
+    msgs = (await session.exec(
         select(ChatMessage)
         .where(ChatMessage.channel_id == channel_id,
                ChatMessage.bot_name == None,
                ChatMessage.created_at >= since)
         .order_by(ChatMessage.created_at)
-    ).all()
+    )).all()
     if not msgs:
         return {"notes": "No messages in the last 2 hours to summarize."}
     transcript = "\n".join(f"{m.sender_name}: {m.content}" for m in msgs if m.content)
@@ -3541,6 +6243,6 @@ async def meeting_summary(
         channel_id=channel_id, sender_id=0, sender_name="Volt",
         content=f"📋 **Meeting Notes**\n\n{notes}", bot_name="Volt",
     )
-    session.add(cm); session.commit(); session.refresh(cm)
-    await _chat_broadcast({"type": "channel_message", "message": _msg_dict(cm)})
+    session.add(cm); await session.commit(); await session.refresh(cm)
+    await _chat_broadcast({"type": "channel_message", "message": _msg_dict(cm)}, channel_id=channel_id)
     return {"notes": notes}
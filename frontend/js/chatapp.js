@@ -61,11 +61,18 @@ let activeId      = null;    // channel id or user id
 let activeDmName  = '';
 let dmUsers       = {};      // { user_id: {name, online} }
 let typingTimers  = {};      // channel/dm → timer
+let typingUsers   = {};      // channel/dm → { user_id: name } currently typing
 let emojiTarget   = null;    // 'input' or message_id for reaction
+const myReactions = new Map(); // message_id → Set of the viewer's emojis, for capped reactor lists
 let pendingEmoji  = '💬';   // selected channel emoji
 let unread        = {};      // { cid: count }
 let allUsers      = [];      // [{id, name, avatar_url, status}] from /chat/users
 let threadParentId   = null;
+let historyBefore    = null;  // cursor for the next older page of the open conversation
+let historyAfter     = null;  // cursor for the next newer page (set after a jump into older history)
+let historyMissed    = false; // live messages skipped while historyAfter was set
+let historyLoading   = false;
+let pendingJumpId    = null;  // message to centre the next loadMessages() on
 let threadParentData = null;
 let searchTimeout    = null;
 let _pinnedPollTimer = null;  // auto-refresh pinned badge every 5s
@@ -275,31 +282,108 @@ async function initChat() {
 }
 
 // ── WebSocket ─────────────────────────────────────────────────────────────────
-function connectWS() {
-  ws = new WebSocket(`${WSS}/ws/chat/${user.id}?token=${token}`);
+// Resume: the server stamps durable events with a per-user seq; after a drop we
+// reconnect with resume_from=<epoch>:<last seq> and it replays what we missed.
+let streamEpoch = null;
+let lastSeq     = 0;
+let resuming    = false;
+let connectSeq  = 0;         // server's seq when this socket connected
 
-  ws.onopen  = () => console.log('[chat-ws] connected');
+function connectWS() {
+  resuming = streamEpoch !== null;
+  const resume = resuming ? `&resume_from=${streamEpoch}:${lastSeq}` : '';
+  ws = new WebSocket(`${WSS}/ws/chat/${user.id}?token=${token}${resume}`);
+
+  ws.onopen  = () => {
+    console.log('[chat-ws] connected');
+    syncSubscriptions();
+    pendingSends.forEach(frame => wsSend(frame));
+  };
   ws.onclose = () => { console.log('[chat-ws] disconnected'); setTimeout(connectWS, 3000); };
   ws.onerror = e => console.error('[chat-ws] error', e);
   ws.onmessage = e => {
     console.log('[chat-ws] received:', e.data);
-    try { handleServerMsg(JSON.parse(e.data)); } catch(err) { console.warn(err); }
+    try {
+      const msg = JSON.parse(e.data);
+      if (msg.seq) lastSeq = msg.seq;
+      handleServerMsg(msg);
+    } catch(err) { console.warn(err); }
   };
 }
 
+// Heartbeat: tells the server whether the user interacted since the last beat,
+// so an idle tab shows as "away" without any presence PATCH.
+const HEARTBEAT_MS = 30000;
+let userActive = true;
+['keydown', 'mousedown', 'mousemove', 'touchstart', 'focus'].forEach(ev =>
+  window.addEventListener(ev, () => { userActive = true; }, { passive: true }));
+setInterval(() => {
+  wsSend({ type: 'heartbeat', active: userActive && !document.hidden });
+  userActive = false;
+}, HEARTBEAT_MS);
+
+// Messages carry a client_msg_id and stay pending until the server acks (stored) or
+// nacks (refused) them; pending ones are re-sent on reconnect (the server drops
+// repeats of the same id).
+const pendingSends = new Map();   // client_msg_id → frame
+function sendReliable(frame) {
+  frame.client_msg_id = frame.client_msg_id
+    || (crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+  pendingSends.set(frame.client_msg_id, frame);
+  wsSend(frame);
+}
+
 function wsSend(obj) {
   if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify(obj));
 }
 
+// Tell the server which channels this tab shows (sidebar) and which one is focused,
+// so channel events and typing indicators are only fanned out to interested sockets.
+function syncSubscriptions() {
+  wsSend({ type: 'join', channel_ids: channels.map(c => c.id) });
+  wsSend({ type: 'focus', channel_id: activeType === 'channel' ? activeId : null });
+}
+
 // ── Handle server messages ────────────────────────────────────────────────────
 function handleServerMsg(msg) {
+  // Ephemeral events (typing, presence, status, reactions) arrive coalesced
+  if (msg.type === 'batch') { msg.events.forEach(handleServerMsg); return; }
   console.log('[chat-ws] handleServerMsg:', msg.type, 'activeType:', activeType, 'activeId:', activeId);
   switch (msg.type) {
 
+    case 'connected': {
+      streamEpoch = msg.epoch;
+      connectSeq  = msg.last_seq;
+      if (!resuming) lastSeq = msg.last_seq;
+      break;
+    }
+
+    case 'ack':
+    case 'nack': {
+      pendingSends.delete(msg.client_msg_id);
+      break;
+    }
+
+    case 'resumed': {
+      lastSeq = msg.last_seq;
+      break;
+    }
+
+    case 'resume_failed': {
+      // Gap too old (or server restarted): fall back to refetching the open conversation
+      lastSeq = connectSeq;
+      if (activeType && activeId) loadMessages(activeType, activeId);
+      break;
+    }
+
     case 'channel_message': {
       const m = msg.message;
       console.log('[chat-ws] channel_message - m.channel_id:', m.channel_id, 'activeId:', activeId, 'match:', activeId === m.channel_id);
-      if (activeType === 'channel' && activeId === m.channel_id) {
+      if (activeType === 'channel' && activeId === m.channel_id && !canAppendLive()) {
+        // viewing older history: our own send jumps back to the latest page
+        if (m.sender_id === user.id) loadMessages('channel', activeId);
+        else notifyUnread();
+      } else if (activeType === 'channel' && activeId === m.channel_id) {
         const wrap = document.getElementById('messagesWrap');
         const wasAtBottom = !wrap || wrap.scrollHeight - wrap.scrollTop - wrap.clientHeight < 120;
         appendMessage(m, false);
@@ -334,9 +418,16 @@ function handleServerMsg(msg) {
     case 'dm': {
       const m  = msg.message;
       const other = m.sender_id === user.id ? m.dm_to_user_id : m.sender_id;
-      if (activeType === 'dm' && activeId === other) {
+      if (dmUsers[other]) dmUsers[other].lastAt = m.ts;
+      if (activeType === 'dm' && activeId === other && !canAppendLive()) {
+        if (m.sender_id === user.id) loadMessages('dm', other);
+        else wsSend({ type: 'mark_dm_read', to_user_id: other });
+        renderDmList();
+      } else if (activeType === 'dm' && activeId === other) {
         appendMessage(m, false);
         scrollToBottom();
+        if (m.sender_id !== user.id) wsSend({ type: 'mark_dm_read', to_user_id: other });
+        renderDmList();
       } else if (m.sender_id !== user.id) {
         unread[`dm_${other}`] = (unread[`dm_${other}`] || 0) + 1;
         updateDmBadge(other);
@@ -356,28 +447,43 @@ function handleServerMsg(msg) {
       const relevant = (chanId && activeType === 'channel' && activeId === chanId)
                     || (toUid && activeType === 'dm' && activeId === msg.user_id);
       if (!relevant) break;
-      typingBar.textContent = `${who} is typing…`;
+      const users = typingUsers[key] = typingUsers[key] || {};
+      if (msg.typing === false) delete users[msg.user_id];
+      else                      users[msg.user_id] = who;
+      renderTypingBar(key);
+      // Safety net in case the server's stop event is lost
       clearTimeout(typingTimers[key]);
-      typingTimers[key] = setTimeout(() => { typingBar.textContent = ''; }, 3000);
+      typingTimers[key] = setTimeout(() => { typingUsers[key] = {}; renderTypingBar(key); }, 10000);
+      break;
+    }
+
+    case 'volt_thinking': {
+      if (activeType !== 'channel' || activeId !== msg.channel_id) break;
+      if (msg.thinking) typingBar.textContent = '⚡ Volt is thinking…';
+      else              renderTypingBar(`ch_${msg.channel_id}`);
       break;
     }
 
     case 'reaction_update': {
-      const pill = document.querySelector(`[data-msg-id="${msg.message_id}"] .reactions-row`);
-      if (pill) renderReactions(pill.parentElement.querySelector('[data-msg-id]') || pill.parentElement, msg.message_id, msg.reactions);
+      if (msg.user_id === user.id) {
+        const mine = myReactions.get(msg.message_id) || new Set();
+        if (msg.added) mine.add(msg.emoji); else mine.delete(msg.emoji);
+        myReactions.set(msg.message_id, mine);
+      }
       // re-render reactions row in place
       const msgEl = document.querySelector(`[data-msg-id="${msg.message_id}"]`);
       if (msgEl) {
         let rr = msgEl.querySelector('.reactions-row');
         if (!rr) { rr = document.createElement('div'); rr.className = 'reactions-row'; msgEl.appendChild(rr); }
-        buildReactionRow(rr, msg.message_id, msg.reactions);
+        buildReactionRow(rr, msg.message_id, msg.reactions, msg.reaction_counts);
       }
       break;
     }
 
     case 'presence': {
       if (dmUsers[msg.user_id]) {
-        dmUsers[msg.user_id].online = msg.online;
+        dmUsers[msg.user_id].online   = msg.online;
+        dmUsers[msg.user_id].presence = msg.presence || (msg.online ? 'online' : 'offline');
         updateDmDot(msg.user_id, msg.online);
       }
       break;
@@ -606,6 +712,7 @@ async function openChannel(ch) {
   saveDraft();
   activeType  = 'channel';
   activeId    = ch.id;
+  wsSend({ type: 'focus', channel_id: ch.id });
   activeDmName = '';
   unread[ch.id] = 0;
   chatTitle.textContent  = ch.name;
@@ -686,14 +793,30 @@ async function loadUsers() {
   if (!res.ok) return;
   allUsers = await res.json();
   allUsers.forEach(u => {
-    dmUsers[u.id] = { name: u.name, online: false, avatar_url: u.avatar_url, status: u.status };
+    dmUsers[u.id] = { name: u.name, online: !!u.presence && u.presence !== 'offline',
+                      presence: u.presence || 'offline', avatar_url: u.avatar_url, status: u.status };
   });
+  await loadDmConversations();
+}
+
+// Recent conversations (with unread counts) come from one request; they sort to the top
+async function loadDmConversations() {
+  const res = await authFetch('/chat/dm');
+  if (res.ok) {
+    (await res.json()).forEach(c => {
+      dmUsers[c.user_id] = dmUsers[c.user_id] || { name: c.name, online: c.presence !== 'offline',
+                                                   presence: c.presence, avatar_url: c.avatar_url };
+      dmUsers[c.user_id].lastAt = c.last_message_at;
+      if (!(activeType === 'dm' && activeId === c.user_id)) unread[`dm_${c.user_id}`] = c.unread;
+    });
+  }
   renderDmList();
 }
 
 function renderDmList() {
   dmListEl.innerHTML = '';
-  Object.entries(dmUsers).forEach(([uid, info]) => {
+  const recent = ([, a], [, b]) => (b.lastAt ? Date.parse(b.lastAt) : 0) - (a.lastAt ? Date.parse(a.lastAt) : 0);
+  Object.entries(dmUsers).sort(recent).forEach(([uid, info]) => {
     const li = document.createElement('li');
     const numId = parseInt(uid);
     li.className = `ch-item${activeType === 'dm' && activeId === numId ? ' active' : ''}`;
@@ -716,6 +839,7 @@ async function openDm(uid, name) {
   saveDraft();
   activeType   = 'dm';
   activeId     = uid;
+  wsSend({ type: 'focus', channel_id: null });
   activeDmName = name;
   unread[`dm_${uid}`] = 0;
   chatTitle.textContent  = `@ ${name}`;
@@ -758,24 +882,99 @@ function updateUnreadBadge(cid) {
 }
 
 // ── Messages ──────────────────────────────────────────────────────────────────
+function historyUrl(type, id) {
+  return type === 'channel' ? `/chat/channels/${id}/messages` : `/chat/dm/${id}/messages`;
+}
+
 async function loadMessages(type, id) {
-  const url = type === 'channel' ? `/chat/channels/${id}/messages` : `/chat/dm/${id}/messages`;
-  const res  = await authFetch(url);
+  const jumpId = pendingJumpId;
+  pendingJumpId = null;
+  historyBefore = historyAfter = null;
+  historyMissed = false;
+  const res  = await authFetch(historyUrl(type, id) + (jumpId ? `?around=${jumpId}` : ''));
   if (!res.ok) { messagesWrap.innerHTML = ''; return; }
-  const msgs = await res.json();
+  const page = await res.json();
+  const msgs = page.items;
   // Guard: discard stale responses if the user has already switched context
   const stillActive = (type === 'channel' && activeType === 'channel' && activeId === id)
                    || (type === 'dm'      && activeType === 'dm'      && activeId === id);
   if (!stillActive) return;
+  historyBefore = page.before;
+  historyAfter  = page.after;
   messagesWrap.innerHTML = '';
   if (!msgs.length) {
     messagesWrap.innerHTML = '<div style="color:var(--text-muted);font-size:.85rem;padding:20px 0;text-align:center;">No messages yet. Say hello! 👋</div>';
     return;
   }
   msgs.forEach(m => appendMessage(m, true));
-  scrollToBottom();
+  const target = jumpId && messagesWrap.querySelector(`[data-msg-id="${jumpId}"]`);
+  if (target) {
+    target.scrollIntoView({ block: 'center' });
+    target.classList.add('msg-highlight');
+    setTimeout(() => target.classList.remove('msg-highlight'), 2000);
+  } else {
+    scrollToBottom();
+  }
+}
+
+// Older pages are prepended when the user scrolls to the top of the history
+async function loadOlderMessages() {
+  if (!historyBefore || historyLoading || !activeType) return;
+  const type = activeType, id = activeId;
+  historyLoading = true;
+  try {
+    const res = await authFetch(`${historyUrl(type, id)}?before=${encodeURIComponent(historyBefore)}`);
+    if (!res.ok || activeType !== type || activeId !== id) return;
+    const page = await res.json();
+    historyBefore = page.before;
+    const prevHeight = messagesWrap.scrollHeight, prevTop = messagesWrap.scrollTop;
+    const newer = Array.from(messagesWrap.childNodes);
+    messagesWrap.innerHTML = '';
+    page.items.forEach(m => appendMessage(m, true));
+    newer.forEach(n => messagesWrap.appendChild(n));
+    messagesWrap.scrollTop = messagesWrap.scrollHeight - prevHeight + prevTop;
+  } finally {
+    historyLoading = false;
+  }
 }
 
+// After a jump, newer pages are appended when the user scrolls to the bottom; live
+// messages are held back until the view has caught up, so no gap opens in between
+async function loadNewerMessages() {
+  if (!historyAfter || historyLoading || !activeType) return;
+  const type = activeType, id = activeId;
+  historyLoading = true;
+  historyMissed  = false;
+  try {
+    const res = await authFetch(`${historyUrl(type, id)}?after=${encodeURIComponent(historyAfter)}`);
+    if (!res.ok || activeType !== type || activeId !== id) return;
+    const page = await res.json();
+    page.items.forEach(m => appendMessage(m, true));
+    const last = page.items.length ? String(page.items[page.items.length - 1].id) : historyAfter;
+    // a live message skipped while this page was in flight may be newer than the page
+    historyAfter = page.after || (historyMissed ? last : null);
+  } finally {
+    historyLoading = false;
+  }
+  if (historyAfter && isNearBottom()) loadNewerMessages();
+}
+
+function isNearBottom() {
+  return messagesWrap.scrollHeight - messagesWrap.scrollTop - messagesWrap.clientHeight < 80;
+}
+
+// A live message for the open conversation: false while older history is shown
+function canAppendLive() {
+  if (!historyAfter) return true;
+  historyMissed = true;
+  return false;
+}
+
+messagesWrap.addEventListener('scroll', () => {
+  if (messagesWrap.scrollTop < 80) loadOlderMessages();
+  else if (isNearBottom()) loadNewerMessages();
+});
+
 function appendMessage(m, initial) {
   const wrap = messagesWrap;
   // Mood board: render as image card instead of normal message
@@ -880,21 +1079,24 @@ function appendMessage(m, initial) {
   bubble.innerHTML = inner;
 
   if (m.id !== null && m.id !== undefined) {
-    buildReactionRow(bubble.querySelector('.reactions-row'), m.id, m.reactions || {});
+    if (m.my_reactions) myReactions.set(m.id, new Set(m.my_reactions));
+    buildReactionRow(bubble.querySelector('.reactions-row'), m.id, m.reactions || {}, m.reaction_counts);
   }
   group.appendChild(bubble);
   // Async link preview for message text
   if (m.content && !m.bot_name) fetchLinkPreviews(bubble, m.content);
 }
 
-function buildReactionRow(rowEl, msgId, reactions) {
+// `reactions` lists the first reactors per emoji; `counts` has the totals. Past the
+// cap the list can't tell whether the viewer reacted, so myReactions is checked too.
+function buildReactionRow(rowEl, msgId, reactions, counts) {
   rowEl.innerHTML = '';
   Object.entries(reactions).forEach(([emoji, users]) => {
     if (!users.length) return;
-    const mine = users.includes(user.id);
+    const mine = users.includes(user.id) || !!myReactions.get(msgId)?.has(emoji);
     const pill = document.createElement('button');
     pill.className = `reaction-pill${mine ? ' mine' : ''}`;
-    pill.innerHTML = `${emoji} <span class="reaction-count">${users.length}</span>`;
+    pill.innerHTML = `${emoji} <span class="reaction-count">${(counts && counts[emoji]) || users.length}</span>`;
     pill.onclick   = () => wsSend({ type: 'react', message_id: msgId, emoji });
     rowEl.appendChild(pill);
   });
@@ -933,7 +1135,7 @@ async function sendMessage() {
     payload.type        = 'dm';
     payload.to_user_id  = activeId;
   }
-  wsSend(payload);
+  sendReliable(payload);
   msgInput.value = '';
   msgInput.style.height = 'auto';
 }
@@ -1385,6 +1587,13 @@ async function executeSlashCommand(text) {
 }
 
 // ── Typing ────────────────────────────────────────────────────────────────────
+function renderTypingBar(key) {
+  const names = Object.values(typingUsers[key] || {});
+  typingBar.textContent = !names.length  ? ''
+                        : names.length === 1 ? `${names[0]} is typing…`
+                        : `${names.join(', ')} are typing…`;
+}
+
 let typingSent = false;
 let typingReset;
 function sendTyping() {
@@ -1495,6 +1704,7 @@ async function createChannel() {
   }
   const ch = await res.json();
   channels.push(ch);
+  wsSend({ type: 'join', channel_ids: [ch.id] });
   renderChannelList();
   closeAddChannelModal();
   openChannel(ch);
@@ -2156,7 +2366,7 @@ async function openGalleryPanel() {
   body.innerHTML = '<div class="gallery-empty">Loading…</div>';
   const r = await authFetch(`/chat/channels/${activeId}/gallery`);
   if (!r.ok) { body.innerHTML = '<div class="gallery-empty">Could not load gallery</div>'; return; }
-  const items = await r.json();
+  const items = (await r.json()).items.reverse();
   if (!items.length) { body.innerHTML = '<div class="gallery-empty">No media in this channel yet.</div>'; return; }
   body.innerHTML = '';
   items.forEach(item => {
@@ -2393,28 +2603,29 @@ async function doSearch(q) {
   let url = `/chat/search?q=${encodeURIComponent(q)}`;
   if (fromUser)   url += `&from_user=${encodeURIComponent(fromUser)}`;
   if (channelId)  url += `&channel_id=${channelId}`;
-  if (afterDate)  url += `&after=${encodeURIComponent(afterDate)}`;
-  if (beforeDate) url += `&before=${encodeURIComponent(beforeDate)}`;
+  if (afterDate)  url += `&from_date=${encodeURIComponent(afterDate)}`;
+  if (beforeDate) url += `&to_date=${encodeURIComponent(beforeDate)}`;
 
   const res = await authFetch(url);
   const resultsEl = document.getElementById('searchResults');
   if (!res.ok) { resultsEl.innerHTML = '<div class="search-empty">Search failed</div>'; return; }
-  const msgs = await res.json();
+  const msgs = (await res.json()).items.reverse();
   if (!msgs.length) { resultsEl.innerHTML = '<div class="search-empty">No results for "' + esc(q) + '"</div>'; return; }
   const highlighted = str => esc(str).replace(new RegExp(esc(q).replace(/[.*+?^${}()|[\]\\]/g, '\\$&'), 'gi'), m => `<mark>${m}</mark>`);
   resultsEl.innerHTML = msgs.map(m => {
     const where = m.channel_id
       ? (channels.find(c => c.id === m.channel_id)?.name || `#${m.channel_id}`)
       : `@ DM`;
-    return `<div class="search-result-item" onclick="jumpToMsg(${m.channel_id},${m.dm_to_user_id},${m.sender_id})">
+    return `<div class="search-result-item" onclick="jumpToMsg(${m.channel_id},${m.dm_to_user_id},${m.sender_id},${m.id})">
       <div class="sri-meta">${esc(m.sender_name)} in <b>${esc(where)}</b> · ${formatTime(m.ts)}</div>
       <div class="sri-text">${highlighted(m.content || (m.file_name ? '📎 ' + m.file_name : ''))}</div>
     </div>`;
   }).join('');
 }
 
-function jumpToMsg(channelId, dmUid, senderId) {
+function jumpToMsg(channelId, dmUid, senderId, msgId) {
   closeSearch();
+  pendingJumpId = msgId || null;
   if (channelId) {
     const ch = channels.find(c => c.id === channelId);
     if (ch) openChannel(ch);
@@ -2455,7 +2666,7 @@ async function openThread(m) {
   const res = await authFetch(`/chat/messages/${m.id}/thread`);
   tmsgs.innerHTML = '';
   if (!res.ok) return;
-  const replies = await res.json();
+  const replies = (await res.json()).items;
   if (!replies.length) {
     tmsgs.innerHTML = '<div style="color:var(--text-muted);font-size:.8rem;padding:8px 0;">No replies yet.</div>';
     return;
@@ -2490,7 +2701,7 @@ function sendThreadReply() {
   const input = document.getElementById('threadInput');
   const text  = input.value.trim();
   if (!text || !threadParentId) return;
-  wsSend({
+  sendReliable({
     type:          'thread_reply',
     parent_id:     threadParentId,
     content:       text,
@@ -3726,7 +3937,7 @@ async function loadFileBrowser() {
   list.innerHTML = '<div style="color:var(--text-muted);font-size:.8rem;padding:12px;">Loading…</div>';
   const res = await authFetch(`/files/${activeId}`);
   if (!res.ok) { list.innerHTML = '<div style="color:var(--text-muted);font-size:.8rem;padding:12px;">Failed to load</div>'; return; }
-  const files = await res.json();
+  const files = (await res.json()).items.reverse();
   if (!files.length) { list.innerHTML = '<div style="color:var(--text-muted);font-size:.8rem;padding:12px;text-align:center;">No files shared yet</div>'; return; }
   const extIcon = n => {
     if (!n) return 'fa-file';
@@ -127,6 +127,10 @@
   let _wbLastX            = 0;
   let _wbLastY            = 0;
   let _wbCtx              = null;
+  let _wbOps              = [];     // ops received before the board was opened
+  let _wbStroke           = null;   // stroke being batched: { color, size, tool, pts: [x, y, dx, dy, ...] }
+  let _wbFlushTimer       = null;
+  const WB_BATCH_MS       = 40;
 
   // Auth — chat is only available to signed-in users
   const IS_SIGNED_IN = !!localStorage.getItem('synctact_user');
@@ -399,6 +403,7 @@
         }
         if (msg.type === 'reaction') fireReaction(msg.emoji);
         if (msg.type === 'whiteboard') handleWbOp(msg);
+        if (msg.type === 'whiteboard_state') msg.ops.forEach(handleWbOp);
       }
     });
 
@@ -1009,6 +1014,9 @@
     wbCanvas.addEventListener('touchstart', wbTouchDown, { passive: false });
     wbCanvas.addEventListener('touchmove',  wbTouchMove, { passive: false });
     wbCanvas.addEventListener('touchend',   wbPointerUp);
+    const pending = _wbOps;
+    _wbOps = [];
+    pending.forEach(handleWbOp);
   }
 
   function resizeWb() {
@@ -1024,11 +1032,26 @@
   function wbPointerDown(e) { _wbDrawing = true; _wbLastX = e.offsetX; _wbLastY = e.offsetY; }
   function wbPointerMove(e) {
     if (!_wbDrawing) return;
-    wbDrawLine(_wbLastX, _wbLastY, e.offsetX, e.offsetY, wbColorPick.value, parseInt(wbSizeRange.value), wbTool);
-    if (rtc) rtc.sendData('whiteboard', { op: 'draw', x0: _wbLastX, y0: _wbLastY, x1: e.offsetX, y1: e.offsetY, color: wbColorPick.value, size: parseInt(wbSizeRange.value), tool: wbTool });
+    const color = wbColorPick.value, size = parseInt(wbSizeRange.value);
+    wbDrawLine(_wbLastX, _wbLastY, e.offsetX, e.offsetY, color, size, wbTool);
+    // Batch segments into one delta-encoded stroke per WB_BATCH_MS
+    if (!_wbStroke || _wbStroke.color !== color || _wbStroke.size !== size || _wbStroke.tool !== wbTool) {
+      wbFlushStroke();
+      _wbStroke = { color, size, tool: wbTool, pts: [_wbLastX, _wbLastY] };
+    }
+    _wbStroke.pts.push(e.offsetX - _wbLastX, e.offsetY - _wbLastY);
+    if (!_wbFlushTimer) _wbFlushTimer = setTimeout(wbFlushStroke, WB_BATCH_MS);
     _wbLastX = e.offsetX; _wbLastY = e.offsetY;
   }
-  function wbPointerUp() { _wbDrawing = false; }
+  function wbPointerUp() { _wbDrawing = false; wbFlushStroke(); }
+  function wbFlushStroke() {
+    clearTimeout(_wbFlushTimer);
+    _wbFlushTimer = null;
+    if (!_wbStroke) return;
+    if (rtc) rtc.sendData('whiteboard', { op: 'stroke', ..._wbStroke });
+    // the next batch continues from the last point
+    _wbStroke = _wbDrawing ? { ..._wbStroke, pts: [_wbLastX, _wbLastY] } : null;
+  }
   function wbTouchDown(e) { e.preventDefault(); const t = e.touches[0]; const r = wbCanvas.getBoundingClientRect(); wbPointerDown({ offsetX: t.clientX - r.left, offsetY: t.clientY - r.top }); }
   function wbTouchMove(e) { e.preventDefault(); const t = e.touches[0]; const r = wbCanvas.getBoundingClientRect(); wbPointerMove({ offsetX: t.clientX - r.left, offsetY: t.clientY - r.top }); }
 
@@ -1045,8 +1068,20 @@
   }
 
   function handleWbOp(msg) {
-    if (!_wbCtx) return;
+    if (!_wbCtx) {
+      if (msg.op === 'clear') _wbOps = [];
+      else _wbOps.push(msg);
+      return;
+    }
     if (msg.op === 'draw') wbDrawLine(msg.x0, msg.y0, msg.x1, msg.y1, msg.color, msg.size, msg.tool);
+    if (msg.op === 'stroke') {
+      let [x, y] = msg.pts;
+      for (let i = 2; i + 1 < msg.pts.length; i += 2) {
+        const nx = x + msg.pts[i], ny = y + msg.pts[i + 1];
+        wbDrawLine(x, y, nx, ny, msg.color, msg.size, msg.tool);
+        x = nx; y = ny;
+      }
+    }
     if (msg.op === 'clear') { _wbCtx.fillStyle = '#ffffff'; _wbCtx.fillRect(0, 0, wbCanvas.width, wbCanvas.height); }
   }
 
@@ -19,6 +19,7 @@ class SyncTactRTC {
     this.peerId     = this._genId();
 
     this.peers      = new Map();  // peerId -> { pc, stream, name }
+    this._chatSeen  = new Set();  // ids of meeting chat messages already shown
     this.localStream = null;
     this.screenStream = null;
 
@@ -105,6 +106,16 @@ class SyncTactRTC {
     switch (msg.type) {
 
       case 'room_state': {
+        // Whiteboard drawn before we joined: compacted snapshot + recent ops
+        if (msg.whiteboard) {
+          this.onData({ type: 'whiteboard_state', ops: [...msg.whiteboard.snapshot, ...msg.whiteboard.tail] });
+        }
+        // Recent meeting chat (skipping what this page already showed before a reconnect)
+        for (const m of (msg.chat || [])) {
+          if (m.from_id === this.peerId || this._chatSeen.has(m.id)) continue;
+          this._chatSeen.add(m.id);
+          this.onMessage({ from: m.from_name, text: m.text, ts: m.ts, self: false });
+        }
         // Existing peers in room
         for (const peer of (msg.peers || [])) {
           if (peer.id !== this.peerId) {
@@ -155,6 +166,7 @@ class SyncTactRTC {
       }
 
       case 'chat': {
+        if (msg.id) this._chatSeen.add(msg.id);
         this.onMessage({ from: msg.from_name, text: msg.text, ts: msg.ts, self: false });
         break;
       }